@@ -0,0 +1,413 @@
+"""
+Analytics file
+
+Turnout, winners and margins, and consistency checks over every polling
+station, computed with NumPy on a columnar snapshot of the results. The
+snapshot is loaded once and only results committed since are read on later
+calls
+"""
+
+import os
+import threading
+import time
+from functools import cached_property
+
+import numpy as np
+from db import Candidate
+from db import NATIONAL_TALLY_NAME
+from db import Polling_Station
+from db import Polling_Station_Result
+from db import Polling_Station_Vote
+from db import Sequence
+from db import db
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy import select
+load_dotenv()
+
+# stations are only reloaded with their shape changes, or after this long
+ANALYTICS_RELOAD_SECONDS = int(os.environ.get("ANALYTICS_RELOAD_SECONDS", 300))
+MAX_ANOMALIES = 1000
+
+# station checks, in the column order of Snapshot.flags
+ANOMALY_FLAGS = ("ballot_totals", "candidate_sum", "over_registered", "negative_count")
+
+
+_snapshot = {"current" : None}
+_lock = threading.Lock()
+
+
+
+class Snapshot:
+    """
+    Every polling station as columns, row i of each array is station_ids[i]
+
+    Stations without a result have reported false and zero counts
+    """
+
+    def __init__(self, stations, candidates):
+        station_ids, constituencies, regions, registered_voters = zip(*stations) if stations else ((), (), (), ())
+
+        self.station_ids = np.array(station_ids, dtype = np.int64)
+        self.registered_voters = np.array([np.nan if count is None else count for count in registered_voters], dtype = np.float64)
+
+        # constituency names may repeat across regions, so constituencies are (region, constituency) pairs
+        self.region_names, self.region_codes = np.unique(np.array(regions, dtype = object), return_inverse = True)
+        pairs = np.array([region + "\0" + constituency for region, constituency in zip(regions, constituencies)], dtype = object)
+        constituency_pairs, self.constituency_codes = np.unique(pairs, return_inverse = True)
+        self.constituency_names = [pair.split("\0", 1)[1] for pair in constituency_pairs]
+        self.constituency_regions = [pair.split("\0", 1)[0] for pair in constituency_pairs]
+
+        self.candidate_ids = np.array([candidate_id for candidate_id, key in candidates], dtype = np.int64)
+        self.candidate_keys = [key for candidate_id, key in candidates]
+
+        n = len(self.station_ids)
+        self.reported = np.zeros(n, dtype = bool)
+        self.total_valid_ballots = np.zeros(n, dtype = np.int64)
+        self.total_rejected_ballots = np.zeros(n, dtype = np.int64)
+        self.total_votes_cast = np.zeros(n, dtype = np.int64)
+        self.votes = np.zeros((n, len(self.candidate_ids)), dtype = np.int64)
+
+        self.shape = None
+        self.last_seq = 0
+        self.loaded_at = time.monotonic()
+
+
+    def copy(self):
+        """
+        Returns a snapshot sharing the station columns, with its own result columns
+        """
+        snapshot = object.__new__(Snapshot)
+        snapshot.__dict__.update(self.__dict__)
+
+        for column in ("reported", "total_valid_ballots", "total_rejected_ballots", "total_votes_cast", "votes"):
+            setattr(snapshot, column, getattr(self, column).copy())
+
+        return snapshot
+
+
+    def add_results(self, results, votes):
+        """
+        Scatters result rows and vote rows, both keyed by polling station id, into the columns
+        """
+        # flags are computed again from the new columns
+        self.__dict__.pop("flags", None)
+        self.__dict__.pop("anomalous", None)
+
+        if results:
+            station_ids, valid, rejected, cast, seqs = (np.array(column) for column in zip(*results))
+            rows = np.searchsorted(self.station_ids, station_ids)
+
+            self.reported[rows] = True
+            self.total_valid_ballots[rows] = valid
+            self.total_rejected_ballots[rows] = rejected
+            self.total_votes_cast[rows] = cast
+            self.last_seq = max(self.last_seq, int(max((seq for seq in seqs if seq is not None), default = 0)))
+
+        if votes:
+            station_ids, candidate_ids, counts = (np.array(column) for column in zip(*votes))
+            self.votes[np.searchsorted(self.station_ids, station_ids), np.searchsorted(self.candidate_ids, candidate_ids)] = counts
+
+
+    @cached_property
+    def flags(self):
+        """
+        Returns a stations x ANOMALY_FLAGS boolean matrix, false for stations without a result
+        """
+        negative = (self.total_valid_ballots < 0) | (self.total_rejected_ballots < 0) | (self.total_votes_cast < 0)
+        if self.votes.shape[1]:
+            negative |= (self.votes < 0).any(axis = 1)
+
+        flags = np.column_stack((
+            self.total_valid_ballots + self.total_rejected_ballots != self.total_votes_cast,
+            self.votes.sum(axis = 1) != self.total_valid_ballots if self.votes.shape[1] else np.zeros(len(self.station_ids), dtype = bool),
+            self.total_votes_cast > self.registered_voters,
+            negative
+        ))
+        return flags & self.reported[:, None]
+
+
+    @cached_property
+    def anomalous(self):
+        """
+        Returns whether each station fails any check
+        """
+        return self.flags.any(axis = 1)
+
+
+
+##### LOADING #####
+def _shape():
+    """
+    Returns what the station columns of a snapshot depend on, read in one cheap query
+    """
+    row = db.session.execute(select(
+        select(func.count(Polling_Station.id)).scalar_subquery(),
+        select(func.max(Polling_Station.id)).scalar_subquery(),
+        select(func.count(Candidate.id)).scalar_subquery(),
+        select(func.max(Candidate.id)).scalar_subquery(),
+        select(Sequence.value).where(Sequence.name == "results").scalar_subquery()
+    )).one()
+    return tuple(row[:4]), row[4] or 0
+
+
+def _result_rows(since = None):
+    """
+    Returns the (station id, valid, rejected, cast, seq) rows of results committed
+    after the ingest sequence number since, or of every result
+    """
+    query = select(Polling_Station_Result.polling_station_id,
+                   Polling_Station_Result.total_valid_ballots,
+                   Polling_Station_Result.total_rejected_ballots,
+                   Polling_Station_Result.total_votes_cast,
+                   Polling_Station_Result.seq)
+
+    if since is not None:
+        query = query.where(Polling_Station_Result.seq > since)
+
+    return db.session.execute(query).all()
+
+
+def _vote_rows(since = None):
+    """
+    Returns the (station id, candidate id, votes) rows of results committed
+    after the ingest sequence number since, or of every result
+    """
+    query = select(Polling_Station_Vote.polling_station_id,
+                   Polling_Station_Vote.candidate_id,
+                   Polling_Station_Vote.votes)
+
+    if since is not None:
+        query = query.join(
+            Polling_Station_Result, Polling_Station_Result.polling_station_id == Polling_Station_Vote.polling_station_id
+        ).where(Polling_Station_Result.seq > since)
+
+    return db.session.execute(query).all()
+
+
+def load_snapshot():
+    """
+    Returns the snapshot of every station and result, up to date with the database
+
+    Stations and candidates are read again when they change, otherwise only
+    the results committed since the last call are read and added
+    """
+    shape, last_seq = _shape()
+
+    with _lock:
+        snapshot = _snapshot["current"]
+        stale = (snapshot is None
+                 or snapshot.shape != shape
+                 # the database was reset
+                 or last_seq < snapshot.last_seq
+                 or time.monotonic() - snapshot.loaded_at > ANALYTICS_RELOAD_SECONDS)
+
+        if stale:
+            stations = db.session.execute(select(Polling_Station.id,
+                                                 Polling_Station.constituency,
+                                                 Polling_Station.region,
+                                                 Polling_Station.registered_voters).order_by(Polling_Station.id)).all()
+            candidates = db.session.execute(select(Candidate.id, Candidate.key).order_by(Candidate.id)).all()
+
+            snapshot = Snapshot(stations, candidates)
+            snapshot.shape = shape
+            snapshot.add_results(_result_rows(), _vote_rows())
+
+        elif last_seq > snapshot.last_seq:
+            since = snapshot.last_seq
+            snapshot = snapshot.copy()
+            snapshot.add_results(_result_rows(since), _vote_rows(since))
+
+        _snapshot["current"] = snapshot
+
+    return snapshot
+
+
+def invalidate():
+    """
+    Drops the snapshot, the next call loads everything again
+    """
+    with _lock:
+        _snapshot["current"] = None
+
+
+
+##### COMPUTING #####
+def _group_sum(codes, groups, values):
+    """
+    Returns values summed per group code, values being a column or a stations x k matrix
+    """
+    if values.ndim == 1:
+        return np.bincount(codes, weights = values, minlength = groups)
+
+    # a bincount per candidate column is faster than np.add.at over the matrix
+    acc = np.zeros((groups, values.shape[1]))
+    for column in range(values.shape[1]):
+        acc[:, column] = np.bincount(codes, weights = values[:, column], minlength = groups)
+    return acc
+
+
+def _share(numerator, denominator):
+    """
+    Returns numerator / denominator, with nan where the denominator is 0
+    """
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
+
+
+def _aggregate(snapshot, codes, groups):
+    """
+    Returns the per group columns of a grouping of the stations
+    """
+    reported = snapshot.reported
+    registered = reported & ~np.isnan(snapshot.registered_voters)
+
+    res = {
+        "stations_total" : np.bincount(codes, minlength = groups),
+        "stations_reported" : np.bincount(codes[reported], minlength = groups),
+        "total_valid_ballots" : _group_sum(codes, groups, snapshot.total_valid_ballots),
+        "total_rejected_ballots" : _group_sum(codes, groups, snapshot.total_rejected_ballots),
+        "total_votes_cast" : _group_sum(codes, groups, snapshot.total_votes_cast),
+        "votes" : _group_sum(codes, groups, snapshot.votes),
+        "anomalies" : np.bincount(codes[snapshot.anomalous], minlength = groups)
+    }
+
+    # turnout over the reporting stations whose registration is known
+    registered_voters = np.bincount(codes[registered], weights = snapshot.registered_voters[registered], minlength = groups)
+    votes_cast = np.bincount(codes[registered], weights = snapshot.total_votes_cast[registered], minlength = groups)
+    res["registered_voters"] = registered_voters
+    res["turnout"] = _share(votes_cast, registered_voters)
+
+    # winner and runner up by sorting each group's candidates by votes
+    votes = res["votes"]
+    order = np.argsort(-votes, axis = 1, kind = "stable")
+    top = np.take_along_axis(votes, order[:, :2], axis = 1)
+    first = top[:, 0] if votes.shape[1] else np.zeros(groups)
+    second = top[:, 1] if votes.shape[1] > 1 else np.zeros(groups)
+
+    res["winner"] = np.where(first > 0, order[:, 0] if votes.shape[1] else -1, -1)
+    res["runner_up"] = np.where(second > 0, order[:, 1] if votes.shape[1] > 1 else -1, -1)
+    res["margin"] = first - second
+    res["margin_share"] = _share(first - second, res["total_valid_ballots"])
+    return res
+
+
+def _number(value):
+    """
+    Returns a number as a json number, nan as None
+    """
+    value = float(value)
+    if value != value:
+        return None
+    return int(value) if value.is_integer() else round(value, 6)
+
+
+def _serialize_groups(snapshot, columns, names):
+    """
+    Returns one dict per group from the per group columns
+    """
+    keys = snapshot.candidate_keys
+    acc = []
+
+    # plain lists index much faster than arrays, one element at a time
+    columns = {name : column.tolist() for name, column in columns.items()}
+
+    for i, name in enumerate(names):
+        winner, runner_up = columns["winner"][i], columns["runner_up"][i]
+        acc.append({
+            "name" : name,
+            "stations_total" : _number(columns["stations_total"][i]),
+            "stations_reported" : _number(columns["stations_reported"][i]),
+            "registered_voters" : _number(columns["registered_voters"][i]),
+            "total_votes_cast" : _number(columns["total_votes_cast"][i]),
+            "total_valid_ballots" : _number(columns["total_valid_ballots"][i]),
+            "total_rejected_ballots" : _number(columns["total_rejected_ballots"][i]),
+            "turnout" : _number(columns["turnout"][i]),
+            "data" : {key : _number(votes) for key, votes in zip(keys, columns["votes"][i])},
+            "winner" : keys[winner] if winner >= 0 else None,
+            "runner_up" : keys[runner_up] if runner_up >= 0 else None,
+            "margin" : _number(columns["margin"][i]),
+            "margin_share" : _number(columns["margin_share"][i]),
+            "anomalies" : _number(columns["anomalies"][i])
+        })
+
+    return acc
+
+
+def get_summary():
+    """
+    Returns national turnout, candidate totals, winner and margin, and anomaly counts
+    """
+    start = time.perf_counter()
+    snapshot = load_snapshot()
+
+    columns = _aggregate(snapshot, np.zeros(len(snapshot.station_ids), dtype = np.int64), 1)
+    res = _serialize_groups(snapshot, columns, [NATIONAL_TALLY_NAME])[0]
+    res["anomaly_counts"] = dict(zip(ANOMALY_FLAGS, (int(count) for count in snapshot.flags.sum(axis = 0))))
+    res["as_of_seq"] = snapshot.last_seq
+    res["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return True, res
+
+
+def get_constituencies():
+    """
+    Returns turnout, candidate totals, winner and margin for every constituency
+    """
+    start = time.perf_counter()
+    snapshot = load_snapshot()
+
+    columns = _aggregate(snapshot, snapshot.constituency_codes, len(snapshot.constituency_names))
+    acc = _serialize_groups(snapshot, columns, snapshot.constituency_names)
+    for constituency, region in zip(acc, snapshot.constituency_regions):
+        constituency["region_name"] = region
+
+    res = {
+        "constituencies" : acc,
+        "as_of_seq" : snapshot.last_seq,
+        "elapsed_ms" : round((time.perf_counter() - start) * 1000, 3)
+    }
+    return True, res
+
+
+def get_regions():
+    """
+    Returns turnout, candidate totals, winner and margin for every region
+    """
+    start = time.perf_counter()
+    snapshot = load_snapshot()
+
+    columns = _aggregate(snapshot, snapshot.region_codes, len(snapshot.region_names))
+
+    res = {
+        "regions" : _serialize_groups(snapshot, columns, list(snapshot.region_names)),
+        "as_of_seq" : snapshot.last_seq,
+        "elapsed_ms" : round((time.perf_counter() - start) * 1000, 3)
+    }
+    return True, res
+
+
+def get_anomalies(limit = MAX_ANOMALIES):
+    """
+    Returns the stations whose result fails a consistency check, with the checks failed
+    """
+    start = time.perf_counter()
+    snapshot = load_snapshot()
+
+    flags = snapshot.flags
+    rows = np.flatnonzero(snapshot.anomalous)
+
+    stations = [{
+        "polling_station_id" : int(snapshot.station_ids[row]),
+        "constituency_name" : snapshot.constituency_names[snapshot.constituency_codes[row]],
+        "region_name" : snapshot.region_names[snapshot.region_codes[row]],
+        "flags" : [flag for flag, failed in zip(ANOMALY_FLAGS, flags[row]) if failed]
+    } for row in rows[:limit]]
+
+    res = {
+        "counts" : dict(zip(ANOMALY_FLAGS, (int(count) for count in flags.sum(axis = 0)))),
+        "total" : len(rows),
+        "stations" : stations,
+        "as_of_seq" : snapshot.last_seq,
+        "elapsed_ms" : round((time.perf_counter() - start) * 1000, 3)
+    }
+    return True, res
@@ -1,25 +1,129 @@
+import hashlib
 import json
 import os
+import sys
+from functools import partial
 
+import analytics
+import click
+from db import configure_sqlite
 from db import db
-from db import load_polling_stations
-from flask import Flask, request
+from db import NATIONAL_TALLY_NAME
+import hashing
+import idempotency
+import pinksheets
+import provisioning
+from importer import import_candidates
+from importer import import_polling_agents
+from importer import import_polling_stations
+from importer import read_records
+from importer import write_agent_manifest
+from migrations import migrate_candidate_votes
+from migrations import migrate_pink_sheets
+from migrations import migrate_registered_voters
+from migrations import migrate_result_sequence
+from migrations import migrate_station_hierarchy
+from migrations import migrate_totp_steps
+from flask import Blueprint, Flask, Response, current_app, request, send_file, stream_with_context
 import dao
 import datetime
-from twilioapp import sendmessage
+import feed
+import twilioapp
+import writer
+from tokens import token_digest
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from dotenv import load_dotenv
+load_dotenv()
 
 db_filename = "collation.db"
-app = Flask(__name__)
+FEED_HEARTBEAT_SECONDS = 15
+FEED_LONG_POLL_SECONDS = 30
+FEED_RETRY_SECONDS = 5
+PINK_SHEET_MAX_AGE = 365 * 24 * 3600
+SUBMIT_BATCH_MAX_SIZE = int(os.environ.get("SUBMIT_BATCH_MAX_SIZE", 500))
+
+# every route and cli command is registered on this blueprint, see create_app
+api = Blueprint("api", __name__, cli_group = None)
+
+
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+
+def database_uri():
+    """
+    Returns the database to use, DATABASE_URL or the development SQLite file
+    """
+    uri = os.environ.get("DATABASE_URL", "sqlite:///%s" % db_filename)
+
+    # some hosts hand out postgres:// urls, which SQLAlchemy no longer accepts
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+
+    return uri
+
+
+def engine_options(uri):
+    """
+    Returns the engine options for uri
+
+    The pool is only sized for dialects using a queue pool, in-memory SQLite
+    keeps one connection per thread and takes no pool_size or max_overflow
+    """
+    options = {
+        "pool_recycle" : int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping" : True
+    }
+
+    url = make_url(uri)
+
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update({
+            "pool_size" : int(os.environ.get("DB_POOL_SIZE", 10)),
+            "max_overflow" : int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+            "pool_timeout" : int(os.environ.get("DB_POOL_TIMEOUT", 30))
+        })
+
+    return options
+
+
+def create_app(config = None):
+    """
+    Creates the app, configured from the environment and then from config
+
+    Tables are created when they are missing unless DB_CREATE_TABLES is off,
+    existing data is never dropped, see the reset-db command
+    """
+    app = Flask(__name__)
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri()
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ECHO"] = env_flag("SQLALCHEMY_ECHO", "false")
+    # lets a fronting nginx serve pink sheets from disk, see get_pink_sheet
+    app.config["USE_X_SENDFILE"] = env_flag("USE_X_SENDFILE", "false")
+    app.config.update(config or {})
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
+
+    # SQLite takes one writer at a time, so its result submissions go through
+    # a single writer thread, see writer.py. Other databases take them directly
+    is_sqlite = app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite")
+    app.config.setdefault("DB_WRITE_QUEUE", env_flag("DB_WRITE_QUEUE", "true" if is_sqlite else "false"))
+
+    db.init_app(app)
+    writer.init_app(app)
+    app.register_blueprint(api)
+
+    with app.app_context():
+        configure_sqlite(db.engine)
+
+        if env_flag("DB_CREATE_TABLES", "true"):
+            db.create_all()
+
+    return app
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
 
-db.init_app(app)
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-    
 # generalized response formats
 def success_response(data, code=200):
     """
@@ -51,7 +155,80 @@ def extract_token(request):
     return True, bearer_token
 
 
-@app.route("/")
+def request_flag(request, name):
+    """
+    Returns true if the query string flag name is set, e.g. ?aggregate=true
+    """
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+
+def parse_count(value, default):
+    """
+    Returns whether a query string argument or header is a non-negative int,
+    and its value, default when it is not given
+    """
+    if value is None:
+        return True, default
+
+    try:
+        value = int(value)
+    except ValueError:
+        return False, None
+
+    return value >= 0, value
+
+
+def delta_requested(request):
+    return "since" in request.args or "since_time" in request.args
+
+
+def delta_response(scope, name):
+    """
+    Returns the results of a scope committed after ?since=<seq> and, if
+    given, after ?since_time=<iso timestamp>
+    """
+    valid_since, since = parse_count(request.args.get("since"), 0)
+    valid_limit, limit = parse_count(request.args.get("limit"), dao.RESULTS_PAGE_SIZE)
+    since_time = request.args.get("since_time")
+
+    try:
+        since_time = datetime.datetime.fromisoformat(since_time) if since_time else None
+    except ValueError:
+        return failure_response("Invalid inputs", 400)
+
+    if not (valid_since and valid_limit) or limit < 1:
+        return failure_response("Invalid inputs", 400)
+
+    success, res = dao.get_results_since(since, since_time, scope, name, min(limit, dao.MAX_RESULTS_PAGE_SIZE))
+    return success_response(res)
+
+
+def cached_response(scope, name, variant, get_results):
+    """
+    Returns a results response from the results cache, building and caching it on a miss
+
+    get_results is a dao getter returning success and results. Responses carry
+    an ETag, and a request with a matching If-None-Match gets a 304 with no body
+    """
+    cached = dao.get_cached_results(scope, name, variant)
+
+    if cached is None:
+        success, res = get_results()
+
+        if not success:
+            return False, res
+        
+        body = json.dumps(res).encode("utf8")
+        cached = (hashlib.sha1(body).hexdigest(), body)
+        dao.cache_results(scope, name, variant, cached)
+
+    etag, body = cached
+    response = Response(body)
+    response.set_etag(etag)
+    return True, response.make_conditional(request)
+
+
+@api.route("/")
 def hello_world():
     """
     Endpoint for testing server
@@ -63,10 +240,13 @@ def hello_world():
 #####################GET REQUESTS################################  
 
 
-@app.route("/sendconstituencyresults/")
+@api.route("/sendconstituencyresults/")
 def send_results_by_constituency():
     """
     Endpoint to get results by constituency
+
+    Pass ?aggregate=true to get summed results instead of per station results,
+    or ?since=<seq> to get only the stations reported after that ingest sequence
     """
     body = json.loads(request.data)
     constituency_name = body.get("constituency_name")
@@ -74,19 +254,30 @@ def send_results_by_constituency():
     if constituency_name is None:
         return failure_response("Invalid inputs")
     
-    success, res = dao.get_result_by_constituency(name = constituency_name)
+    if delta_requested(request):
+        return delta_response("constituency", constituency_name)
+
+    if request_flag(request, "aggregate"):
+        success, res = cached_response("constituency", constituency_name, "aggregate",
+                                       lambda: dao.get_tally_by_constituency(name = constituency_name))
+    else:
+        success, res = cached_response("constituency", constituency_name, "stations",
+                                       lambda: dao.get_result_by_constituency(name = constituency_name))
 
     if not success:
         return failure_response("Constituency does not exists")
     
-    return success_response(res)
+    return res
 
 
 
-@app.route("/sendregionresults/")
+@api.route("/sendregionresults/")
 def send_results_by_region():
     """
     Endpoint to get results by region
+
+    Pass ?aggregate=true to get summed results instead of per station results,
+    or ?since=<seq> to get only the stations reported after that ingest sequence
     """
     body = json.loads(request.data)
     region_name = body.get("region_name")
@@ -94,28 +285,274 @@ def send_results_by_region():
     if region_name is None:
         return failure_response("Invalid inputs")
     
-    success, res = dao.get_result_by_region(name = region_name)
+    if delta_requested(request):
+        return delta_response("region", region_name)
+
+    if request_flag(request, "aggregate"):
+        success, res = cached_response("region", region_name, "aggregate",
+                                       lambda: dao.get_tally_by_region(name = region_name))
+    else:
+        success, res = cached_response("region", region_name, "stations",
+                                       lambda: dao.get_result_by_region(name = region_name))
 
     if not success:
         return failure_response("Region does not exists")
     
-    return success_response(res)
+    return res
 
 
-@app.route("/sendallresults/")
+@api.route("/sendallresults/")
 def send_all_results():
     """
     Endpoint to get all results
+
+    Pass ?aggregate=true to get summed results instead of per station results,
+    ?after=<id>&limit=<n> to page through stations ordered by id, or
+    ?stream=true to stream every station as newline delimited json
+
+    Pass ?since=<seq> (and/or ?since_time=<iso timestamp>) to get only the
+    stations reported since, with the updated aggregate; resume with the
+    returned last_seq
     """
     
-    success, res = dao.get_all_results()
+    if request_flag(request, "stream"):
+        def generate():
+            for polling_station in dao.iter_all_results():
+                yield json.dumps(polling_station) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype = "application/x-ndjson")
+
+    if delta_requested(request):
+        return delta_response("national", NATIONAL_TALLY_NAME)
+
+    if request_flag(request, "aggregate"):
+        success, res = cached_response("national", NATIONAL_TALLY_NAME, "aggregate", dao.get_national_tally)
+    elif "after" in request.args or "limit" in request.args:
+        valid_after, after = parse_count(request.args.get("after"), 0)
+        valid_limit, limit = parse_count(request.args.get("limit"), dao.RESULTS_PAGE_SIZE)
+
+        if not (valid_after and valid_limit) or limit < 1:
+            return failure_response("Invalid inputs", 400)
+
+        limit = min(limit, dao.MAX_RESULTS_PAGE_SIZE)
+        success, res = cached_response("national", NATIONAL_TALLY_NAME, f"page:{after}:{limit}",
+                                       lambda: dao.get_results_page(after, limit))
+    else:
+        success, res = cached_response("national", NATIONAL_TALLY_NAME, "stations", dao.get_all_results)
 
     if not success:
         return failure_response("Results is empty")
     
+    return res
+
+@api.route("/pollingagentqrcode/<kind>/")
+def get_polling_agent_qrcode(kind):
+    """
+    Endpoint to get the uri or key TOTP QR code of the logged in polling agent as a png
+    """
+    success, session_token = extract_token(request)
+    if not success:
+        return failure_response(session_token)
+    
+    success, polling_agent_id = dao.verify_session(session_token)
+    if not success:
+        return failure_response("Invalid session token", 401)
+    
+    success, polling_agent = dao.get_polling_agent_by_id(polling_agent_id)
+    if not success:
+        return failure_response("Polling agent does not exists")
+    
+    success, png = dao.get_polling_agent_qrcode(polling_agent, kind)
+
+    if not success:
+        return failure_response("QR code does not exists")
+    
+    return Response(png, mimetype = "image/png")
+
+
+@api.route("/pinksheets/<digest>/")
+def get_pink_sheet(digest):
+    """
+    Endpoint to get a pink sheet image by digest, served from disk
+    """
+    if not pinksheets.exists(digest):
+        return failure_response("Pink sheet does not exists")
+
+    # content-addressed files never change
+    return send_file(pinksheets.path(digest),
+                     mimetype = pinksheets.get_mimetype(digest) or "application/octet-stream",
+                     etag = digest,
+                     max_age = PINK_SHEET_MAX_AGE)
+
+
+@api.route("/pinksheets/<digest>/thumbnail/")
+def get_pink_sheet_thumbnail(digest):
+    """
+    Endpoint to get the jpeg thumbnail of a pink sheet by digest
+    """
+    success, thumbnail = pinksheets.thumbnail_path(digest)
+
+    if not success:
+        return failure_response("Thumbnail does not exists")
+
+    path, mimetype = thumbnail
+    return send_file(path, mimetype = mimetype, etag = digest, max_age = PINK_SHEET_MAX_AGE)
+
+
+@api.route("/candidates/")
+def get_candidates():
+    """
+    Endpoint to get the candidates, by the key results name them with
+    """
+    success, candidates = dao.get_candidates()
+    return success_response([candidate.serialize() for candidate in candidates])
+
+
+@api.route("/analytics/summary/")
+def get_analytics_summary():
+    """
+    Endpoint to get national turnout, candidate totals, winner, margin and anomaly counts
+    """
+    success, res = analytics.get_summary()
+    return success_response(res)
+
+
+@api.route("/analytics/constituencies/")
+def get_analytics_constituencies():
+    """
+    Endpoint to get turnout, winner and margin of every constituency
+    """
+    success, res = analytics.get_constituencies()
     return success_response(res)
 
-# @app.route("/pollingagent/<int:id>/")
+
+@api.route("/analytics/regions/")
+def get_analytics_regions():
+    """
+    Endpoint to get turnout, winner and margin of every region
+    """
+    success, res = analytics.get_regions()
+    return success_response(res)
+
+
+@api.route("/analytics/anomalies/")
+def get_analytics_anomalies():
+    """
+    Endpoint to get the results failing a consistency check, e.g. valid and
+    rejected ballots not adding up to the votes cast
+    """
+    try:
+        limit = min(int(request.args.get("limit", analytics.MAX_ANOMALIES)), analytics.MAX_ANOMALIES)
+    except ValueError:
+        return failure_response("Invalid limit", 400)
+
+    if limit < 0:
+        return failure_response("Invalid limit", 400)
+
+    success, res = analytics.get_anomalies(limit)
+    return success_response(res)
+
+
+def connect_feed(kind):
+    """
+    Takes a results feed slot of this worker, see feed.connect
+    """
+    app = current_app._get_current_object()
+
+    def last_result_seq():
+        with app.app_context():
+            return dao.get_last_result_seq()
+
+    return feed.connect(last_result_seq, kind)
+
+
+@api.route("/resultsfeed/")
+def results_feed():
+    """
+    Endpoint streaming new results and updated totals as server-sent events
+
+    Each event id is its sequence number, so a reconnecting client resumes
+    with the Last-Event-ID header (or ?since=<seq>). Clients past
+    FEED_MAX_STREAMS get a 503, see feed.py
+    """
+    valid, since = parse_count(request.headers.get("Last-Event-ID") or request.args.get("since"), 0)
+    if not valid:
+        return failure_response("Invalid inputs", 400)
+
+    if not connect_feed("stream"):
+        return failure_response("Results feed is full, retry later", 503) + ({"Retry-After" : str(FEED_RETRY_SECONDS)},)
+
+    def generate():
+        last_seq = since
+        yield "retry: 3000\n\n"
+
+        while True:
+            last_seq, events = dao.wait_for_result_events(last_seq, FEED_HEARTBEAT_SECONDS)
+
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+
+            for event in events:
+                yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    headers = {"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"}
+    response = Response(stream_with_context(generate()), mimetype = "text/event-stream", headers = headers)
+
+    # called when the client goes away and the server closes the stream
+    response.call_on_close(partial(feed.disconnect, "stream"))
+    return response
+
+
+@api.route("/resultsfeed/poll/")
+def results_feed_poll():
+    """
+    Endpoint returning results committed after ?since=<seq>, waiting up to
+    ?timeout=<seconds> for one when there are none yet
+
+    Long polls have their own FEED_MAX_POLLS slots, so they never take the
+    place of a stream
+    """
+    valid, since = parse_count(request.args.get("since"), 0)
+    if not valid:
+        return failure_response("Invalid inputs", 400)
+
+    timeout = min(max(request.args.get("timeout", FEED_LONG_POLL_SECONDS, type = float), 0), FEED_LONG_POLL_SECONDS)
+
+    if not connect_feed("poll"):
+        return failure_response("Results feed is full, retry later", 503) + ({"Retry-After" : str(FEED_RETRY_SECONDS)},)
+
+    try:
+        last_seq, events = dao.wait_for_result_events(since, timeout)
+    finally:
+        feed.disconnect("poll")
+
+    res = {
+        "last_seq" : last_seq,
+        "events" : events
+    }
+    return success_response(res)
+
+
+@api.route("/metrics/")
+def get_metrics():
+    """
+    Endpoint to get internal metrics
+    """
+    res = {
+        "hashing" : hashing.metrics(),
+        "provisioning" : provisioning.metrics(),
+        "pinksheets" : pinksheets.metrics(),
+        "sms" : twilioapp.metrics(),
+        "writes" : writer.metrics(),
+        "feed" : feed.metrics(),
+        "session_cache" : dao.session_cache.metrics(),
+        "results_cache" : dao.results_cache.metrics(),
+        "idempotency" : idempotency.metrics()
+    }
+    return success_response(res)
+
+# @api.route("/pollingagent/<int:id>/")
 # def get_polling_agent_by_id(id):
 #     """
 #     Endpoint to get polling agent by id
@@ -131,20 +568,62 @@ def send_all_results():
 ###################################################################
 #######################POSTS REQUESTS##############################
 
-@app.route("/createpollingstations/", methods = ["POST"])
+@api.route("/createpollingstations/", methods = ["POST"])
 def create_polling_stations():
     """
-    Endpoint to create polling_stations
+    Endpoint to create polling_stations from polling_stations.xlsx
+
+    Existing stations are updated in place by number, keeping their agents and results
     """
-    success = load_polling_stations()
+    success, stats = import_polling_stations()
 
     if not success:
         return failure_response("Couldn't load polling stations", 400)
     
-    return success_response("Created polling stations", 201) 
+    dao.rebuild_tallies()
+
+    return success_response(stats, 201) 
+
+
+@api.route("/createpollingagents/", methods = ["POST"])
+def create_polling_agents():
+    """
+    Endpoint to create polling agents in bulk
+
+    Authenticated with the key of a collation centre, which can only create
+    agents for the stations in its area. Takes {"agents": [...]} with name
+    (or firstname and lastname), phone_number, polling_station_number and
+    optionally password for each agent, or loads agents.xlsx when there is
+    no body. Created rows carry the session token the agent fetches their QR
+    codes with, and the generated password if any
+    """
+    success, key = extract_token(request)
+    if not success:
+        return failure_response(key, 401)
+
+    success, collation_centre = dao.verify_collation_centre_key(key)
+    if not success:
+        return failure_response("Invalid collation centre key", 401)
+
+    if request.data:
+        agents = json.loads(request.data).get("agents")
+
+        if not isinstance(agents, list):
+            return failure_response("Invalid inputs!", 400)
+        
+        records = enumerate(agents, start = 1)
+    else:
+        records = read_records("agents.xlsx")
+
+    success, report = import_polling_agents(records, collation_centre = collation_centre)
+
+    if not success:
+        return failure_response(report, 400)
+    
+    return success_response(report, 201)
 
 
-@app.route("/pollingagent/", methods = ["POST"])
+@api.route("/pollingagent/", methods = ["POST"])
 def create_polling_agent():
     """
     Endpoint to create a polling agent account
@@ -185,14 +664,90 @@ def create_polling_agent():
 
 
 
+@api.route("/pinksheets/", methods = ["POST"])
+def upload_pink_sheet():
+    """
+    Endpoint to upload a scanned pink sheet, as the "pink_sheet" file of a
+    multipart form or as the raw request body
+
+    Returns the digest to submit as the result's pinksheet
+    """
+    success, session_token = extract_token(request)
+    if not success:
+        return failure_response(session_token)
+    
+    success, polling_agent_id = dao.verify_session(session_token)
+    if not success:
+        return failure_response("Invalid session token", 401)
+
+    upload = request.files.get("pink_sheet")
+    success, digest = pinksheets.store_upload(upload.stream if upload else request.stream)
+
+    if not success:
+        return failure_response(digest, 400)
+
+    res = {
+        "pink_sheet" : digest,
+        "url" : f"/pinksheets/{digest}/",
+        "thumbnail_url" : f"/pinksheets/{digest}/thumbnail/"
+    }
+    return success_response(res, 201)
+
+
 # TODO: WORK ON THIS
-@app.route("/submitresult/<int:polling_agent_id>/", methods = ["POST"])
+@api.route("/submitresult/<int:polling_agent_id>/", methods = ["POST"])
 def submit_result(polling_agent_id):
     """
     Endpoint to create a result
+
+    pinksheet is the digest returned by /pinksheets/ for the uploaded scan.
+    Retries sent with the same Idempotency-Key header get the first
+    successful response back from memory
     """
     body = json.loads(request.data)
-    
+    idempotency_key = request.headers.get("Idempotency-Key")
+
+    if not idempotency_key:
+        return create_result(polling_agent_id, body)
+
+    if len(idempotency_key) > idempotency.MAX_KEY_LENGTH:
+        return failure_response("Invalid Idempotency-Key", 400)
+
+    success, session_token = extract_token(request)
+    if not success:
+        return failure_response(session_token)
+
+    # keys are only shared by requests with the same session token and agent
+    key = (token_digest(session_token), polling_agent_id, idempotency_key)
+
+    # a retry may come with a fresh TOTP code
+    request_fingerprint = idempotency.fingerprint(body, exclude = ("auto_password",))
+
+    run, response = idempotency.begin(key, request_fingerprint)
+
+    if not run:
+        if response is None:
+            return failure_response("Idempotency-Key was used by another request", 409)
+        return response + ({"Idempotent-Replayed" : "true"},)
+
+    response = None
+    try:
+        response = create_result(polling_agent_id, body, replayable = True)
+    finally:
+        # failures are not kept, so a retry gets another chance
+        idempotency.finish(key, request_fingerprint, response if response and response[1] == 201 else None)
+
+    return response
+
+
+def create_result(polling_agent_id, body, replayable = False):
+    """
+    Creates a result from a /submitresult/ body and returns the response
+
+    If replayable, a result the polling agent already submitted with the
+    same counts is returned as created, since the request is a retry handled
+    by another worker
+    """
     data = body.get("data")
     total_rejected_ballots = body.get("total_rejected_ballots")
     total_votes_cast = body.get("total_votes_casts")
@@ -200,12 +755,14 @@ def submit_result(polling_agent_id):
     pink_sheet = body.get("pinksheet")
     auto_password = body.get("auto_password")
     polling_station_id = body.get("polling_station_id")
-    data, success_code = secret_message()
+    message, success_code = secret_message()
 
-    if success_code != 201 or json.loads(data) != "Session verified!":
+    if success_code != 201 or json.loads(message) != "Session verified!":
         return failure_response("Session expired", 400)
 
-    provided_all_data = data and total_rejected_ballots and total_votes_cast and total_valid_ballots and pink_sheet and auto_password and polling_station_id
+    # ballot counts can legitimately be 0
+    provided_all_counts = all(dao.is_count(count) for count in (total_rejected_ballots, total_votes_cast, total_valid_ballots))
+    provided_all_data = data and provided_all_counts and pink_sheet and auto_password and polling_station_id
     if not (provided_all_data):
         return failure_response("Invalid inputs!", 400)
     
@@ -218,13 +775,93 @@ def submit_result(polling_agent_id):
                                                                         polling_station_id,
                                                                         auto_password)
     
+    if not created and replayable:
+        created, polling_station_result = dao.get_resubmitted_result(polling_agent_id,
+                                                                     polling_station_id,
+                                                                     data,
+                                                                     total_votes_cast,
+                                                                     total_rejected_ballots,
+                                                                     total_valid_ballots)
+
     if not created:
-        return failure_response("Couldn't create result", 400)
+        return failure_response(polling_station_result or "Couldn't create result", 400)
     
     return success_response(polling_station_result.serialize(), 201)
     
 
-@app.route("/pollingagentlogin/", methods=["POST"])
+@api.route("/submitresults/", methods = ["POST"])
+def submit_results():
+    """
+    Endpoint to create the results of many polling stations at once, for
+    collation centres catching up on a backlog
+
+    Authenticated with the key of the collation centre, see the
+    create-collation-centre command. Body is {"results" : [...]}, each item
+    the body of /submitresult/ without auto_password, plus its
+    polling_agent_id. Returns the status of every item, in order
+    """
+    success, key = extract_token(request)
+    if not success:
+        return failure_response(key, 401)
+
+    success, collation_centre = dao.verify_collation_centre_key(key)
+    if not success:
+        return failure_response("Invalid collation centre key", 401)
+
+    body = json.loads(request.data)
+    items = body.get("results")
+
+    if not isinstance(items, list) or not items:
+        return failure_response("Invalid inputs!", 400)
+
+    if len(items) > SUBMIT_BATCH_MAX_SIZE:
+        return failure_response(f"At most {SUBMIT_BATCH_MAX_SIZE} results per batch", 400)
+
+    acc = [None] * len(items)
+    submissions = []
+    indexes = []
+
+    for i, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        submission = {
+            "data" : item.get("data"),
+            "total_votes_cast" : item.get("total_votes_casts"),
+            "total_rejected_ballots" : item.get("total_rejected_ballots"),
+            "total_valid_ballots" : item.get("total_valid_ballots"),
+            "pink_sheet" : item.get("pinksheet"),
+            "polling_agent_id" : item.get("polling_agent_id"),
+            "polling_station_id" : item.get("polling_station_id")
+        }
+        data = submission["data"]
+
+        # ballot counts and votes can legitimately be 0
+        provided_all_counts = all(dao.is_count(submission[field]) for field in ("total_votes_cast", "total_rejected_ballots", "total_valid_ballots"))
+        provided_all_votes = isinstance(data, dict) and data and all(dao.is_count(votes) for votes in data.values())
+        provided_all_ids = all(dao.is_count(submission[field]) for field in ("polling_agent_id", "polling_station_id"))
+
+        if not (provided_all_counts and provided_all_votes and provided_all_ids and submission["pink_sheet"]):
+            acc[i] = {"status" : "rejected", "error" : "Invalid inputs!"}
+            continue
+
+        submissions.append(submission)
+        indexes.append(i)
+
+    for i, (created, value) in zip(indexes, dao.create_polling_station_results(submissions, collation_centre)):
+        if created:
+            acc[i] = {"status" : "accepted", "result" : value.serialize()}
+        else:
+            acc[i] = {"status" : "rejected", "error" : value}
+
+    accepted = sum(1 for item in acc if item["status"] == "accepted")
+    res = {
+        "accepted" : accepted,
+        "rejected" : len(acc) - accepted,
+        "results" : acc
+    }
+    return success_response(res, 201 if accepted else 200)
+
+
+@api.route("/pollingagentlogin/", methods=["POST"])
 def login_by_polling_agent():
     """
     Endpoint for logging in a polling agent
@@ -260,7 +897,7 @@ def login_by_polling_agent():
     return success_response(res)
 
 
-@app.route("/pollingagentlogout/", methods=["POST"])
+@api.route("/pollingagentlogout/", methods=["POST"])
 def logout_by_polling_agent():
     """
     Endpoint to logout polling agent
@@ -269,19 +906,15 @@ def logout_by_polling_agent():
     if not success:
         return failure_response(session_token)
     
-    polling_agent = dao.get_polling_agent_by_session_token(session_token)
-
-    if not polling_agent or not polling_agent.verify_session_token(session_token):
-        return failure_response("Invalid session token")
-    
-    polling_agent.session_expiration = datetime.datetime.now()
+    success, polling_agent = dao.end_session(session_token)
 
-    db.session.commit()
+    if not success:
+        return failure_response("Invalid session token", 401)
 
     return success_response("Logout success", 201)
 
 
-@app.route("/secret/", methods = ["POST"])
+@api.route("/secret/", methods = ["POST"])
 def secret_message():
     """
     Endpoint to verifying session token and returning a secret message
@@ -290,20 +923,182 @@ def secret_message():
     if not success:
         return failure_response(session_token)
     
-    polling_agent = dao.get_polling_agent_by_session_token(session_token)
-    if not polling_agent or not polling_agent.verify_session_token(session_token):
-        return failure_response("Invalid session token")
+    success, polling_agent_id = dao.verify_session(session_token)
+    if not success:
+        return failure_response("Invalid session token", 401)
     
     return success_response("Session verified!", 201)
 
 
+
+################################################################
+#####################CLI COMMANDS###############################
+
+@api.cli.command("import-stations")
+@click.argument("path", default = "polling_stations.xlsx")
+def import_stations_command(path):
+    """
+    Upserts polling stations from an xlsx or csv roster and rebuilds the tallies
+    """
+    success, stats = import_polling_stations(path)
+    print(json.dumps(stats))
+
+    if not success:
+        sys.exit(1)
+
+    dao.rebuild_tallies()
+
+
+@api.cli.command("import-agents")
+@click.argument("path", default = "agents.xlsx")
+@click.option("--manifest", default = None, help = "Directory to write the QR codes and passwords of the created agents to")
+def import_agents_command(path, manifest):
+    """
+    Creates polling agents in bulk from an xlsx or csv roster
+    """
+    success, report = import_polling_agents(read_records(path))
+    print(json.dumps(report))
+
+    if not success:
+        sys.exit(1)
+
+    if manifest:
+        success, count = write_agent_manifest(report, manifest)
+        print(f"Wrote the QR codes of {count} polling agents to {manifest}", file = sys.stderr)
+
+
+@api.cli.command("create-collation-centre")
+@click.argument("name")
+@click.argument("region")
+@click.option("--constituency", default = None, help = "Limits the collation centre to one constituency of the region")
+def create_collation_centre_command(name, region, constituency):
+    """
+    Creates a collation centre and prints the key it submits batches with
+    """
+    success, value = dao.create_collation_centre(name, region, constituency)
+
+    if not success:
+        print(f"Collation centre {name} already exists")
+        sys.exit(1)
+
+    collation_centre, key = value
+    print(json.dumps(dict(collation_centre.serialize(), key = key)))
+
+
+@api.cli.command("import-candidates")
+@click.argument("path", default = "candidates.xlsx")
+def import_candidates_command(path):
+    """
+    Creates or updates candidates and their parties from an xlsx or csv file
+    with key, name, party and abbreviation columns
+    """
+    success, report = import_candidates(read_records(path))
+    print(json.dumps(report))
+
+    if not success:
+        sys.exit(1)
+
+
+@api.cli.command("migrate-hierarchy")
+def migrate_hierarchy_command():
+    """
+    Adds normalized regions, constituencies and hierarchy indexes to an existing database
+    """
+    migrate_station_hierarchy()
+    print("Migrated polling station hierarchy")
+
+
+@api.cli.command("migrate-registration")
+def migrate_registration_command():
+    """
+    Adds the registered voters count to the polling stations of an existing database
+    """
+    migrate_registered_voters()
+    print("Added registered voters, import a roster with a registered_voters column to fill it in")
+
+
+@api.cli.command("migrate-sequence")
+def migrate_sequence_command():
+    """
+    Adds the results sequence and timestamp to an existing database and numbers the results already in it
+    """
+    success, count = migrate_result_sequence()
+    print(f"Numbered {count} results")
+
+
+@api.cli.command("migrate-totp")
+def migrate_totp_command():
+    """
+    Adds the submission TOTP step to the polling agents of an existing database
+    """
+    migrate_totp_steps()
+    print("Added the submission TOTP step")
+
+
+@api.cli.command("migrate-candidates")
+def migrate_candidates_command():
+    """
+    Moves the votes of the cand1, cand2 and cand3 columns to the candidates tables
+    """
+    success, count = migrate_candidate_votes()
+    print(f"Moved the votes of {count} results")
+
+
+@api.cli.command("migrate-pinksheets")
+def migrate_pinksheets_command():
+    """
+    Moves pink sheets stored inline in results to the pink sheet store
+    """
+    success, count = migrate_pink_sheets()
+    print(f"Moved {count} pink sheets")
+
+
+@api.cli.command("rebuild-tallies")
+def rebuild_tallies_command():
+    """
+    Recomputes the constituency, region and national tallies from the raw results
+    """
+    success, count = dao.rebuild_tallies()
+    print(f"Rebuilt {count} tallies")
+
+
+@api.cli.command("check-tallies")
+def check_tallies_command():
+    """
+    Compares the stored tallies with the raw results, exiting non-zero on mismatch
+    """
+    consistent, mismatches = dao.check_tallies()
+
+    for mismatch in mismatches:
+        print(json.dumps(mismatch))
+
+    if not consistent:
+        sys.exit(1)
     
+    print("Tallies are consistent")
+
+
+@api.cli.command("reset-db")
+@click.confirmation_option(prompt = "Drop every table and all the data in them?")
+def reset_db_command():
+    """
+    Drops and recreates every table, for development
+    """
+    db.drop_all()
+    db.create_all()
+    dao.invalidate_results()
+    print("Reset the database")
+
 
 #endpoint to create an acc
 #endpoint to load excel into database
 #if the polling agent has to be replaced, we will do that
 # endpoint for admin creation and login 
-#TODO: endpoint to send results on regular intervals 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    # development server only, production runs wsgi:app under gunicorn.
+    # The reloader runs the server in a child process, which sends the SMS
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        twilioapp.start_workers()
+
+    create_app().run(host="0.0.0.0", port=8000, debug=True)
 
@@ -0,0 +1,354 @@
+"""
+Load test and benchmark harness for the collation API
+
+Seeds a database with the polling stations of an xlsx or csv roster and
+synthetic polling agents, then drives concurrent logins followed by result
+submissions mixed with results reads, and reports throughput and latency
+percentiles per endpoint. Requests go through the Flask test client, or to a
+running server with --url, which must use the database given with --database
+
+The database is reset first: a fresh SQLite file by default, or --database
+
+usage: python benchmark.py [--stations N] [--agents N] [--threads N] [--reads N]
+                           [--database URI] [--url http://host:port]
+                           [--output report.json] [--baseline report.json]
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import pyotp
+
+import dao
+from app import create_app
+from db import Polling_Agent
+from db import Polling_Station
+from db import db
+from hashing import BCRYPT_ROUNDS
+from histogram import percentile
+from importer import import_candidates
+from importer import import_polling_agents
+from importer import import_polling_stations
+from importer import read_records
+from totp import TOTP_INTERVAL
+from totp import decrypt_totp_key
+
+
+
+class TestClientTarget:
+    """
+    Sends requests to the app in process, one test client per thread
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body = None, headers = None):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+
+        response = self.local.client.open(path,
+                                          method = method,
+                                          data = json.dumps(body) if body is not None else None,
+                                          headers = headers or {})
+        return response.status_code, response.data
+
+
+class HttpTarget:
+    """
+    Sends requests to a running server
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, body = None, headers = None):
+        # without a json content type the body is parsed as a form and request.data is empty
+        headers = dict(headers or {}, **{"Content-Type" : "application/json"})
+        request = urllib.request.Request(self.url + path,
+                                         data = json.dumps(body).encode("utf8") if body is not None else None,
+                                         headers = headers,
+                                         method = method)
+        try:
+            with urllib.request.urlopen(request, timeout = 60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Recorder:
+    """
+    Collects the latency and status of every request, by endpoint
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def call(self, target, endpoint, method, path, body = None, headers = None):
+        start = time.perf_counter()
+        status, data = target.request(method, path, body, headers)
+        latency = (time.perf_counter() - start) * 1000
+
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+        return status, data
+
+    def phase(self, endpoints, seconds):
+        """
+        Records how long the phase the endpoints ran in took, for throughput
+        """
+        for endpoint in endpoints:
+            self.seconds[endpoint] = self.seconds.get(endpoint, 0) + seconds
+
+    def report(self):
+        res = {}
+
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            res[endpoint] = {
+                "requests" : len(latencies),
+                "errors" : self.errors.get(endpoint, 0),
+                "per_second" : round(len(latencies) / self.seconds[endpoint], 1) if self.seconds.get(endpoint) else None,
+                "mean_ms" : round(statistics.mean(latencies), 3),
+                "p50_ms" : round(percentile(latencies, 0.5), 3),
+                "p95_ms" : round(percentile(latencies, 0.95), 3),
+                "p99_ms" : round(percentile(latencies, 0.99), 3),
+                "max_ms" : round(latencies[-1], 3)
+            }
+
+        return res
+
+
+def run_concurrently(threads, calls):
+    """
+    Runs calls from a pool of threads and returns their results and the seconds it took
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        res = list(executor.map(lambda call: call(), calls))
+    return res, time.perf_counter() - start
+
+
+##### SEEDING #####
+def seed(app, roster, stations, agents):
+    """
+    Resets the database, imports the stations and onboards one synthetic agent
+    per station, returning the timings and the agents' credentials
+    """
+    timings = {}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        dao.invalidate_results()
+
+        # the candidates the synthetic results are for
+        import_candidates((line, {"key" : key}) for line, key in enumerate(("cand1", "cand2", "cand3"), start = 2))
+
+        # the first stations of the roster, through the csv importer
+        with tempfile.NamedTemporaryFile("w", suffix = ".csv", newline = "", delete = False) as subset:
+            rows = list(islice(read_records(roster), stations))
+            roster_writer = csv.DictWriter(subset, fieldnames = list(rows[0][1]))
+            roster_writer.writeheader()
+            roster_writer.writerows(record for line, record in rows)
+
+        start = time.perf_counter()
+        success, stats = import_polling_stations(subset.name)
+        dao.rebuild_tallies()
+        timings["import_stations"] = {"rows" : stats["imported"], "seconds" : round(time.perf_counter() - start, 3)}
+        os.remove(subset.name)
+
+        numbers = [number for number, in db.session.query(Polling_Station.number).order_by(Polling_Station.id).limit(agents)]
+        records = [(i + 2, {"name" : f"Agent {i}",
+                            "phone_number" : f"+233{i:09d}",
+                            "polling_station_number" : number,
+                            "password" : f"password-{i}"})
+                   for i, number in enumerate(numbers)]
+
+        start = time.perf_counter()
+        success, report = import_polling_agents(records)
+        timings["onboard_agents"] = {"rows" : report["created"], "seconds" : round(time.perf_counter() - start, 3)}
+        passwords = {record["name"] : record["password"] for line, record in records}
+
+        # TOTP keys reach real agents as QR codes, the harness reads them back
+        credentials = [{
+            "id" : polling_agent.id,
+            "name" : polling_agent.name,
+            "password" : passwords[polling_agent.name],
+            "polling_station_id" : polling_agent.polling_station_id,
+            "totp_key" : decrypt_totp_key(polling_agent.totp_key_encrypted)
+        } for polling_agent in Polling_Agent.query.order_by(Polling_Agent.id).all()]
+
+        constituencies = [name for name, in db.session.query(Polling_Station.constituency).distinct()]
+        regions = [name for name, in db.session.query(Polling_Station.region).distinct()]
+
+    return timings, credentials, constituencies, regions
+
+
+##### TRAFFIC #####
+def login(recorder, target, agent):
+    firstname, lastname = agent["name"].split(" ", 1)
+    body = {
+        "firstname" : firstname,
+        "lastname" : lastname,
+        "password" : agent["password"],
+        "totp_key" : agent["totp_key"],
+        "totp_value" : pyotp.TOTP(agent["totp_key"], interval= TOTP_INTERVAL).now()
+    }
+    status, data = recorder.call(target, "POST /pollingagentlogin/", "POST", "/pollingagentlogin/", body)
+
+    if status == 200:
+        agent["session_token"] = json.loads(data)["session_token"]
+
+
+def submit(recorder, target, agent, votes):
+    cand1, cand2, cand3, rejected = votes
+    body = {
+        "data" : {"cand1" : cand1, "cand2" : cand2, "cand3" : cand3},
+        "total_rejected_ballots" : rejected,
+        "total_valid_ballots" : cand1 + cand2 + cand3,
+        "total_votes_casts" : cand1 + cand2 + cand3 + rejected,
+        "pinksheet" : f"pinksheet-{agent['polling_station_id']}",
+        "auto_password" : pyotp.TOTP(agent["totp_key"], interval= TOTP_INTERVAL).now(),
+        "polling_station_id" : agent["polling_station_id"]
+    }
+    recorder.call(target, "POST /submitresult/", "POST", f"/submitresult/{agent['id']}/", body,
+                  {"Authorization" : "Bearer " + agent["session_token"]})
+
+
+def read_calls(recorder, target, reads, constituencies, regions, rng):
+    """
+    Returns reads calls, a weighted mix of what dashboards and mirrors request
+    """
+    reads_mix = [
+        (4, lambda: ("GET /sendallresults/?aggregate", "/sendallresults/?aggregate=true", None)),
+        (3, lambda: ("GET /sendconstituencyresults/?aggregate", "/sendconstituencyresults/?aggregate=true",
+                     {"constituency_name" : rng.choice(constituencies)})),
+        (2, lambda: ("GET /sendregionresults/?aggregate", "/sendregionresults/?aggregate=true",
+                     {"region_name" : rng.choice(regions)})),
+        (2, lambda: ("GET /sendconstituencyresults/", "/sendconstituencyresults/",
+                     {"constituency_name" : rng.choice(constituencies)})),
+        (2, lambda: ("GET /sendallresults/?since", f"/sendallresults/?since={rng.randint(0, 50)}&limit=100", None)),
+        (1, lambda: ("GET /sendallresults/?after", f"/sendallresults/?after={rng.randint(0, 1000)}&limit=500", None))
+    ]
+    weights = [weight for weight, make in reads_mix]
+    calls = []
+
+    for make in rng.choices([make for weight, make in reads_mix], weights = weights, k = reads):
+        endpoint, path, body = make()
+        calls.append(lambda endpoint = endpoint, path = path, body = body:
+                     recorder.call(target, endpoint, "GET", path, body))
+
+    return calls
+
+
+##### REPORT #####
+def print_report(report):
+    for name, timing in report["seeding"].items():
+        print(f"{name:<42} {timing['rows']:>7} rows in {timing['seconds']:8.3f} s")
+    print()
+
+    print(f"{'endpoint':<42} {'requests':>8} {'errors':>6} {'per s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"{endpoint:<42} {stats['requests']:>8} {stats['errors']:>6} {stats['per_second'] or 0:>8} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+
+def compare(report, baseline, tolerance):
+    """
+    Prints the p99 change of every endpoint against a baseline report and
+    returns the endpoints that got slower by more than tolerance
+    """
+    regressions = []
+    print()
+
+    for endpoint, stats in report["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            continue
+
+        change = (stats["p99_ms"] - before["p99_ms"]) / before["p99_ms"] if before["p99_ms"] else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(endpoint)
+            flag = "  REGRESSION"
+        print(f"{endpoint:<42} p99 {before['p99_ms']:9.2f} -> {stats['p99_ms']:9.2f} ms ({change:+.0%}){flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load test the collation API")
+    parser.add_argument("--roster", default = "polling_stations.xlsx", help = "polling stations to import")
+    parser.add_argument("--stations", type = int, default = 5000, help = "stations imported from the roster")
+    parser.add_argument("--agents", type = int, default = 200, help = "agents onboarded, one per station")
+    parser.add_argument("--threads", type = int, default = 16)
+    parser.add_argument("--reads", type = int, default = 2000, help = "reads mixed with the submissions")
+    parser.add_argument("--database", help = "database to reset and use, a fresh SQLite file by default")
+    parser.add_argument("--url", help = "send requests to this server instead of the test client")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", help = "write the report as json")
+    parser.add_argument("--baseline", help = "json report to compare p99 latencies with")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "p99 slowdown counted as a regression")
+    args = parser.parse_args()
+
+    database = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    app = create_app({"SQLALCHEMY_DATABASE_URI" : database})
+    target = HttpTarget(args.url) if args.url else TestClientTarget(app)
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+
+    print(f"{args.stations} stations, {args.agents} agents, {args.reads} reads from {args.threads} threads, "
+          f"bcrypt rounds = {BCRYPT_ROUNDS}, target {args.url or 'test client'}")
+    timings, agents, constituencies, regions = seed(app, args.roster, args.stations, args.agents)
+
+    results, seconds = run_concurrently(args.threads, [lambda agent = agent: login(recorder, target, agent) for agent in agents])
+    recorder.phase(["POST /pollingagentlogin/"], seconds)
+
+    calls = [lambda agent = agent, votes = (rng.randint(0, 400), rng.randint(0, 400), rng.randint(0, 50), rng.randint(0, 10)):
+             submit(recorder, target, agent, votes)
+             for agent in agents if "session_token" in agent]
+    calls += read_calls(recorder, target, args.reads, constituencies, regions, rng)
+    rng.shuffle(calls)
+
+    results, seconds = run_concurrently(args.threads, calls)
+    recorder.phase([endpoint for endpoint in recorder.latencies if endpoint != "POST /pollingagentlogin/"], seconds)
+
+    report = {
+        "config" : vars(args),
+        "seeding" : timings,
+        "endpoints" : recorder.report()
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(report, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmarks the TOTP part of a polling agent login
+
+Compares the old bcrypt check of the TOTP secret with the encrypted-at-rest
+check now used by Polling_Agent.verify_totp_key
+
+usage: python benchmark_login.py [iterations]
+"""
+
+import sys
+import time
+
+import bcrypt
+import pyotp
+
+from hashing import BCRYPT_ROUNDS
+from histogram import print_latencies
+from totp import TOTP_INTERVAL
+from totp import encrypt_totp_key
+from totp import gen_totp_key
+from totp import totp_keys_match
+
+
+
+def bcrypt_totp_check(totp_key, totp_key_digest, totp_value):
+    """
+    TOTP check as done before, bcrypt then pyotp
+    """
+    if not bcrypt.checkpw(totp_key.encode("utf8"), totp_key_digest):
+        return False
+    return pyotp.TOTP(totp_key, interval= TOTP_INTERVAL).verify(totp_value)
+
+
+def encrypted_totp_check(totp_key, totp_key_encrypted, totp_value):
+    """
+    TOTP check as done now, decrypt and compare then pyotp
+    """
+    if not totp_keys_match(totp_key, totp_key_encrypted):
+        return False
+    return pyotp.TOTP(totp_key, interval= TOTP_INTERVAL).verify(totp_value)
+
+
+def time_check(check, iterations, *args):
+    """
+    Returns the latencies of running check iterations times, in milliseconds
+    """
+    acc = []
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        check(*args)
+        acc.append((time.perf_counter() - start) * 1000)
+
+    return acc
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    totp_key = gen_totp_key()
+    totp_value = pyotp.TOTP(totp_key, interval= TOTP_INTERVAL).now()
+    totp_key_digest = bcrypt.hashpw(totp_key.encode("utf8"), bcrypt.gensalt(rounds = BCRYPT_ROUNDS))
+    totp_key_encrypted = encrypt_totp_key(totp_key)
+
+    print(f"{iterations} TOTP checks, bcrypt rounds = {BCRYPT_ROUNDS}")
+    print_latencies("bcrypt", time_check(bcrypt_totp_check, iterations, totp_key, totp_key_digest, totp_value))
+    print_latencies("encrypted", time_check(encrypted_totp_check, iterations, totp_key, totp_key_encrypted, totp_value))
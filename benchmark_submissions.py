@@ -0,0 +1,128 @@
+"""
+Benchmarks a close-of-polls burst of result submissions
+
+Every polling agent of a fresh SQLite database submits its result at once
+from a pool of threads, first through the writer queue and then with each
+request committing on its own
+
+usage: python benchmark_submissions.py [stations] [threads]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyotp
+
+import dao
+from app import create_app
+from db import Polling_Agent
+from db import Polling_Station
+from db import db
+from hashing import hash_secrets
+from histogram import print_latencies
+from importer import sync_station_hierarchy
+from totp import TOTP_INTERVAL
+from totp import gen_totp_key
+
+
+
+def setup(app, stations):
+    """
+    Creates stations with one polling agent each and returns what they submit with
+    """
+    acc = []
+
+    with app.app_context():
+        for key in ("cand1", "cand2", "cand3"):
+            dao.create_candidate(key)
+
+        for i in range(stations):
+            db.session.add(Polling_Station(name = f"station {i}",
+                                           number = str(i),
+                                           constituency = f"constituency {i % 50}",
+                                           region = f"region {i % 5}"))
+        db.session.commit()
+        sync_station_hierarchy()
+
+        # password digests are unique, cheap rounds keep setup fast
+        password_digests = hash_secrets(*[f"password {i}" for i in range(stations)], rounds = 4)
+
+        for polling_station, password_digest in zip(Polling_Station.query.all(), password_digests):
+            totp_key = gen_totp_key()
+            polling_agent = Polling_Agent(name = f"agent {polling_station.id}",
+                                          phone_number = str(polling_station.id),
+                                          password_digest = password_digest,
+                                          polling_station_id = polling_station.id,
+                                          totp_key = totp_key)
+            db.session.add(polling_agent)
+            acc.append((polling_agent, totp_key))
+        db.session.commit()
+
+        acc = [(polling_agent.id, polling_agent.polling_station_id, polling_agent.session_token, totp_key)
+               for polling_agent, totp_key in acc]
+        dao.rebuild_tallies()
+
+    return acc
+
+
+def submit(app, polling_agent_id, polling_station_id, session_token, totp_key):
+    """
+    Submits a result and returns the status code and latency in milliseconds
+    """
+    body = {
+        "data" : {"cand1" : 120, "cand2" : 80, "cand3" : 5},
+        "total_rejected_ballots" : 3,
+        "total_votes_casts" : 208,
+        "total_valid_ballots" : 205,
+        "pinksheet" : f"pinksheet-{polling_station_id}",
+        "auto_password" : pyotp.TOTP(totp_key, interval= TOTP_INTERVAL).now(),
+        "polling_station_id" : polling_station_id
+    }
+
+    start = time.perf_counter()
+    response = app.test_client().post(f"/submitresult/{polling_agent_id}/",
+                                      data = json.dumps(body),
+                                      headers = {"Authorization" : "Bearer " + session_token})
+    return response.status_code, (time.perf_counter() - start) * 1000
+
+
+def burst(write_queue, stations, threads):
+    """
+    Runs one burst against a fresh database and prints its latencies
+    """
+    path = os.path.join(tempfile.mkdtemp(), "burst.db")
+    app = create_app({"SQLALCHEMY_DATABASE_URI" : f"sqlite:///{path}", "DB_WRITE_QUEUE" : write_queue})
+    agents = setup(app, stations)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        outcomes = list(executor.map(lambda agent: submit(app, *agent), agents))
+    elapsed = time.perf_counter() - start
+
+    codes = {}
+    for code, latency in outcomes:
+        codes[code] = codes.get(code, 0) + 1
+
+    name = "queued" if write_queue else "direct"
+    print(f"{name}: {len(agents) / elapsed:.0f} submissions/s, status codes {codes}")
+    print_latencies(name, [latency for code, latency in outcomes])
+
+    with app.app_context():
+        writes = app.extensions["writer"].metrics()
+
+    if write_queue:
+        print(f"{'':<12} batch size mean {writes['batch_size']['mean']:.1f}, "
+              f"queue wait p99 <= {writes['queue_wait_ms']['p99']} ms, commit p99 <= {writes['commit_ms']['p99']} ms")
+
+
+if __name__ == "__main__":
+    stations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+    print(f"{stations} submissions from {threads} threads")
+    burst(True, stations, threads)
+    burst(False, stations, threads)
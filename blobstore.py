@@ -0,0 +1,120 @@
+"""
+Blob store file
+
+Content-addressed files on disk, stored once under the sha256 digest of
+their bytes, so identical uploads are deduplicated and a stored file never
+changes
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+
+CHUNK_SIZE = 64 * 1024
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    """
+    Blobs under root, in a directory per first two digest characters
+    """
+
+    def __init__(self, root, suffix = ""):
+        self.root = root
+        self.suffix = suffix
+
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + self.suffix)
+
+
+    def exists(self, digest):
+        return bool(DIGEST_PATTERN.fullmatch(digest or "")) and os.path.exists(self.path(digest))
+
+
+    def _commit(self, tmp_path, digest):
+        """
+        Moves a fully written temporary file to its digest, unless it is stored already
+        """
+        path = self.path(digest)
+
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        os.replace(tmp_path, path)
+
+
+    def _tmp_file(self):
+        os.makedirs(self.root, exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = self.root, prefix = f".{os.getpid()}.{threading.get_ident()}.", suffix = ".tmp")
+        return os.fdopen(fd, "wb"), tmp_path
+
+
+    def store(self, blob):
+        """
+        Stores blob, once, and returns its digest
+        """
+        digest = hashlib.sha256(blob).hexdigest()
+        self.store_as(digest, blob)
+        return digest
+
+
+    def store_as(self, digest, blob):
+        """
+        Stores blob under the digest of what it was derived from, e.g. a thumbnail
+        """
+        if not os.path.exists(self.path(digest)):
+            # write then rename so readers never see a partial file
+            tmp_file, tmp_path = self._tmp_file()
+            with tmp_file:
+                tmp_file.write(blob)
+            self._commit(tmp_path, digest)
+
+
+    def store_stream(self, stream, max_size = None, head = b""):
+        """
+        Stores head followed by what is read from stream, in chunks, and returns
+        its digest and size
+
+        Raises BlobTooLarge once more than max_size bytes were read
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        tmp_file, tmp_path = self._tmp_file()
+
+        try:
+            with tmp_file:
+                chunk = head or stream.read(CHUNK_SIZE)
+                while chunk:
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge()
+
+                    sha256.update(chunk)
+                    tmp_file.write(chunk)
+                    chunk = stream.read(CHUNK_SIZE)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        digest = sha256.hexdigest()
+        self._commit(tmp_path, digest)
+        return digest, size
+
+
+    def read(self, digest):
+        """
+        Returns the stored blob with the given digest
+        """
+        with open(self.path(digest), "rb") as blob_file:
+            return blob_file.read()
@@ -0,0 +1,82 @@
+"""
+Cache file
+
+Bounded in-process cache with least recently used eviction and a time to live
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache whose entries expire ttl seconds after being set
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default = None):
+        """
+        Returns the value cached for key, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def set(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entry when full
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+
+
+    def pop(self, key):
+        """
+        Removes key from the cache
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def metrics(self):
+        """
+        Returns the cache size and hit/miss counters
+        """
+        with self._lock:
+            res = {
+                "size" : len(self._entries),
+                "maxsize" : self.maxsize,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses
+            }
+        return res
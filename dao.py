@@ -4,51 +4,68 @@ DAO (Data Access Object) file
 Helper file containing functions for accessing data in our database
 """
 
+from db import Candidate
+from db import Collation_Centre
+from db import Party
 from db import Polling_Agent
 from db import Polling_Station
 from db import Polling_Station_Result
+from db import Polling_Station_Vote
+from db import Revoked_Session
+from db import Sequence
+from db import Tally
+from db import Tally_Vote
+from db import NATIONAL_TALLY_NAME
+from db import TALLY_FIELDS
 from db import db
-from twilioapp import sendmessage
-
+from sqlalchemy import exc
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import update
+from sqlalchemy.orm import joinedload
+
+import datetime
+import feed
 import os
+from cache import LRUCache
 from dotenv import load_dotenv
 load_dotenv()
-import pyotp
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
-
-
-
-def gen_totp_key():
-    return pyotp.random_base32()
-
-def gen_totp_uri(key, polling_agent_name):
-    return pyotp.totp.TOTP(key, interval= 15).provisioning_uri(name=polling_agent_name, issuer_name="Collation App")
-
-def gen_qrcode(data, content, name, id):
-    qr = qrcode.QRCode(
-        version=1,  
-        error_correction=qrcode.constants.ERROR_CORRECT_L,  
-        box_size=10,  
-        border=4,    
-    )
-
-
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    title = f"{content}-{name}-{id}"
-    font = ImageFont.load_default()
-    draw = ImageDraw.Draw(img)
-    text_width = text_height = font.getlength(title)
-    x = (img.size[0] - text_width) // 2
-    y = img.size[1]//25  
-    draw.text((x, y), title, font=font, fill="black")
-
-    img.save(f"{title}.png")
-
+import pinksheets
+import provisioning
+import secrets
+import time
+import writer
+from tokens import read_session_token
+from tokens import signed_tokens_enabled
+from tokens import token_digest
+from totp import decrypt_totp_key
+from totp import gen_totp_key
+
+RESULTS_PAGE_SIZE = 500
+FEED_BATCH_SIZE = 200
+MAX_RESULTS_PAGE_SIZE = 5000
+
+# session token -> (polling agent id, session expiration). Entries live for a
+# short ttl since another worker's logout only reaches this cache through the db
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", 30))
+session_cache = LRUCache(maxsize = SESSION_CACHE_SIZE, ttl = SESSION_CACHE_TTL)
+
+# (scope, name) -> {variant : (etag, encoded json)} for the results endpoints.
+# Commits invalidate this worker's entries, the ttl bounds staleness in the others
+RESULTS_CACHE_SIZE = int(os.environ.get("RESULTS_CACHE_SIZE", 2000))
+RESULTS_CACHE_TTL = int(os.environ.get("RESULTS_CACHE_TTL", 5))
+results_cache = LRUCache(maxsize = RESULTS_CACHE_SIZE, ttl = RESULTS_CACHE_TTL)
+
+# signed tokens revoked before expiring, reloaded from the db every few seconds
+REVOCATION_REFRESH_SECONDS = int(os.environ.get("REVOCATION_REFRESH_SECONDS", 5))
+_revoked = {"digests" : set(), "loaded_at" : 0.0}
+
+# candidate key -> id, reloaded when a result names a candidate not in it
+_candidates = {"ids" : {}}
 
 
 def get_polling_agent_by_id(id):
@@ -83,6 +100,9 @@ def renew_session(polling_agent):
     """
     Renews session
     """
+    session_cache.pop(polling_agent.session_token)
+    if signed_tokens_enabled():
+        revoke_session_token(polling_agent.session_token)
 
     polling_agent.renew_session()
     db.session.commit()
@@ -90,6 +110,85 @@ def renew_session(polling_agent):
     return polling_agent
 
 
+def _is_revoked(session_token):
+    """
+    Returns true if a signed session token was revoked
+    """
+    if time.monotonic() - _revoked["loaded_at"] > REVOCATION_REFRESH_SECONDS:
+        _revoked["digests"] = {digest for digest, in db.session.query(Revoked_Session.token_digest).filter(
+            Revoked_Session.expires_at > datetime.datetime.now()
+        ).all()}
+        _revoked["loaded_at"] = time.monotonic()
+
+    return token_digest(session_token) in _revoked["digests"]
+
+
+def revoke_session_token(session_token):
+    """
+    Revokes a signed session token until it expires, does not commit
+    """
+    valid, claims = read_session_token(session_token)
+
+    if not valid:
+        return False
+
+    digest = token_digest(session_token)
+    Revoked_Session.query.filter(Revoked_Session.expires_at <= datetime.datetime.now()).delete()
+    db.session.merge(Revoked_Session(token_digest = digest, expires_at = claims["session_expiration"]))
+    _revoked["digests"].add(digest)
+
+    return True
+
+
+def verify_session(session_token):
+    """
+    Returns whether a session token is valid and the id of its polling agent
+
+    Signed tokens are checked by signature, opaque ones are cached so most
+    authenticated requests skip the database
+    """
+    if signed_tokens_enabled():
+        valid, claims = read_session_token(session_token)
+
+        if claims is None:
+            return False, None
+
+        return valid and not _is_revoked(session_token), claims["polling_agent_id"]
+
+    session = session_cache.get(session_token)
+
+    if session is None:
+        polling_agent = get_polling_agent_by_session_token(session_token)
+
+        if polling_agent is None:
+            return False, None
+
+        session = (polling_agent.id, polling_agent.session_expiration)
+        session_cache.set(session_token, session)
+
+    polling_agent_id, session_expiration = session
+    return datetime.datetime.now() < session_expiration, polling_agent_id
+
+
+def end_session(session_token):
+    """
+    Expires the session of the polling agent with session_token
+    """
+    session_cache.pop(session_token)
+    polling_agent = get_polling_agent_by_session_token(session_token)
+
+    if not polling_agent or not polling_agent.verify_session_token(session_token):
+        return False, polling_agent
+    
+    if signed_tokens_enabled():
+        revoke_session_token(session_token)
+
+    polling_agent.session_expiration = datetime.datetime.now()
+    db.session.commit()
+
+    return True, polling_agent
+
+
 ##### CREATE  ####
 
 def create_polling_agent(name, phone_number, password, polling_station_id):    
@@ -108,21 +207,42 @@ def create_polling_agent(name, phone_number, password, polling_station_id):
     
     if not polling_agent:
         return False, polling_agent
-    
-    gen_qrcode(gen_totp_uri(totp_key, polling_agent.name), "uri", polling_agent.name, polling_station_id)
-    gen_qrcode(totp_key, "key", polling_agent.name, polling_station_id)
 
     db.session.add(polling_agent)
     db.session.commit()
 
+    # signed session tokens embed the polling agent id, known only now
+    if signed_tokens_enabled():
+        renew_session(polling_agent)
 
+    # station listings include the polling agent
+    invalidate_results(Polling_Station.query.filter(Polling_Station.id == polling_station_id).first())
 
+    # QR codes are rendered in the background, see get_polling_agent_qrcode
+    provisioning.provision_polling_agent(polling_agent.id, polling_agent.name, totp_key, polling_station_id)
 
     return True, polling_agent
+
+
+def get_polling_agent_qrcode(polling_agent, kind):
+    """
+    Returns the uri or key QR code of a polling agent as png bytes
+    """
+    return provisioning.get_qrcode(polling_agent.id,
+                                   kind,
+                                   polling_agent.name,
+                                   decrypt_totp_key(polling_agent.totp_key_encrypted),
+                                   polling_agent.polling_station_id)
     
 
     
-# TODO: work on this
+def is_count(value):
+    """
+    Returns True if value is a ballot or vote count, a non-negative int
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
 def create_polling_station_result(data,
                                   total_votes_cast, 
                                   total_rejected_ballots,
@@ -133,48 +253,401 @@ def create_polling_station_result(data,
                                   auto_password):
     """
     Creates a Polling Station Result 
+
+    The result is added to its constituency, region and national tallies
+    in the same transaction as the insert, committed by the writer
     """
-    #TODO: if not verified, verify with totp_key before submission
-    #TODO: check if polling agent sending to right station
-    verified, polling_agent = verify_totp_key(totp_key, polling_agent_id)
+    success, pink_sheet = pinksheets.resolve(pink_sheet)
 
-    if not verified:
-        return False, polling_agent
-    
+    if not success:
+        return False, None
 
-    if not polling_agent.is_verified:
-        polling_agent.is_verified = True
-    
-    polling_station = get_polling_station(name, number, constituency, region)
+    try:
+        success, polling_station_result_id = writer.run(_insert_polling_station_result,
+                                                        data,
+                                                        total_votes_cast,
+                                                        total_rejected_ballots,
+                                                        total_valid_ballots,
+                                                        pink_sheet,
+                                                        polling_agent_id,
+                                                        polling_station_id,
+                                                        auto_password)
+    except exc.IntegrityError:
+        return False, None
 
-    if not polling_station:
-        return False, polling_station
+    # the id is why the result was rejected then, if it is known
+    if not success:
+        return False, polling_station_result_id
+
+    polling_station_result = db.session.get(Polling_Station_Result, polling_station_result_id)
+    polling_station = db.session.get(Polling_Station, polling_station_id)
+
+    invalidate_results(polling_station)
+    feed.publish(polling_station_result.seq)
+
+    return True, polling_station_result
+
+
+def _insert_polling_station_result(data,
+                                   total_votes_cast,
+                                   total_rejected_ballots,
+                                   total_valid_ballots,
+                                   pink_sheet,
+                                   polling_agent_id,
+                                   polling_station_id,
+                                   auto_password):
+    """
+    Writer job inserting a polling station result, returns its id or, for
+    a rejected TOTP code, why
+
+    Every check runs before the TOTP step is claimed, the first write
+    """
+    success, polling_agent = get_polling_agent_by_id(polling_agent_id)
+
+    if not success:
+        return False, None
+    
+    # polling agent can only submit for the station they are assigned to
+    if polling_agent.polling_station_id != polling_station_id:
+        return False, None
     
-    polling_agent = polling_station.polling_agent
+    exists, polling_station_result = get_polling_station_result_by_polling_station_id(polling_station_id)
 
-    if polling_agent.id != polling_agent_id:
-        return False, polling_agent
+    if exists:
+        return False, None
     
-    if polling_station.polling_station_result is not None and polling_agent.polling_station_result is not None:
-        return False, polling_station.polling_station_result
+    polling_station = Polling_Station.query.filter(Polling_Station.id == polling_station_id).first()
+
+    if polling_station is None:
+        return False, None
+
+    success, candidate_votes = get_candidate_votes(polling_station.id, data)
+
+    if not success:
+        return False, None
+
+    # auto_password is the current TOTP code of the polling agent, and may
+    # be the one they just logged in with
+    success, error = polling_agent.verify_totp(auto_password, purpose = "submit")
+
+    if not success:
+        return False, error
+
+    if not polling_agent.is_verified:
+        polling_agent.is_verified = True
     
     polling_station_result = Polling_Station_Result(
-        total_votes_cast = total_votes,
-        total_valid_ballots = valid_ballots,
-        total_rejected_ballots = rejected_ballots,
+        total_votes_cast = total_votes_cast,
+        total_valid_ballots = total_valid_ballots,
+        total_rejected_ballots = total_rejected_ballots,
         pink_sheet = pink_sheet,
-        votes = votes,
+        candidate_votes = candidate_votes,
         polling_station_id = polling_station.id,
         polling_agent_id = polling_agent.id,
     )
 
-    if not polling_station_result:
-        return False, polling_station_result
-
     db.session.add(polling_station_result)
+    add_result_to_tallies(polling_station_result, polling_station)
+    polling_station_result.seq = next_sequence("results")
+    db.session.flush()
+
+    return True, polling_station_result.id
+
+
+def create_polling_station_results(submissions, collation_centre):
+    """
+    Creates a batch of Polling Station Results in one transaction
+
+    Each submission is a dict of create_polling_station_result's arguments
+    but auto_password, the collation centre key stands in for the TOTP codes
+    and only stations in its area are accepted. Returns a (created, polling
+    station result or error message) pair per submission, in order. Rejected
+    submissions do not stop the others
+    """
+    acc = [None] * len(submissions)
+    accepted = []
+
+    for i, submission in enumerate(submissions):
+        success, pink_sheet = pinksheets.resolve(submission.get("pink_sheet"))
+
+        if not success:
+            acc[i] = (False, "Pink sheet not uploaded")
+        else:
+            accepted.append((i, dict(submission, pink_sheet = pink_sheet)))
+
+    submissions = [submission for i, submission in accepted]
+
+    try:
+        outcomes = writer.run(_insert_polling_station_results, submissions, collation_centre.id)
+    except exc.IntegrityError:
+        # lost a race with a concurrent submission, a second pass sees its row
+        try:
+            outcomes = writer.run(_insert_polling_station_results, submissions, collation_centre.id)
+        except exc.IntegrityError:
+            outcomes = [(False, "Couldn't create result")] * len(submissions)
+
+    ids = [value for success, value in outcomes if success]
+    if not ids:
+        polling_station_results = {}
+    else:
+        polling_station_results = {
+            polling_station_result.id : polling_station_result
+            for polling_station_result in Polling_Station_Result.query.filter(Polling_Station_Result.id.in_(ids)).all()
+        }
+
+    for (i, submission), (success, value) in zip(accepted, outcomes):
+        acc[i] = (True, polling_station_results[value]) if success else (False, value)
+
+    if polling_station_results:
+        polling_station_ids = {result.polling_station_id for result in polling_station_results.values()}
+        for polling_station in Polling_Station.query.filter(Polling_Station.id.in_(polling_station_ids)).all():
+            invalidate_results(polling_station)
+        feed.publish(max(result.seq for result in polling_station_results.values()))
+
+    return acc
+
+
+def _insert_polling_station_results(submissions, collation_centre_id):
+    """
+    Writer job inserting a batch of polling station results
+
+    Agents, stations and existing results are loaded with one query each, and
+    tallies and the ingest sequence are updated once for the whole batch.
+    Returns a (created, id or error message) pair per submission
+    """
+    collation_centre = db.session.get(Collation_Centre, collation_centre_id)
+    polling_agent_ids = {submission.get("polling_agent_id") for submission in submissions}
+    polling_station_ids = {submission.get("polling_station_id") for submission in submissions}
+    pink_sheets = {submission.get("pink_sheet") for submission in submissions}
+
+    polling_agents = {
+        polling_agent.id : polling_agent
+        for polling_agent in Polling_Agent.query.filter(Polling_Agent.id.in_(polling_agent_ids)).all()
+    }
+    polling_stations = {
+        polling_station.id : polling_station
+        for polling_station in Polling_Station.query.filter(Polling_Station.id.in_(polling_station_ids)).all()
+    }
+
+    submitted = db.session.execute(
+        select(Polling_Station_Result.polling_agent_id,
+               Polling_Station_Result.polling_station_id,
+               Polling_Station_Result.pink_sheet).where(
+            db.or_(Polling_Station_Result.polling_agent_id.in_(polling_agent_ids),
+                   Polling_Station_Result.polling_station_id.in_(polling_station_ids),
+                   Polling_Station_Result.pink_sheet.in_(pink_sheets))
+        )
+    ).all()
+    submitted_agents = {row.polling_agent_id for row in submitted}
+    submitted_stations = {row.polling_station_id for row in submitted}
+    submitted_pink_sheets = {row.pink_sheet for row in submitted}
+
+    acc = []
+    created = []
+
+    for submission in submissions:
+        polling_agent = polling_agents.get(submission.get("polling_agent_id"))
+        polling_station = polling_stations.get(submission.get("polling_station_id"))
+
+        if polling_agent is None:
+            acc.append((False, "Polling agent does not exists"))
+            continue
+
+        # polling agent can only submit for the station they are assigned to
+        if polling_agent.polling_station_id != submission.get("polling_station_id"):
+            acc.append((False, "Polling agent is not assigned to this polling station"))
+            continue
+
+        if polling_station is None:
+            acc.append((False, "Polling station does not exists"))
+            continue
+
+        if not collation_centre.covers(polling_station):
+            acc.append((False, "Polling station is not in the area of this collation centre"))
+            continue
+
+        # earlier submissions of the batch count as submitted
+        if polling_agent.id in submitted_agents or polling_station.id in submitted_stations:
+            acc.append((False, "Result already submitted"))
+            continue
+
+        if submission.get("pink_sheet") in submitted_pink_sheets:
+            acc.append((False, "Pink sheet already submitted"))
+            continue
+
+        success, candidate_votes = get_candidate_votes(polling_station.id, submission.get("data"))
+
+        if not success:
+            acc.append((False, candidate_votes))
+            continue
+
+        polling_station_result = Polling_Station_Result(
+            total_votes_cast = submission.get("total_votes_cast"),
+            total_valid_ballots = submission.get("total_valid_ballots"),
+            total_rejected_ballots = submission.get("total_rejected_ballots"),
+            pink_sheet = submission.get("pink_sheet"),
+            candidate_votes = candidate_votes,
+            polling_station_id = polling_station.id,
+            polling_agent_id = polling_agent.id,
+        )
+
+        db.session.add(polling_station_result)
+        submitted_agents.add(polling_agent.id)
+        submitted_stations.add(polling_station.id)
+        submitted_pink_sheets.add(polling_station_result.pink_sheet)
+
+        acc.append((True, polling_station_result))
+        created.append((polling_station_result, polling_station))
+
+    if created:
+        add_results_to_tallies(created)
+
+        # the batch gets consecutive values, in submission order
+        last_seq = next_sequence("results", len(created))
+        for seq, (polling_station_result, polling_station) in enumerate(created, last_seq - len(created) + 1):
+            polling_station_result.seq = seq
+
+        db.session.flush()
+
+    return [(success, value.id if success else value) for success, value in acc]
+
+
+def get_resubmitted_result(polling_agent_id,
+                           polling_station_id,
+                           data,
+                           total_votes_cast,
+                           total_rejected_ballots,
+                           total_valid_ballots):
+    """
+    Returns the result a polling agent already submitted for a polling
+    station, if it has the given counts
+    """
+    exists, polling_station_result = get_polling_station_result_by_polling_station_id(polling_station_id)
+
+    if not exists or polling_station_result.polling_agent_id != polling_agent_id:
+        return False, None
+
+    submitted = (
+        polling_station_result.serialize()["data"],
+        polling_station_result.total_votes_cast,
+        polling_station_result.total_rejected_ballots,
+        polling_station_result.total_valid_ballots
+    )
+    resubmitted = (
+        data,
+        total_votes_cast,
+        total_rejected_ballots,
+        total_valid_ballots
+    )
+
+    return submitted == resubmitted, polling_station_result
+
+
+##### COLLATION CENTRES #####
+def create_collation_centre(name, region, constituency = None):
+    """
+    Creates a collation centre and returns it with its key
+
+    Only the digest of the key is stored, so it is shown this once
+    """
+    if Collation_Centre.query.filter(Collation_Centre.name == name).first() is not None:
+        return False, None
+
+    key = secrets.token_urlsafe(32)
+    collation_centre = Collation_Centre(name = name,
+                                        region = region,
+                                        constituency = constituency,
+                                        key_digest = token_digest(key))
+    db.session.add(collation_centre)
     db.session.commit()
+    return True, (collation_centre, key)
 
-    return True, polling_station_result
+
+def verify_collation_centre_key(key):
+    """
+    Returns whether a collation centre key is valid and its collation centre
+    """
+    collation_centre = Collation_Centre.query.filter(Collation_Centre.key_digest == token_digest(key)).first()
+    return collation_centre is not None, collation_centre
+
+
+##### CANDIDATES #####
+def get_candidates():
+    """
+    Returns every candidate, in ballot order
+    """
+    return True, Candidate.query.order_by(Candidate.id).all()
+
+
+def get_candidate_ids(keys):
+    """
+    Returns whether every candidate key is known and a key -> id dict
+    """
+    candidate_ids = _candidates["ids"]
+
+    if not set(keys) <= candidate_ids.keys():
+        # candidates imported since the last load
+        candidate_ids = dict(db.session.execute(select(Candidate.key, Candidate.id)).all())
+        _candidates["ids"] = candidate_ids
+
+    return set(keys) <= candidate_ids.keys(), candidate_ids
+
+
+def get_candidate_votes(polling_station_id, data):
+    """
+    Returns the polling station vote rows for the data of a result, keyed by
+    candidate key, or false and why if it names an unknown candidate or a
+    vote is not a count
+    """
+    if not isinstance(data, dict):
+        return False, "Invalid votes"
+
+    if not all(is_count(votes) for votes in data.values()):
+        return False, "Invalid votes"
+
+    success, candidate_ids = get_candidate_ids(data)
+
+    if not success:
+        return False, "Unknown candidate"
+
+    acc = [
+        Polling_Station_Vote(polling_station_id = polling_station_id, candidate_id = candidate_ids[key], votes = votes)
+        for key, votes in data.items()
+    ]
+    return True, acc
+
+
+def create_candidate(key, name = None, party_name = None, abbreviation = None):
+    """
+    Creates a candidate, and their party if it is new, or updates the
+    candidate with the same key
+    """
+    party = None
+
+    if party_name:
+        party = Party.query.filter(Party.name == party_name).first()
+
+        if party is None:
+            party = Party(name = party_name, abbreviation = abbreviation)
+            db.session.add(party)
+            db.session.flush()
+        elif abbreviation:
+            party.abbreviation = abbreviation
+
+    candidate = Candidate.query.filter(Candidate.key == key).first()
+
+    if candidate is None:
+        candidate = Candidate(key = key, name = name, party_id = party.id if party else None)
+        db.session.add(candidate)
+    else:
+        candidate.name = name or candidate.name
+        candidate.party_id = party.id if party else candidate.party_id
+
+    db.session.commit()
+
+    # ids may have changed if the tables were reset
+    _candidates["ids"] = {}
+    return True, candidate
 
 
 def get_polling_station(name, number, constituency, region):
@@ -226,14 +699,31 @@ def get_polling_station_result_by_polling_station_id(polling_station_id):
 
 
 
+def _station_query(eager_load = True):
+    """
+    Returns a polling station query, eager loading what Polling_Station.serialize touches
+
+    Results and agents are unique per station, so the joins never multiply
+    rows and a whole listing is fetched with a single SELECT instead of
+    up to three lazy loads per station
+    """
+    if not eager_load:
+        return Polling_Station.query
+
+    return Polling_Station.query.options(
+        joinedload(Polling_Station.polling_station_results),
+        joinedload(Polling_Station.polling_agent).joinedload(Polling_Agent.polling_station_result)
+    )
+
+
 ##### GET CONSTITUENCY #####
 # 1
-def get_result_by_constituency(name):
+def get_result_by_constituency(name, eager_load = True):
     """
     Returns constituency results by name
     """
     
-    polling_stations = Polling_Station.query.filter(Polling_Station.constituency == name).all()
+    polling_stations = _station_query(eager_load).filter(Polling_Station.constituency == name).all()
 
     if polling_stations is None:
         return False, polling_stations
@@ -246,11 +736,11 @@ def get_result_by_constituency(name):
     return True, acc
 
 # 2
-def get_all_results():
+def get_all_results(eager_load = True):
     """
     Returns all results 
     """
-    polling_stations = Polling_Station.query.all()
+    polling_stations = _station_query(eager_load).all()
 
     if polling_stations is None:
         return False, polling_stations
@@ -263,13 +753,95 @@ def get_all_results():
     return True, acc
 
 
+def get_results_page(after = 0, limit = RESULTS_PAGE_SIZE):
+    """
+    Returns up to limit results for polling stations with an id greater than after
+
+    next_after is the cursor for the following page, or None on the last page
+    """
+    polling_stations = _station_query().filter(
+        Polling_Station.id > after
+    ).order_by(Polling_Station.id).limit(limit).all()
+
+    res = {
+        "results" : [polling_station.serialize() for polling_station in polling_stations],
+        "next_after" : polling_stations[-1].id if len(polling_stations) == limit else None
+    }
+    return True, res
+
+
+def iter_all_results(page_size = RESULTS_PAGE_SIZE):
+    """
+    Yields every serialized polling station, one keyset page at a time
+
+    Only a single page of stations is held in memory at once
+    """
+    after = 0
+
+    while True:
+        polling_stations = _station_query().filter(
+            Polling_Station.id > after
+        ).order_by(Polling_Station.id).limit(page_size).all()
+
+        for polling_station in polling_stations:
+            yield polling_station.serialize()
+
+        if len(polling_stations) < page_size:
+            return
+
+        after = polling_stations[-1].id
+
+
+def get_results_since(since = 0, since_time = None, scope = "national", name = NATIONAL_TALLY_NAME, limit = RESULTS_PAGE_SIZE):
+    """
+    Returns the polling stations of a scope whose results were committed after
+    the ingest sequence number since, and after since_time if it is given
+
+    Stations come in sequence order with last_seq as the cursor for the next
+    call, has_more tells whether the limit cut the delta short. The current
+    aggregate of the scope is included whenever anything changed
+    """
+    query = _station_query().join(
+        Polling_Station_Result, Polling_Station_Result.polling_station_id == Polling_Station.id
+    ).filter(Polling_Station_Result.seq > since)
+
+    if since_time is not None:
+        query = query.filter(Polling_Station_Result.created_at > since_time)
+    
+    if scope == "constituency":
+        query = query.filter(Polling_Station.constituency == name)
+    elif scope == "region":
+        query = query.filter(Polling_Station.region == name)
+
+    polling_stations = query.order_by(Polling_Station_Result.seq).limit(limit).all()
+
+    res = {
+        "since" : since,
+        "last_seq" : since,
+        "has_more" : len(polling_stations) == limit,
+        "results" : [polling_station.serialize() for polling_station in polling_stations],
+        "aggregate" : None
+    }
+
+    if polling_stations:
+        res["last_seq"] = max(result.seq for result in polling_stations[-1].polling_station_results)
+
+        get_aggregate = {
+            "constituency" : get_tally_by_constituency,
+            "region" : get_tally_by_region
+        }.get(scope)
+        success, res["aggregate"] = get_aggregate(name) if get_aggregate else get_national_tally()
+
+    return True, res
+
+
 ##### GET REGION #####
 # 3
-def get_result_by_region(name):
+def get_result_by_region(name, eager_load = True):
     """
     Returns results by region
     """
-    polling_stations = Polling_Station.query.filter(Polling_Station.region == name).all()
+    polling_stations = _station_query(eager_load).filter(Polling_Station.region == name).all()
 
     if polling_stations is None:
         return False, polling_stations
@@ -282,17 +854,444 @@ def get_result_by_region(name):
     return True, acc
 
 
+##### RESULTS CACHE #####
+def get_cached_results(scope, name, variant):
+    """
+    Returns a cached (etag, encoded json) results response, or None
+    """
+    return results_cache.get((scope, name), {}).get(variant)
+
+
+def cache_results(scope, name, variant, response):
+    """
+    Caches an (etag, encoded json) results response
+    """
+    variants = dict(results_cache.get((scope, name), {}))
+    variants[variant] = response
+    results_cache.set((scope, name), variants)
+
+
+def invalidate_results(polling_station = None):
+    """
+    Drops the cached results a polling station appears in, or every cached result
+    """
+    if polling_station is None:
+        results_cache.clear()
+        return
+
+    for scope, name, parent in _tally_keys(polling_station):
+        results_cache.pop((scope, name))
+
+
+##### TALLIES #####
+def _tally_query(*group_by):
+    """
+    Returns a query summing results over polling stations grouped by group_by
+
+    Stations without a result are still counted towards stations_total
+    """
+    return db.session.query(
+        *group_by,
+        func.count(Polling_Station.id).label("stations_total"),
+        func.count(Polling_Station_Result.id).label("stations_reported"),
+        func.coalesce(func.sum(Polling_Station_Result.total_valid_ballots), 0).label("total_valid_ballots"),
+        func.coalesce(func.sum(Polling_Station_Result.total_rejected_ballots), 0).label("total_rejected_ballots"),
+        func.coalesce(func.sum(Polling_Station_Result.total_votes_cast), 0).label("total_votes_cast"),
+    ).select_from(Polling_Station).outerjoin(
+        Polling_Station_Result, Polling_Station_Result.polling_station_id == Polling_Station.id
+    ).group_by(*group_by)
+
+
+def _vote_query(*group_by):
+    """
+    Returns a query summing every candidate's votes over polling stations
+    grouped by group_by, in one scan of the polling station votes
+    """
+    return db.session.query(
+        *group_by,
+        Polling_Station_Vote.candidate_id,
+        func.sum(Polling_Station_Vote.votes).label("votes")
+    ).select_from(Polling_Station).join(
+        Polling_Station_Vote, Polling_Station_Vote.polling_station_id == Polling_Station.id
+    ).group_by(*group_by, Polling_Station_Vote.candidate_id)
+
+
+def get_candidate_totals(scope = "national"):
+    """
+    Returns the votes of every candidate summed from the raw polling station
+    votes, per constituency, per region or for the whole nation
+
+    Each item is a (name, {candidate id : votes}) pair
+    """
+    group_by = {
+        "constituency" : (Polling_Station.constituency,),
+        "region" : (Polling_Station.region,)
+    }.get(scope, ())
+
+    acc = {}
+    for row in _vote_query(*group_by).all():
+        name = row[0] if group_by else NATIONAL_TALLY_NAME
+        acc.setdefault(name, {})[row.candidate_id] = row.votes
+
+    return True, list(acc.items())
+
+
+def compute_tallies():
+    """
+    Returns every tally recomputed from the raw polling station results
+
+    Each item is a (scope, name, parent, counts, votes) tuple, votes keyed by candidate id
+    """
+    acc = []
+    votes = {scope : dict(get_candidate_totals(scope)[1]) for scope in ("constituency", "region", "national")}
+
+    for row in _tally_query(Polling_Station.region, Polling_Station.constituency).all():
+        acc.append(("constituency", row.constituency, row.region, {field : getattr(row, field) for field in TALLY_FIELDS},
+                    votes["constituency"].get(row.constituency, {})))
+
+    for row in _tally_query(Polling_Station.region).all():
+        acc.append(("region", row.region, None, {field : getattr(row, field) for field in TALLY_FIELDS},
+                    votes["region"].get(row.region, {})))
+
+    row = _tally_query().first()
+    if row is not None and row.stations_total:
+        acc.append(("national", NATIONAL_TALLY_NAME, None, {field : getattr(row, field) for field in TALLY_FIELDS},
+                    votes["national"].get(NATIONAL_TALLY_NAME, {})))
+
+    return acc
+
+
+def _tally_keys(polling_station):
+    """
+    Returns the (scope, name, parent) of every tally a polling station counts towards
+    """
+    return [
+        ("constituency", polling_station.constituency, polling_station.region),
+        ("region", polling_station.region, None),
+        ("national", NATIONAL_TALLY_NAME, None)
+    ]
+
+
+# built once so submissions skip compiling it, see add_result_to_tallies
+_tallies = Tally.__table__
+_TALLY_INCREMENT = update(_tallies).where(
+    _tallies.c.scope == bindparam("tally_scope"), _tallies.c.name == bindparam("tally_name")
+).values({
+    _tallies.c[field] : _tallies.c[field] + bindparam(field)
+    for field in TALLY_FIELDS if field != "stations_total"
+})
+_tally_votes = Tally_Vote.__table__
+_TALLY_VOTE_INCREMENT = update(_tally_votes).where(
+    _tally_votes.c.scope == bindparam("tally_scope"),
+    _tally_votes.c.name == bindparam("tally_name"),
+    _tally_votes.c.candidate_id == bindparam("vote_candidate_id")
+).values(votes = _tally_votes.c.votes + bindparam("vote_count"))
+
+
+def add_result_to_tallies(polling_station_result, polling_station):
+    """
+    Adds a polling station result to its running tallies
+
+    Does not commit, so the tallies move in the same transaction as the result.
+    The increments are done in SQL so concurrent submissions cannot lose updates
+    """
+    add_results_to_tallies([(polling_station_result, polling_station)])
+
+
+def add_results_to_tallies(results):
+    """
+    Adds (polling station result, polling station) pairs to their running tallies,
+    with one update per tally however many results count towards it
+
+    Does not commit, like add_result_to_tallies
+    """
+    acc = {}
+    votes = {}
+
+    for polling_station_result, polling_station in results:
+        for key in _tally_keys(polling_station):
+            increments = acc.setdefault(key, dict.fromkeys(TALLY_FIELDS, 0))
+            increments["stations_reported"] += 1
+            increments["total_valid_ballots"] += polling_station_result.total_valid_ballots
+            increments["total_rejected_ballots"] += polling_station_result.total_rejected_ballots
+            increments["total_votes_cast"] += polling_station_result.total_votes_cast
+
+            candidate_increments = votes.setdefault(key[:2], {})
+            for vote in polling_station_result.candidate_votes:
+                candidate_increments[vote.candidate_id] = candidate_increments.get(vote.candidate_id, 0) + vote.votes
+
+    # rows are updated in (scope, name, candidate_id) order in every
+    # transaction, so concurrent submissions cannot deadlock on their locks
+    for (scope, name), candidate_increments in sorted(votes.items()):
+        for candidate_id, count in sorted(candidate_increments.items()):
+            params = {"tally_scope" : scope, "tally_name" : name, "vote_candidate_id" : candidate_id, "vote_count" : count}
+
+            # inserted right away rather than at flush, to keep the order
+            if not db.session.execute(_TALLY_VOTE_INCREMENT, params).rowcount:
+                db.session.execute(insert(_tally_votes).values(scope = scope, name = name, candidate_id = candidate_id, votes = count))
+
+    for (scope, name, parent), increments in sorted(acc.items(), key = lambda item: item[0][:2]):
+        # the tally was not built with these stations counted in
+        increments.pop("stations_total")
+
+        # one statement per tally, executemany rowcounts are not reliable on every driver
+        updated = db.session.execute(_TALLY_INCREMENT, dict(increments, tally_scope = scope, tally_name = name)).rowcount
+
+        # tallies have not been built for these stations yet
+        if not updated:
+            db.session.execute(insert(_tallies).values(scope = scope, name = name, parent = parent,
+                                                       stations_total = increments["stations_reported"], **increments))
+
+
+def rebuild_tallies():
+    """
+    Recomputes every tally from scratch
+    """
+    tallies = compute_tallies()
+
+    Tally_Vote.query.delete()
+    Tally.query.delete()
+    for scope, name, parent, counts, votes in tallies:
+        db.session.add(Tally(scope = scope, name = name, parent = parent, **counts))
+        for candidate_id, count in votes.items():
+            db.session.add(Tally_Vote(scope = scope, name = name, candidate_id = candidate_id, votes = count))
+    db.session.commit()
+
+    invalidate_results()
+
+    return True, len(tallies)
+
+
+def check_tallies():
+    """
+    Compares the stored tallies with the raw polling station results
+
+    Returns whether they are consistent and a list of mismatches
+    """
+    stored = {(tally.scope, tally.name) : tally for tally in Tally.query.all()}
+    mismatches = []
+
+    for scope, name, parent, counts, votes in compute_tallies():
+        tally = stored.pop((scope, name), None)
+
+        if tally is None:
+            mismatches.append({"scope" : scope, "name" : name, "error" : "missing tally"})
+            continue
+
+        # candidates without a vote row have no votes
+        stored_votes = {vote.candidate_id : vote.votes for vote in tally.candidate_votes if vote.votes}
+        if stored_votes != {candidate_id : count for candidate_id, count in votes.items() if count}:
+            mismatches.append({
+                "scope" : scope,
+                "name" : name,
+                "field" : "votes",
+                "expected" : votes,
+                "stored" : stored_votes
+            })
+
+        for field in TALLY_FIELDS:
+            if getattr(tally, field) != counts[field]:
+                mismatches.append({
+                    "scope" : scope,
+                    "name" : name,
+                    "field" : field,
+                    "expected" : counts[field],
+                    "stored" : getattr(tally, field)
+                })
+
+    for scope, name in stored:
+        mismatches.append({"scope" : scope, "name" : name, "error" : "unexpected tally"})
+
+    return not mismatches, mismatches
+
+
+def get_tally(scope, name):
+    """
+    Returns a stored tally by scope and name
+    """
+    tally = Tally.query.filter(Tally.scope == scope, Tally.name == name).first()
+
+    if tally is None:
+        return False, tally
+
+    return True, tally
+
+
+def get_tally_by_constituency(name):
+    """
+    Returns summed constituency results by name
+    """
+    success, tally = get_tally("constituency", name)
+
+    if not success:
+        return False, tally
+
+    res = tally.serialize()
+    res.update({
+        "constituency_name" : tally.name,
+        "region_name" : tally.parent
+    })
+    return True, res
+
+
+def get_tally_by_region(name):
+    """
+    Returns summed region results by name, broken down by constituency
+    """
+    success, tally = get_tally("region", name)
+
+    if not success:
+        return False, tally
+
+    constituencies = Tally.query.filter(
+        Tally.scope == "constituency", Tally.parent == name
+    ).order_by(Tally.name).all()
+
+    res = tally.serialize()
+    res.update({
+        "region_name" : tally.name,
+        "constituencies" : [
+            dict(constituency.serialize(), constituency_name = constituency.name)
+            for constituency in constituencies
+        ]
+    })
+    return True, res
+
+
+def get_national_tally():
+    """
+    Returns summed national results, broken down by region
+    """
+    success, tally = get_tally("national", NATIONAL_TALLY_NAME)
+
+    if not success:
+        return False, tally
+
+    regions = Tally.query.filter(Tally.scope == "region").order_by(Tally.name).all()
+
+    res = tally.serialize()
+    res.update({
+        "regions" : [
+            dict(region.serialize(), region_name = region.name)
+            for region in regions
+        ]
+    })
+    return True, res
+
+
+##### FEED #####
+_sequences = Sequence.__table__
+_SEQUENCE_INCREMENT = update(_sequences).where(
+    _sequences.c.name == bindparam("sequence_name")
+).values(value = _sequences.c.value + bindparam("sequence_count"))
+_SEQUENCE_VALUE = select(_sequences.c.value).where(_sequences.c.name == bindparam("sequence_name"))
+
+
+def next_sequence(name, count = 1):
+    """
+    Returns the next value of a named sequence, does not commit
+
+    With a count, reserves that many values and returns the last of them.
+    The counter row stays locked until the transaction ends, so concurrent
+    transactions commit their values in increasing order
+    """
+    params = {"sequence_name" : name, "sequence_count" : count}
+
+    if not db.session.execute(_SEQUENCE_INCREMENT, params).rowcount:
+        db.session.add(Sequence(name = name, value = count))
+        return count
+
+    return db.session.execute(_SEQUENCE_VALUE, params).scalar()
+
+
+def get_result_events(since, limit = FEED_BATCH_SIZE):
+    """
+    Returns the last sequence number and the events for results committed after since
+
+    Each new result is a "result" event, followed by "tally" events with
+    the current totals of every constituency, region and nation it changed
+    """
+    rows = db.session.query(Polling_Station_Result, Polling_Station).join(
+        Polling_Station, Polling_Station.id == Polling_Station_Result.polling_station_id
+    ).filter(Polling_Station_Result.seq > since).order_by(Polling_Station_Result.seq).limit(limit).all()
+
+    if not rows:
+        return since, []
+
+    events = []
+    keys = {}
+    for polling_station_result, polling_station in rows:
+        data = polling_station_result.serialize()
+        data.update({
+            "polling_station_name" : polling_station.name,
+            "polling_station_number" : polling_station.number,
+            "constituency_name" : polling_station.constituency,
+            "region_name" : polling_station.region
+        })
+        events.append({"seq" : polling_station_result.seq, "type" : "result", "data" : data})
+
+        for scope, name, parent in _tally_keys(polling_station):
+            keys[(scope, name)] = True
+
+    last_seq = rows[-1][0].seq
+    for tally in Tally.query.filter(tuple_(Tally.scope, Tally.name).in_(list(keys))).all():
+        events.append({
+            "seq" : last_seq,
+            "type" : "tally",
+            "data" : dict(tally.serialize(), scope = tally.scope, name = tally.name)
+        })
+
+    return last_seq, events
+
+
+def get_last_result_seq():
+    """
+    Returns the sequence number of the last committed result
+    """
+    return db.session.query(func.max(Polling_Station_Result.seq)).scalar() or 0
+
+
+def wait_for_result_events(since, timeout):
+    """
+    Returns result events after since, waiting up to timeout seconds for one
+
+    The database is only read again once a later result is published in this
+    worker, by a submission or by the feed poller, see feed.connect
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        seen = feed.latest()
+        last_seq, events = get_result_events(since)
+
+        # ends the read transaction, so results committed since are visible
+        # next time, and frees the connection while the client waits
+        db.session.rollback()
+        remaining = deadline - time.monotonic()
+
+        if events or remaining <= 0:
+            return last_seq, events
+
+        feed.wait(max(since, seen), remaining)
+
+
 ##### VERIFICATION #####
 def verify_sms_code(verification_code, polling_agent_id):
-    user = get_polling_agent_by_id(id = polling_agent_id)
+    """
+    Verifies a code sent by SMS, returns the polling agent or why it was refused
+    """
+    success, polling_agent = get_polling_agent_by_id(id = polling_agent_id)
 
-    if not user:
-        return False, None
-    
-    if not user.verify_totp(verification_code):
-        return False, None
-    
-    return True, user
+    if not success:
+        return False, "Polling agent does not exists"
+
+    success, error = polling_agent.verify_totp(verification_code)
+    if not success:
+        return False, error
+
+    # keeps the step claimed so the code cannot be used again
+    db.session.commit()
+    return True, polling_agent
 
 
 def verify_totp_key(totp_key, totp_value, polling_agent_id):
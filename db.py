@@ -1,16 +1,53 @@
 import datetime
 import hashlib
 import os
-import pyotp
 
 
 
-import bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from hashing import check_secret
+from hashing import hash_secrets
+from totp import encrypt_totp_key
+from totp import decrypt_totp_key
+from totp import totp_keys_match
+from totp import verify_totp_value
+from tokens import sign_session_token
+from tokens import signed_tokens_enabled
 
-from pandas import read_excel
 db = SQLAlchemy()
 
+# Tallies are kept per constituency, per region and for the whole nation
+NATIONAL_TALLY_NAME = "national"
+TALLY_FIELDS = ("stations_total", "stations_reported",
+                "total_valid_ballots", "total_rejected_ballots", "total_votes_cast")
+
+# the column each purpose of a TOTP code keeps its last accepted step in
+TOTP_STEP_COLUMNS = {"login" : "totp_last_step", "submit" : "totp_submit_step"}
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 10000))
+
+
+
+def configure_sqlite(engine):
+    """
+    Sets up every new connection of a SQLite engine for concurrent use
+
+    WAL lets readers run alongside the writer, synchronous=NORMAL syncs at
+    checkpoints instead of every commit, and the busy timeout makes writers
+    wait for the lock instead of failing with "database is locked"
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
 
 
 class Polling_Agent(db.Model):
@@ -24,7 +61,12 @@ class Polling_Agent(db.Model):
     name = db.Column(db.String, nullable = False)
     phone_number = db.Column(db.String, nullable = False, unique = True)
     password_digest = db.Column(db.String, nullable= False, unique = True)
-    totp_key_digest = db.Column(db.String, nullable= False, unique = True)
+    # TOTP secret is encrypted at rest so it can be checked in microseconds
+    totp_key_encrypted = db.Column(db.String, nullable= False)
+    # last accepted time steps, for replay protection. Logins and submissions
+    # are tracked apart, so an agent can log in and submit with the same code
+    totp_last_step = db.Column(db.Integer, nullable = True)
+    totp_submit_step = db.Column(db.Integer, nullable = True)
 
     is_verified = db.Column(db.Boolean, default = False, nullable =  False)  #TODO: HOW TO VERIFY
 
@@ -46,9 +88,10 @@ class Polling_Agent(db.Model):
         """
         self.name = kwargs.get("name")
         self.phone_number = kwargs.get("phone_number")
-        self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
+        # bulk onboarding hashes passwords up front, in parallel
+        self.password_digest = kwargs.get("password_digest") or hash_secrets(kwargs.get("password"))[0]
+        self.totp_key_encrypted = encrypt_totp_key(kwargs.get("totp_key"))
         self.polling_station_id = kwargs.get("polling_station_id")
-        self.totp_key_digest = bcrypt.hashpw(kwargs.get("totp_key").encode("utf8"), bcrypt.gensalt(rounds=13))
         self.renew_session()
 
 
@@ -77,25 +120,62 @@ class Polling_Agent(db.Model):
     def renew_session(self):
         """
         Renews session
+
+        In signed token mode the session token can only be signed once the
+        polling agent has an id, new polling agents get an opaque one first
         """
-        self.session_token = self._urlsafe_base_64()
         self.session_expiration = datetime.datetime.now() + datetime.timedelta(minutes=15)
+        if signed_tokens_enabled() and self.id is not None:
+            self.session_token = sign_session_token(self.id, self.polling_station_id, self.session_expiration)
+        else:
+            self.session_token = self._urlsafe_base_64()
         self.update_token = self._urlsafe_base_64()
 
     def verify_password(self, password):
         """
         Verifies the password of a polling agent
         """
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        return check_secret(password, self.password_digest)
 
     
     def verify_totp_key(self, totp_key, totp_value):
         """
         Verifies the auto password of a polling agent
         """
-        if not bcrypt.checkpw(totp_key.encode("utf8"), self.totp_key_digest):
+        if not totp_keys_match(totp_key, self.totp_key_encrypted):
             return False
-        return pyotp.TOTP(totp_key, interval= 15).verify(totp_value)
+        return self.verify_totp(totp_value)[0]
+
+    def verify_totp(self, totp_value, purpose = "login"):
+        """
+        Verifies a TOTP code against the stored secret, accepting each time
+        step once per purpose, "login" or "submit"
+
+        The step is claimed with a conditional update so concurrent workers
+        cannot both accept the same code. Returns whether the code was
+        accepted and why not. The caller commits
+        """
+        column = TOTP_STEP_COLUMNS[purpose]
+        last_step = getattr(self, column)
+        valid, step = verify_totp_value(decrypt_totp_key(self.totp_key_encrypted), totp_value)
+
+        if not valid:
+            return False, "Invalid auto password"
+
+        if last_step is not None and step <= last_step:
+            return False, "Auto password already used, wait for the next one"
+
+        last_step_column = getattr(Polling_Agent, column)
+        claimed = Polling_Agent.query.filter(
+            Polling_Agent.id == self.id,
+            db.or_(last_step_column == None, last_step_column < step)
+        ).update({last_step_column : step}, synchronize_session = False)
+
+        if not claimed:
+            return False, "Auto password already used, wait for the next one"
+
+        setattr(self, column, step)
+        return True, None
     
     def verify_session_token(self, session_token):
         """
@@ -104,29 +184,211 @@ class Polling_Agent(db.Model):
 
         return session_token == self.session_token and datetime.datetime.now() < self.session_expiration
         
-def load_polling_stations():
+class Revoked_Session(db.Model):
+    """
+    Revoked Session Model
+
+    Signed session tokens ended before they expire, kept until they expire
+    """
+    __tablename__ = "revoked_sessions"
+    token_digest = db.Column(db.String, primary_key = True)
+    expires_at = db.Column(db.DateTime, nullable = False, index = True)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a revoked session
+        """
+        self.token_digest = kwargs.get("token_digest")
+        self.expires_at = kwargs.get("expires_at")
+
+
+class Collation_Centre(db.Model):
+    """
+    Collation Centre Model
+
+    Collation centres submit results in batches for the polling stations of
+    their region, or of one constituency of it, with a key instead of the
+    polling agents' TOTP codes
+    """
+    __tablename__ = "collation_centres"
+    id = db.Column(db.Integer, primary_key=True, autoincrement = True)
+    name = db.Column(db.String, nullable = False, unique = True)
+    region = db.Column(db.String, nullable = False)
+    constituency = db.Column(db.String, nullable = True)  # the whole region when not set
+    key_digest = db.Column(db.String, nullable = False, unique = True)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a collation centre
+        """
+        self.name = kwargs.get("name")
+        self.region = kwargs.get("region")
+        self.constituency = kwargs.get("constituency")
+        self.key_digest = kwargs.get("key_digest")
+
+
+    def covers(self, polling_station):
+        """
+        Returns whether the polling station is in the area of the collation centre
+        """
+        if polling_station.region != self.region:
+            return False
+
+        return self.constituency is None or polling_station.constituency == self.constituency
+
+
+    def serialize(self):
+        """
+        Returns a serialized collation centre
+        """
+        res = {
+            "id" : self.id,
+            "name" : self.name,
+            "region_name" : self.region,
+            "constituency_name" : self.constituency
+        }
+        return res
+
+
+class Region(db.Model):
+    """
+    Region Model
+    """
+    __tablename__ = "regions"
+    id = db.Column(db.Integer, primary_key=True, autoincrement = True)
+    name = db.Column(db.String, nullable = False, unique = True)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a region
+        """
+        self.name = kwargs.get("name")
+
+
+    def serialize(self):
+        """
+        Returns a serialized region
+        """
+        res = {
+            "id" : self.id,
+            "region_name" : self.name
+        }
+        return res
+
+
+class Constituency(db.Model):
+    """
+    Constituency Model
+    """
+    __tablename__ = "constituencies"
+    __table_args__ = (
+        db.UniqueConstraint("region_id", "name"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement = True)
+    name = db.Column(db.String, nullable = False)
+    region_id = db.Column(db.Integer, db.ForeignKey("regions.id"), nullable = False)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a constituency
+        """
+        self.name = kwargs.get("name")
+        self.region_id = kwargs.get("region_id")
+
+
+    def serialize(self):
+        """
+        Returns a serialized constituency
+        """
+        res = {
+            "id" : self.id,
+            "constituency_name" : self.name,
+            "region_id" : self.region_id
+        }
+        return res
+
+
+class Party(db.Model):
+    """
+    Party Model
     """
-    Loads polling stations into polling stations model from stations.xlsx
+    __tablename__ = "parties"
+    id = db.Column(db.Integer, primary_key=True, autoincrement = True)
+    name = db.Column(db.String, nullable = False, unique = True)
+    abbreviation = db.Column(db.String, nullable = True)
+
 
-    stations.xlsx must contain name, number, constituency and region columns
+    def __init__(self, **kwargs):
+        """
+        Initializes a party
+        """
+        self.name = kwargs.get("name")
+        self.abbreviation = kwargs.get("abbreviation")
+
+
+    def serialize(self):
+        """
+        Returns a serialized party
+        """
+        res = {
+            "id" : self.id,
+            "party_name" : self.name,
+            "abbreviation" : self.abbreviation
+        }
+        return res
+
+
+class Candidate(db.Model):
+    """
+    Candidate Model
+
+    key is how the candidate is named in the data of a result, e.g. "cand1"
     """
+    __tablename__ = "candidates"
+    id = db.Column(db.Integer, primary_key=True, autoincrement = True)
+    key = db.Column(db.String, nullable = False, unique = True)
+    name = db.Column(db.String, nullable = False)
+    party_id = db.Column(db.Integer, db.ForeignKey("parties.id"), nullable = True, index = True)
 
-    polling_stations_df = read_excel('polling_stations.xlsx')
+    party = db.relationship("Party", lazy = "joined")
 
-    # Specify the table name and the SQLAlchemy engine
-    engine = db.get_engine()
 
-    # Insert the data into the database table
+    def __init__(self, **kwargs):
+        """
+        Initializes a candidate
+        """
+        self.key = kwargs.get("key")
+        self.name = kwargs.get("name") or self.key
+        self.party_id = kwargs.get("party_id")
+
+
+    def serialize(self):
+        """
+        Returns a serialized candidate
+        """
+        res = {
+            "id" : self.id,
+            "key" : self.key,
+            "candidate_name" : self.name,
+            "party" : self.party.serialize() if self.party else None
+        }
+        return res
 
-    polling_stations_df.to_sql("polling_stations", con = engine, if_exists = 'replace', index = False, chunksize = 1000) 
-    db.session.commit()
-    return True
 
 class Polling_Station(db.Model):
     """
     Polling Station Model
     """
     __tablename__ = "polling_stations"
+    __table_args__ = (
+        # region and region + constituency reports are range scans on this index
+        db.Index("ix_polling_stations_hierarchy", "region", "constituency", "number"),
+        db.Index("ix_polling_stations_constituency", "constituency"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement = True)
 
     # Polling station results
@@ -140,7 +402,13 @@ class Polling_Station(db.Model):
     number = db.Column(db.String, nullable = False, unique = True)
     region = db.Column(db.String, nullable = False)
     constituency = db.Column(db.String, nullable = False)
-    # composite id between region and constituency
+
+    # from the roster when known, for turnout
+    registered_voters = db.Column(db.Integer, nullable = True)
+
+    # normalized hierarchy, kept in sync with the region and constituency names
+    region_id = db.Column(db.Integer, db.ForeignKey("regions.id"), nullable = True, index = True)
+    constituency_id = db.Column(db.Integer, db.ForeignKey("constituencies.id"), nullable = True, index = True)
 
 
 
@@ -152,6 +420,9 @@ class Polling_Station(db.Model):
         self.number = kwargs.get("number") 
         self.constituency = kwargs.get("constituency")
         self.region = kwargs.get("region")
+        self.registered_voters = kwargs.get("registered_voters")
+        self.region_id = kwargs.get("region_id")
+        self.constituency_id = kwargs.get("constituency_id")
 
          
     def serialize(self):
@@ -159,10 +430,12 @@ class Polling_Station(db.Model):
         Returns a serialized polling station
         """
         res = {
+            "polling_station_id" : self.id,
             "polling_station_name" : self.name,
             "polling_station_number" : self.number,
             "constituency_name" : self.constituency,
             "region_name" : self.region,
+            "registered_voters" : self.registered_voters,
             "polling_station_result" : [result.serialize() for result in self.polling_station_results],
             "polling_agent" : [polling_agent.serialize() for polling_agent in self.polling_agent]
         }
@@ -176,11 +449,13 @@ class Polling_Station_Result(db.Model):
     __tablename__ = "polling_station_results"
     id = db.Column(db.Integer, primary_key=True, autoincrement = True)
 
-    # Candidates with votes
-
-    cand1 = db.Column(db.Integer, nullable = False)
-    cand2 = db.Column(db.Integer, nullable = False)
-    cand3 = db.Column(db.Integer, nullable = False) #TODO: candidate table with party of candidate
+    # Candidates with votes, one row per candidate keyed by polling station
+    candidate_votes = db.relationship(
+        "Polling_Station_Vote",
+        primaryjoin = "Polling_Station_Result.polling_station_id == foreign(Polling_Station_Vote.polling_station_id)",
+        order_by = "Polling_Station_Vote.candidate_id",
+        lazy = "selectin"
+    )
 
     # measure of central tendies
     total_valid_ballots = db.Column(db.Integer, nullable = False)
@@ -196,14 +471,16 @@ class Polling_Station_Result(db.Model):
     # polling station
     polling_station_id = db.Column(db.Integer, db.ForeignKey("polling_stations.id"), nullable = False, unique = True)
 
+    # ingest sequence, increasing in commit order, see Sequence
+    seq = db.Column(db.Integer, nullable = True, unique = True)
+    created_at = db.Column(db.DateTime, nullable = True, index = True, default = datetime.datetime.now)
+
 
     def __init__(self, **kwargs):
         """
         Initializes a polling station result
         """
-        self.cand1 = kwargs.get("votes").get("cand1")
-        self.cand2 = kwargs.get("votes").get("cand2") 
-        self.cand3 = kwargs.get("votes").get("cand3")
+        self.candidate_votes = kwargs.get("candidate_votes", [])
 
         self.total_rejected_ballots = kwargs.get("total_rejected_ballots")
         self.total_valid_ballots = kwargs.get("total_valid_ballots")
@@ -220,18 +497,147 @@ class Polling_Station_Result(db.Model):
         Returns a serialized polling station result
         """
         res = {
-            "data" : {
-                "cand1" : self.cand1,
-                "cand2" : self.cand2,
-                "cand3" : self.cand3}
-                ,
+            "data" : {vote.candidate.key : vote.votes for vote in self.candidate_votes},
             "total_rejected_ballots" : self.total_rejected_ballots,
             "total_valid_ballots" : self.total_valid_ballots,
             "total_votes_cast" : self.total_votes_cast,
             "pink_sheet" : self.pink_sheet,
             "polling_agent_id" : self.polling_agent_id,
-            "polling_station_id" : self.polling_station_id
+            "polling_station_id" : self.polling_station_id,
+            "seq" : self.seq,
+            "created_at" : self.created_at.isoformat() if self.created_at else None
         }
         return res
     
 
+class Polling_Station_Vote(db.Model):
+    """
+    Polling Station Vote Model
+
+    The votes of one candidate at one polling station
+    """
+    __tablename__ = "polling_station_votes"
+    __table_args__ = (
+        # per candidate sums over a set of stations read only this index
+        db.Index("ix_polling_station_votes_covering", "polling_station_id", "candidate_id", "votes"),
+    )
+    polling_station_id = db.Column(db.Integer, db.ForeignKey("polling_stations.id"), primary_key = True)
+    candidate_id = db.Column(db.Integer, db.ForeignKey("candidates.id"), primary_key = True)
+    votes = db.Column(db.Integer, nullable = False)
+
+    candidate = db.relationship("Candidate", lazy = "joined")
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a polling station vote
+        """
+        self.polling_station_id = kwargs.get("polling_station_id")
+        self.candidate_id = kwargs.get("candidate_id")
+        self.votes = kwargs.get("votes")
+
+
+class Sequence(db.Model):
+    """
+    Sequence Model
+
+    Named counters. Taking a value locks the counter row until commit, so
+    values become visible in the order they were taken
+    """
+    __tablename__ = "sequences"
+    name = db.Column(db.String, primary_key = True)
+    value = db.Column(db.Integer, default = 0, nullable = False)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a sequence
+        """
+        self.name = kwargs.get("name")
+        self.value = kwargs.get("value", 0)
+
+
+class Tally(db.Model):
+    """
+    Tally Model
+
+    Running totals for a constituency, a region or the whole nation, updated
+    in the same transaction as every polling station result
+    """
+    __tablename__ = "tallies"
+
+    # scope is constituency, region or national; parent is the region of a constituency
+    scope = db.Column(db.String, primary_key = True)
+    name = db.Column(db.String, primary_key = True)
+    parent = db.Column(db.String, nullable = True, index = True)
+
+    # Reporting progress
+    stations_total = db.Column(db.Integer, default = 0, nullable = False)
+    stations_reported = db.Column(db.Integer, default = 0, nullable = False)
+
+    # Candidates with votes, see Tally_Vote
+    candidate_votes = db.relationship(
+        "Tally_Vote",
+        primaryjoin = "and_(Tally.scope == foreign(Tally_Vote.scope), Tally.name == foreign(Tally_Vote.name))",
+        order_by = "Tally_Vote.candidate_id",
+        lazy = "selectin",
+        viewonly = True
+    )
+
+    # measure of central tendies
+    total_valid_ballots = db.Column(db.Integer, default = 0, nullable = False)
+    total_rejected_ballots = db.Column(db.Integer, default = 0, nullable = False)
+    total_votes_cast = db.Column(db.Integer, default = 0, nullable = False)
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a tally
+        """
+        self.scope = kwargs.get("scope")
+        self.name = kwargs.get("name")
+        self.parent = kwargs.get("parent")
+
+        for field in TALLY_FIELDS:
+            setattr(self, field, kwargs.get(field, 0))
+
+
+    def serialize(self):
+        """
+        Returns a serialized tally
+        """
+        res = {
+            "stations_total" : self.stations_total,
+            "stations_reported" : self.stations_reported,
+            "data" : {vote.candidate.key : vote.votes for vote in self.candidate_votes},
+            "total_rejected_ballots" : self.total_rejected_ballots,
+            "total_valid_ballots" : self.total_valid_ballots,
+            "total_votes_cast" : self.total_votes_cast
+        }
+        return res
+
+
+class Tally_Vote(db.Model):
+    """
+    Tally Vote Model
+
+    Running total of one candidate's votes in a tally
+    """
+    __tablename__ = "tally_votes"
+    scope = db.Column(db.String, primary_key = True)
+    name = db.Column(db.String, primary_key = True)
+    candidate_id = db.Column(db.Integer, db.ForeignKey("candidates.id"), primary_key = True)
+    votes = db.Column(db.Integer, default = 0, nullable = False)
+
+    candidate = db.relationship("Candidate", lazy = "joined")
+
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a tally vote
+        """
+        self.scope = kwargs.get("scope")
+        self.name = kwargs.get("name")
+        self.candidate_id = kwargs.get("candidate_id")
+        self.votes = kwargs.get("votes", 0)
+
@@ -0,0 +1,133 @@
+"""
+Feed file
+
+Wakes up the results feeds of this worker as soon as a result is committed.
+Results committed by other workers are picked up by one poller thread per
+worker, shared by every feed client. Each client holds a request thread while
+it waits, so streams and long polls each get their share of the worker's
+threads, and FEED_RESERVED_THREADS are always left for submissions
+"""
+
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# request threads of a worker, see gunicorn.conf.py
+WORKER_THREADS = int(os.environ.get("GUNICORN_THREADS", 32))
+FEED_RESERVED_THREADS = int(os.environ.get("FEED_RESERVED_THREADS", 8))
+
+# streams stay connected, long polls come back between responses, so two
+# thirds of the feed threads go to streams by default
+FEED_THREADS = max(WORKER_THREADS - FEED_RESERVED_THREADS, 3)
+FEED_MAX_STREAMS = int(os.environ.get("FEED_MAX_STREAMS", FEED_THREADS * 2 // 3))
+FEED_MAX_POLLS = int(os.environ.get("FEED_MAX_POLLS", FEED_THREADS - FEED_THREADS * 2 // 3))
+FEED_POLL_SECONDS = float(os.environ.get("FEED_POLL_SECONDS", 1))
+
+FEED_LIMITS = {"stream" : FEED_MAX_STREAMS, "poll" : FEED_MAX_POLLS}
+
+
+_condition = threading.Condition()
+_latest = {"seq" : 0}
+
+_lock = threading.Lock()
+_clients = {"stream" : 0, "poll" : 0}
+_rejected = {"stream" : 0, "poll" : 0}
+_poller = {"pid" : None}
+
+
+
+def publish(seq):
+    """
+    Announces that results up to seq were committed
+    """
+    with _condition:
+        _latest["seq"] = max(_latest["seq"], seq)
+        _condition.notify_all()
+
+
+def latest():
+    """
+    Returns the last sequence number published here
+    """
+    with _condition:
+        return _latest["seq"]
+
+
+def wait(since, timeout):
+    """
+    Waits up to timeout seconds for a result after since to be published here
+    """
+    with _condition:
+        _condition.wait_for(lambda: _latest["seq"] > since, timeout)
+
+
+def _poll(last_seq):
+    while True:
+        time.sleep(FEED_POLL_SECONDS)
+
+        with _lock:
+            idle = not any(_clients.values())
+
+        if idle:
+            continue
+
+        try:
+            publish(last_seq())
+        except Exception:
+            # database unavailable, tried again on the next tick
+            pass
+
+
+def connect(last_seq, kind = "stream"):
+    """
+    Takes a feed client slot of this worker, "stream" or "poll", returns
+    false if all slots of that kind are taken
+
+    last_seq returns the last committed sequence number. The first client
+    starts the poller calling it every FEED_POLL_SECONDS, for as long as
+    clients are connected. Every client calls disconnect once done
+    """
+    with _lock:
+        if _clients[kind] >= FEED_LIMITS[kind]:
+            _rejected[kind] += 1
+            return False
+
+        _clients[kind] += 1
+
+        # the poller thread does not survive a fork
+        start = _poller["pid"] != os.getpid()
+        _poller["pid"] = os.getpid()
+
+    if start:
+        threading.Thread(target = _poll, args = (last_seq,), name = "feed-poller", daemon = True).start()
+
+    return True
+
+
+def disconnect(kind = "stream"):
+    """
+    Frees the feed client slot taken by connect
+    """
+    with _lock:
+        _clients[kind] -= 1
+
+
+def metrics():
+    """
+    Returns the feed client counts of this worker
+    """
+    with _lock:
+        res = {
+            "streams" : _clients["stream"],
+            "polls" : _clients["poll"],
+            "rejected_streams" : _rejected["stream"],
+            "rejected_polls" : _rejected["poll"],
+            "max_streams" : FEED_MAX_STREAMS,
+            "max_polls" : FEED_MAX_POLLS
+        }
+
+    res["latest_seq"] = latest()
+    return res
@@ -0,0 +1,59 @@
+"""
+Gunicorn config
+
+Every setting can be overridden from the environment, e.g. GUNICORN_WORKERS=8
+"""
+
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# one process per core for cpu bound work, threads for requests waiting on
+# the database, hashing pool or a results feed. Feed clients hold a thread
+# while they wait, without a database connection, so the feed gets every
+# thread but FEED_RESERVED_THREADS, see feed.py
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+# gthread workers heartbeat independently of requests, so long lived
+# results feed streams are not killed by the timeout
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# recycles workers now and then to bound memory growth
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 1000))
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    """
+    Creates missing tables once in the master, so workers do not race to
+    """
+    from app import create_app
+    from db import db
+
+    app = create_app()
+    with app.app_context():
+        db.engine.dispose()
+
+    os.environ["DB_CREATE_TABLES"] = "false"
+
+
+def post_fork(server, worker):
+    """
+    Starts the SMS senders of each worker, so messages queued before a restart
+    are sent right away. Apps built for CLI commands never send SMS
+    """
+    import twilioapp
+
+    twilioapp.start_workers()
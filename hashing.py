@@ -0,0 +1,124 @@
+"""
+Hashing file
+
+Helper file running bcrypt hashing and verification on a bounded process pool,
+so slow hashes never hold the request threads' CPU
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from dotenv import load_dotenv
+load_dotenv()
+
+# cost factor for new hashes, existing hashes keep the cost they were made with
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 13))
+
+# 0 workers hashes inline on the calling thread
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+
+# callers block once this many hashes are queued or running
+HASH_MAX_QUEUE_DEPTH = int(os.environ.get("HASH_MAX_QUEUE_DEPTH", 32))
+
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+_queue = threading.Condition()
+_metrics = {
+    "queue_depth" : 0,
+    "peak_queue_depth" : 0,
+    "completed" : 0,
+    "total_wait_seconds" : 0.0
+}
+
+
+
+def _hashpw(secret, rounds):
+    # digests are stored in string columns, bytes would be stored as bytea text by PostgreSQL
+    return bcrypt.hashpw(secret, bcrypt.gensalt(rounds = rounds)).decode("ascii")
+
+def _checkpw(secret, digest):
+    return bcrypt.checkpw(secret, digest)
+
+
+def _get_executor():
+    """
+    Returns the process pool, creating it lazily in each (forked) worker process
+    """
+    global _executor, _executor_pid
+
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers = HASH_WORKERS)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run(fn, *args_list):
+    """
+    Runs fn once per argument tuple on the pool and returns the results in order
+    """
+    if HASH_WORKERS <= 0:
+        return [fn(*args) for args in args_list]
+
+    # large batches go through the queue a slice at a time
+    if len(args_list) > HASH_MAX_QUEUE_DEPTH:
+        acc = []
+        for i in range(0, len(args_list), HASH_MAX_QUEUE_DEPTH):
+            acc.extend(_run(fn, *args_list[i:i + HASH_MAX_QUEUE_DEPTH]))
+        return acc
+
+    start = time.perf_counter()
+    slots = len(args_list)
+
+    with _queue:
+        _queue.wait_for(lambda: _metrics["queue_depth"] + slots <= HASH_MAX_QUEUE_DEPTH)
+        _metrics["queue_depth"] += slots
+        _metrics["peak_queue_depth"] = max(_metrics["peak_queue_depth"], _metrics["queue_depth"])
+
+    try:
+        executor = _get_executor()
+        futures = [executor.submit(fn, *args) for args in args_list]
+        return [future.result() for future in futures]
+    finally:
+        with _queue:
+            _metrics["queue_depth"] -= slots
+            _metrics["completed"] += len(args_list)
+            _metrics["total_wait_seconds"] += time.perf_counter() - start
+            _queue.notify_all()
+
+
+def hash_secrets(*secrets, rounds = None):
+    """
+    Returns the bcrypt digests of secrets as strings, hashed in parallel
+    """
+    rounds = rounds or BCRYPT_ROUNDS
+    return _run(_hashpw, *[(secret.encode("utf8"), rounds) for secret in secrets])
+
+
+def check_secret(secret, digest):
+    """
+    Returns true if secret matches the bcrypt digest
+    """
+    if isinstance(digest, str):
+        digest = digest.encode("utf8")
+    return _run(_checkpw, (secret.encode("utf8"), digest))[0]
+
+
+def metrics():
+    """
+    Returns the hashing pool metrics
+    """
+    with _queue:
+        res = dict(_metrics)
+
+    res.update({
+        "workers" : HASH_WORKERS,
+        "max_queue_depth" : HASH_MAX_QUEUE_DEPTH,
+        "rounds" : BCRYPT_ROUNDS
+    })
+    return res
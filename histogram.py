@@ -0,0 +1,94 @@
+"""
+Histogram file
+
+Thread safe fixed bucket histogram for latencies and sizes, cheap enough to
+record every request, and exact percentiles for the benchmarks
+"""
+
+import statistics
+import threading
+
+
+# upper bounds of the buckets, the last bucket is unbounded
+LATENCY_BOUNDS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+
+class Histogram:
+    """
+    Counts values into buckets with the given upper bounds
+
+    Quantiles are estimated as the upper bound of the bucket they fall in
+    """
+
+    def __init__(self, bounds = LATENCY_BOUNDS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+
+    def record(self, value):
+        """
+        Adds value to the histogram
+        """
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+
+    def _quantile(self, q):
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+
+    def metrics(self):
+        """
+        Returns the count, mean, max, estimated p50/p95/p99 and the bucket counts
+        """
+        with self._lock:
+            res = {
+                "count" : self.count,
+                "mean" : self.total / self.count if self.count else 0,
+                "max" : self.max,
+                "p50" : self._quantile(0.5),
+                "p95" : self._quantile(0.95),
+                "p99" : self._quantile(0.99),
+                "buckets" : {
+                    f"<={bound}" if i < len(self.bounds) else f">{self.bounds[-1]}" : self.counts[i]
+                    for i, bound in enumerate(self.bounds + (None,))
+                }
+            }
+        return res
+
+
+##### BENCHMARKS #####
+def percentile(latencies, q):
+    """
+    Returns the q quantile of sorted latencies
+    """
+    return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+
+def print_latencies(name, latencies):
+    """
+    Prints the mean, p50 and p99 of latencies in ms
+    """
+    latencies = sorted(latencies)
+    print(f"{name:<12} mean {statistics.mean(latencies):10.3f} ms   p50 {percentile(latencies, 0.5):10.3f} ms   p99 {percentile(latencies, 0.99):10.3f} ms")
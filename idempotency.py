@@ -0,0 +1,102 @@
+"""
+Idempotency file
+
+Responses to requests sent with an Idempotency-Key header are kept in memory
+for a while, so a client retrying a request gets the first response back
+without it running again. Retries arriving while the first request still
+runs wait for its response
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from cache import LRUCache
+from dotenv import load_dotenv
+load_dotenv()
+
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 20000))
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_WAIT_SECONDS = 30
+MAX_KEY_LENGTH = 255
+
+
+# key -> (request fingerprint, response)
+responses = LRUCache(maxsize = IDEMPOTENCY_CACHE_SIZE, ttl = IDEMPOTENCY_TTL)
+
+# key -> event set once the request running with it finishes
+_running = {}
+_lock = threading.Lock()
+_counters = {"replays" : 0, "waits" : 0, "conflicts" : 0}
+
+
+
+def fingerprint(body, exclude = ()):
+    """
+    Returns a digest of a json request body, ignoring the keys in exclude
+    """
+    content = {key : value for key, value in body.items() if key not in exclude}
+    return hashlib.sha256(json.dumps(content, sort_keys = True).encode("utf8")).hexdigest()
+
+
+def begin(key, request_fingerprint, timeout = IDEMPOTENCY_WAIT_SECONDS):
+    """
+    Claims key for a request
+
+    Returns (True, None) if the request has to run, and finish must then be
+    called, or (False, response) with the response of an earlier request
+    sent with key. The response is None if key was used for a different
+    request or the request using it is still running after timeout seconds
+    """
+    while True:
+        with _lock:
+            stored = responses.get(key)
+
+            if stored is not None:
+                stored_fingerprint, response = stored
+
+                if stored_fingerprint != request_fingerprint:
+                    _counters["conflicts"] += 1
+                    return False, None
+
+                _counters["replays"] += 1
+                return False, response
+
+            running = _running.get(key)
+
+            if running is None:
+                _running[key] = threading.Event()
+                return True, None
+
+            _counters["waits"] += 1
+
+        if not running.wait(timeout):
+            return False, None
+
+
+def finish(key, request_fingerprint, response = None):
+    """
+    Releases key, keeping response for later requests sent with it
+
+    Without a response the key is released only, so a retry runs again
+    """
+    with _lock:
+        if response is not None:
+            responses.set(key, (request_fingerprint, response))
+
+        running = _running.pop(key, None)
+
+    if running is not None:
+        running.set()
+
+
+def metrics():
+    """
+    Returns the idempotency store metrics
+    """
+    with _lock:
+        res = dict(_counters, running = len(_running))
+
+    res.update(responses.metrics())
+    return res
@@ -0,0 +1,447 @@
+"""
+Importer file
+
+Helper file for bulk loading the polling station roster into our database
+"""
+
+import csv
+import os
+import secrets
+import time
+
+from db import Constituency
+from db import Polling_Agent
+from db import Polling_Station
+from db import Region
+from db import db
+
+import provisioning
+from dao import create_candidate
+from dao import invalidate_results
+from hashing import hash_secrets
+from openpyxl import load_workbook
+from sqlalchemy import exc
+from sqlalchemy import exists
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
+from tokens import signed_tokens_enabled
+from totp import decrypt_totp_key
+from totp import gen_totp_key
+from totp import gen_totp_uri
+
+STATION_COLUMNS = ("name", "number", "constituency", "region")
+OPTIONAL_STATION_COLUMNS = ("registered_voters",)
+BATCH_SIZE = 5000
+AGENT_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+
+
+
+def _read_rows(path):
+    """
+    Yields the rows of an xlsx or csv roster one at a time, header first
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, newline = "") as roster:
+            yield from csv.reader(roster)
+        return
+
+    # read_only streams rows instead of loading the whole workbook
+    workbook = load_workbook(path, read_only = True)
+    try:
+        yield from workbook.active.iter_rows(values_only = True)
+    finally:
+        workbook.close()
+
+
+def _clean_value(value):
+    """
+    Returns a cell as a stripped string, so 1001 and 1001.0 both become "1001"
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _clean_row(columns, row, optional_columns = None):
+    """
+    Returns a polling station dict from a roster row, or an error message
+
+    Optional columns are counts and may be left empty
+    """
+    station = {}
+
+    for column, index in columns.items():
+        value = _clean_value(row[index]) if index < len(row) else ""
+
+        if not value:
+            return False, f"missing {column}"
+
+        station[column] = value
+
+    for column, index in (optional_columns or {}).items():
+        value = _clean_value(row[index]) if index < len(row) else ""
+
+        if value and not value.isdigit():
+            return False, f"invalid {column}"
+
+        station[column] = int(value) if value else None
+
+    return True, station
+
+
+def _upsert_statement(optional_columns = ()):
+    """
+    Returns an insert that updates the existing polling station with the same number
+
+    Updating in place keeps station ids, and so polling agent and result foreign keys, intact.
+    Optional columns are only updated when the roster has them
+    """
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(Polling_Station.__table__)
+
+    return stmt.on_conflict_do_update(
+        index_elements = ["number"],
+        set_ = {column : stmt.excluded[column] for column in ("name", "constituency", "region", *optional_columns)}
+    )
+
+
+def _flush_batch(stmt, batch):
+    """
+    Upserts a batch of polling stations in a single executemany transaction
+    """
+    db.session.execute(stmt, list(batch.values()))
+    db.session.commit()
+    batch.clear()
+
+
+def sync_station_hierarchy():
+    """
+    Creates any missing regions and constituencies from the polling station
+    names and points every polling station at them, all with set-based SQL
+    """
+    regions = Region.__table__
+    constituencies = Constituency.__table__
+    stations = Polling_Station.__table__
+
+    db.session.execute(regions.insert().from_select(
+        ["name"],
+        select(stations.c.region).distinct().where(
+            ~exists().where(regions.c.name == stations.c.region)
+        )
+    ))
+
+    db.session.execute(constituencies.insert().from_select(
+        ["name", "region_id"],
+        select(stations.c.constituency, regions.c.id).distinct().select_from(
+            stations.join(regions, regions.c.name == stations.c.region)
+        ).where(
+            ~exists().where(
+                constituencies.c.name == stations.c.constituency,
+                constituencies.c.region_id == regions.c.id
+            )
+        )
+    ))
+
+    db.session.execute(stations.update().values(
+        region_id = select(regions.c.id).where(
+            regions.c.name == stations.c.region
+        ).scalar_subquery(),
+        constituency_id = select(constituencies.c.id).select_from(
+            constituencies.join(regions, regions.c.id == constituencies.c.region_id)
+        ).where(
+            constituencies.c.name == stations.c.constituency,
+            regions.c.name == stations.c.region
+        ).scalar_subquery()
+    ))
+
+    db.session.commit()
+
+
+def import_polling_stations(path = "polling_stations.xlsx", batch_size = BATCH_SIZE):
+    """
+    Streams polling stations from an xlsx or csv roster and upserts them by number
+
+    The roster must have name, number, constituency and region columns, and
+    may have registered_voters. Returns whether anything was imported and the
+    import stats
+    """
+    start = time.perf_counter()
+    rows = _read_rows(path)
+
+    header = [_clean_value(value).lower() for value in next(rows, ())]
+    missing = [column for column in STATION_COLUMNS if column not in header]
+
+    if missing:
+        return False, {"error" : "Missing columns: " + ", ".join(missing)}
+
+    columns = {column : header.index(column) for column in STATION_COLUMNS}
+    optional_columns = {column : header.index(column) for column in OPTIONAL_STATION_COLUMNS if column in header}
+
+    stmt = _upsert_statement(optional_columns)
+    stats = {"rows" : 0, "imported" : 0, "rejected" : 0, "errors" : []}
+
+    # keyed by number so a station repeated within a batch is only upserted once
+    batch = {}
+
+    for line, row in enumerate(rows, start = 2):
+        if not any(row):
+            continue
+
+        stats["rows"] += 1
+        valid, station = _clean_row(columns, row, optional_columns)
+
+        if not valid:
+            stats["rejected"] += 1
+            if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+                stats["errors"].append({"row" : line, "error" : station})
+            continue
+
+        batch[station["number"]] = station
+        stats["imported"] += 1
+
+        if len(batch) >= batch_size:
+            _flush_batch(stmt, batch)
+
+    if batch:
+        _flush_batch(stmt, batch)
+
+    sync_station_hierarchy()
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    stats["rows_per_second"] = round(stats["rows"] / stats["seconds"]) if stats["seconds"] else stats["rows"]
+
+    return stats["imported"] > 0, stats
+
+
+def read_records(path):
+    """
+    Yields (row number, record) pairs from an xlsx or csv file, keyed by its header
+    """
+    rows = _read_rows(path)
+    header = [_clean_value(value).lower() for value in next(rows, ())]
+
+    for line, row in enumerate(rows, start = 2):
+        if any(row):
+            yield line, {column : _clean_value(value) for column, value in zip(header, row) if column}
+
+
+def _clean_agent(record):
+    """
+    Returns a polling agent dict from a roster record, or an error message
+
+    A name or a firstname and lastname are accepted. Agents without a password
+    get a generated one, which is returned in the import report
+    """
+    if not isinstance(record, dict):
+        return False, "invalid record"
+
+    record = {key : _clean_value(value) for key, value in record.items()}
+
+    name = record.get("name") or " ".join(filter(None, (record.get("firstname"), record.get("lastname"))))
+    agent = {
+        "name" : name,
+        "phone_number" : record.get("phone_number"),
+        "polling_station_number" : record.get("polling_station_number") or record.get("number"),
+        "password" : record.get("password")
+    }
+
+    for column in ("name", "phone_number", "polling_station_number"):
+        if not agent[column]:
+            return False, f"missing {column}"
+
+    if not agent["password"]:
+        agent["password"] = secrets.token_urlsafe(9)
+        agent["generated_password"] = True
+
+    return True, agent
+
+
+def _import_agent_chunk(chunk, report, collation_centre = None):
+    """
+    Creates a chunk of polling agents in a single transaction
+
+    Stations, occupied stations and taken phone numbers are each resolved
+    with one query for the whole chunk
+    """
+    numbers = {agent["polling_station_number"] for line, agent in chunk}
+    phone_numbers = {agent["phone_number"] for line, agent in chunk}
+
+    stations = {polling_station.number : polling_station for polling_station in Polling_Station.query.filter(
+        Polling_Station.number.in_(numbers)
+    ).all()}
+    station_ids = {number : polling_station.id for number, polling_station in stations.items()}
+    occupied = {station_id for station_id, in db.session.query(Polling_Agent.polling_station_id).filter(
+        Polling_Agent.polling_station_id.in_(station_ids.values())
+    ).all()}
+    taken = {phone_number for phone_number, in db.session.query(Polling_Agent.phone_number).filter(
+        Polling_Agent.phone_number.in_(phone_numbers)
+    ).all()}
+
+    accepted = []
+    for line, agent in chunk:
+        station_id = station_ids.get(agent["polling_station_number"])
+
+        if station_id is None:
+            error = "Polling station does not exists"
+        elif collation_centre is not None and not collation_centre.covers(stations[agent["polling_station_number"]]):
+            error = "Polling station is not in the area of this collation centre"
+        elif station_id in occupied:
+            error = "Polling station occupied"
+        elif agent["phone_number"] in taken:
+            error = "Polling Agent already exists"
+        else:
+            error = None
+            occupied.add(station_id)
+            taken.add(agent["phone_number"])
+            accepted.append((line, agent, station_id))
+
+        if error:
+            report["rejected"] += 1
+            report["results"].append({"row" : line, "status" : "rejected", "error" : error})
+
+    if not accepted:
+        return
+
+    digests = hash_secrets(*[agent["password"] for line, agent, station_id in accepted])
+    totp_keys = [gen_totp_key() for _ in accepted]
+
+    polling_agents = [
+        Polling_Agent(name = agent["name"],
+                      phone_number = agent["phone_number"],
+                      password_digest = digest,
+                      polling_station_id = station_id,
+                      totp_key = totp_key)
+        for (line, agent, station_id), digest, totp_key in zip(accepted, digests, totp_keys)
+    ]
+
+    db.session.add_all(polling_agents)
+    try:
+        db.session.flush()
+
+        # signed session tokens embed the polling agent id, known only now
+        if signed_tokens_enabled():
+            for polling_agent in polling_agents:
+                polling_agent.renew_session()
+
+        # read before commit, which would expire and reload every agent
+        sessions = [(polling_agent.id, polling_agent.session_token) for polling_agent in polling_agents]
+        db.session.commit()
+    except exc.IntegrityError:
+        db.session.rollback()
+        for line, agent, station_id in accepted:
+            report["rejected"] += 1
+            report["results"].append({"row" : line, "status" : "rejected", "error" : "Polling Agent already exists"})
+        return
+
+    # station listings include the polling agents
+    invalidate_results()
+
+    for (line, agent, station_id), (polling_agent_id, session_token), totp_key in zip(accepted, sessions, totp_keys):
+        provisioning.provision_polling_agent(polling_agent_id, agent["name"], totp_key, station_id)
+
+        # like /pollingagent/, the session token lets the agent fetch their QR codes
+        res = {"row" : line, "status" : "created", "polling_agent_id" : polling_agent_id, "session_token" : session_token}
+        if agent.get("generated_password"):
+            res["password"] = agent["password"]
+
+        report["created"] += 1
+        report["results"].append(res)
+
+
+def import_polling_agents(records, chunk_size = AGENT_CHUNK_SIZE, collation_centre = None):
+    """
+    Creates polling agents in bulk from (row number, record) pairs
+
+    Records need a name (or firstname and lastname), phone_number and
+    polling_station_number. With a collation centre, only stations in its
+    area are accepted. Returns whether any agent was created and a report
+    with the status of every row
+    """
+    start = time.perf_counter()
+    report = {"rows" : 0, "created" : 0, "rejected" : 0, "results" : []}
+    chunk = []
+
+    for line, record in records:
+        report["rows"] += 1
+        valid, agent = _clean_agent(record)
+
+        if not valid:
+            report["rejected"] += 1
+            report["results"].append({"row" : line, "status" : "rejected", "error" : agent})
+            continue
+
+        chunk.append((line, agent))
+
+        if len(chunk) >= chunk_size:
+            _import_agent_chunk(chunk, report, collation_centre)
+            chunk = []
+
+    if chunk:
+        _import_agent_chunk(chunk, report, collation_centre)
+
+    report["results"].sort(key = lambda res : res["row"])
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    report["rows_per_second"] = round(report["rows"] / report["seconds"]) if report["seconds"] else report["rows"]
+
+    return report["created"] > 0, report
+
+
+def write_agent_manifest(report, directory):
+    """
+    Writes the uri QR code of every polling agent created by an import to
+    directory, with a manifest.csv listing them and their generated passwords,
+    for handing out credentials that outlive the session tokens of the report
+
+    The QR codes carry the TOTP secrets, directory has to be kept private
+    """
+    created = {res["polling_agent_id"] : res for res in report["results"] if res["status"] == "created"}
+    os.makedirs(directory, exist_ok = True)
+
+    with open(os.path.join(directory, "manifest.csv"), "w", newline = "") as manifest:
+        writer = csv.writer(manifest)
+        writer.writerow(("row", "polling_agent_id", "name", "phone_number", "polling_station_id", "password", "qrcode"))
+
+        for polling_agent in Polling_Agent.query.filter(Polling_Agent.id.in_(created)).order_by(Polling_Agent.id):
+            res = created[polling_agent.id]
+            qrcode_file = f"{polling_agent.id}.png"
+            totp_uri = gen_totp_uri(decrypt_totp_key(polling_agent.totp_key_encrypted), polling_agent.name)
+
+            with open(os.path.join(directory, qrcode_file), "wb") as png:
+                png.write(provisioning.gen_qrcode(totp_uri, f"uri-{polling_agent.name}-{polling_agent.polling_station_id}"))
+
+            writer.writerow((res["row"], polling_agent.id, polling_agent.name, polling_agent.phone_number,
+                             polling_agent.polling_station_id, res.get("password", ""), qrcode_file))
+
+    return True, len(created)
+
+
+def import_candidates(records):
+    """
+    Creates or updates candidates from (row number, record) pairs
+
+    Records need a key, the name of the candidate in the data of a result,
+    and may have a name, party and abbreviation. Returns whether any
+    candidate was imported and a report with the status of every row
+    """
+    report = {"rows" : 0, "imported" : 0, "rejected" : 0, "results" : []}
+
+    for line, record in records:
+        report["rows"] += 1
+
+        if not record.get("key"):
+            report["rejected"] += 1
+            report["results"].append({"row" : line, "status" : "rejected", "error" : "missing key"})
+            continue
+
+        success, candidate = create_candidate(record.get("key"),
+                                              record.get("name"),
+                                              record.get("party"),
+                                              record.get("abbreviation"))
+        report["imported"] += 1
+        report["results"].append({"row" : line, "status" : "imported", "candidate_id" : candidate.id})
+
+    return report["imported"] > 0, report
@@ -0,0 +1,195 @@
+"""
+Migrations file
+
+Helper file for bringing databases created by older versions of the app up to date
+"""
+
+import pinksheets
+from blobstore import DIGEST_PATTERN
+from dao import rebuild_tallies
+from db import Candidate
+from db import Polling_Station
+from db import Polling_Station_Result
+from db import db
+from importer import sync_station_hierarchy
+
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import text
+
+# the fixed candidate columns results and tallies had before the candidates table
+LEGACY_CANDIDATES = ("cand1", "cand2", "cand3")
+
+
+
+def migrate_station_hierarchy():
+    """
+    Adds the region and constituency keys and the hierarchy indexes to an
+    existing polling_stations table, then backfills them from the flat names
+    """
+    # creates the regions and constituencies tables if they are missing
+    db.create_all()
+
+    columns = {column["name"] for column in inspect(db.engine).get_columns("polling_stations")}
+
+    with db.engine.begin() as connection:
+        for column, table in (("region_id", "regions"), ("constituency_id", "constituencies")):
+            if column not in columns:
+                connection.execute(text(
+                    f"ALTER TABLE polling_stations ADD COLUMN {column} INTEGER REFERENCES {table} (id)"
+                ))
+
+    for index in Polling_Station.__table__.indexes:
+        index.create(db.engine, checkfirst = True)
+
+    sync_station_hierarchy()
+    return True
+
+
+def migrate_registered_voters():
+    """
+    Adds the registered voters count to an existing polling_stations table,
+    filled in by the next roster import that has it
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("polling_stations")}
+
+    if "registered_voters" in columns:
+        return False
+
+    with db.engine.begin() as connection:
+        connection.execute(text("ALTER TABLE polling_stations ADD COLUMN registered_voters INTEGER"))
+
+    return True
+
+
+def migrate_totp_steps():
+    """
+    Adds the submission TOTP step to an existing polling_agents table, so
+    codes used to log in are no longer replays for submissions
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("polling_agents")}
+
+    if "totp_submit_step" in columns:
+        return False
+
+    with db.engine.begin() as connection:
+        connection.execute(text("ALTER TABLE polling_agents ADD COLUMN totp_submit_step INTEGER"))
+
+    return True
+
+
+def migrate_result_sequence():
+    """
+    Adds the ingest sequence and timestamp to an existing polling_station_results
+    table and numbers the results already in it, in id order
+    """
+    # creates the sequences table if it is missing
+    db.create_all()
+
+    columns = {column["name"] for column in inspect(db.engine).get_columns("polling_station_results")}
+
+    with db.engine.begin() as connection:
+        if "seq" not in columns:
+            connection.execute(text("ALTER TABLE polling_station_results ADD COLUMN seq INTEGER"))
+            connection.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_polling_station_results_seq ON polling_station_results (seq)"
+            ))
+
+        # results stored before this have no timestamp and only show up in ?since=<seq> deltas
+        if "created_at" not in columns:
+            connection.execute(text("ALTER TABLE polling_station_results ADD COLUMN created_at TIMESTAMP"))
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_polling_station_results_created_at ON polling_station_results (created_at)"
+            ))
+
+        last_seq = connection.execute(text("SELECT COALESCE(MAX(seq), 0) FROM polling_station_results")).scalar()
+        ids = connection.execute(text("SELECT id FROM polling_station_results WHERE seq IS NULL ORDER BY id")).scalars().all()
+
+        if ids:
+            connection.execute(
+                text("UPDATE polling_station_results SET seq = :seq WHERE id = :id"),
+                [{"seq" : last_seq + i, "id" : id} for i, id in enumerate(ids, 1)]
+            )
+        last_seq += len(ids)
+
+        # the counter must not hand out a sequence number already taken
+        current = connection.execute(text("SELECT value FROM sequences WHERE name = 'results'")).scalar()
+
+        if current is None:
+            connection.execute(text("INSERT INTO sequences (name, value) VALUES ('results', :value)"), {"value" : last_seq})
+        elif current < last_seq:
+            connection.execute(text("UPDATE sequences SET value = :value WHERE name = 'results'"), {"value" : last_seq})
+
+    return True, len(ids)
+
+
+def migrate_pink_sheets(batch_size = 500):
+    """
+    Moves pink sheets stored inline in results to the pink sheet store,
+    leaving their digest in the row
+    """
+    count = 0
+    after = 0
+
+    while True:
+        polling_station_results = Polling_Station_Result.query.filter(
+            Polling_Station_Result.id > after
+        ).order_by(Polling_Station_Result.id).limit(batch_size).all()
+
+        if not polling_station_results:
+            break
+
+        for polling_station_result in polling_station_results:
+            if not DIGEST_PATTERN.fullmatch(polling_station_result.pink_sheet):
+                success, polling_station_result.pink_sheet = pinksheets.resolve(polling_station_result.pink_sheet)
+                count += 1
+
+        db.session.commit()
+        after = polling_station_results[-1].id
+
+    return True, count
+
+
+def migrate_candidate_votes():
+    """
+    Moves the votes in the fixed cand1, cand2 and cand3 columns of an existing
+    database to polling station votes of candidates with those keys, drops the
+    columns from the results and tallies tables, then rebuilds the tallies
+    """
+    # creates the parties, candidates and votes tables if they are missing
+    db.create_all()
+
+    columns = {column["name"] for column in inspect(db.engine).get_columns("polling_station_results")}
+    legacy = [key for key in LEGACY_CANDIDATES if key in columns]
+    count = 0
+
+    for key in legacy:
+        if Candidate.query.filter(Candidate.key == key).first() is None:
+            db.session.add(Candidate(key = key))
+    db.session.commit()
+
+    candidate_ids = dict(db.session.execute(select(Candidate.key, Candidate.id)).all())
+
+    with db.engine.begin() as connection:
+        for key in legacy:
+            connection.execute(text(
+                f"INSERT INTO polling_station_votes (polling_station_id, candidate_id, votes) "
+                f"SELECT polling_station_id, :candidate_id, {key} FROM polling_station_results AS results "
+                f"WHERE NOT EXISTS (SELECT 1 FROM polling_station_votes AS votes "
+                f"WHERE votes.polling_station_id = results.polling_station_id AND votes.candidate_id = :candidate_id)"
+            ), {"candidate_id" : candidate_ids[key]})
+
+        if legacy:
+            count = connection.execute(text("SELECT COUNT(*) FROM polling_station_results")).scalar()
+
+        for key in legacy:
+            connection.execute(text(f"ALTER TABLE polling_station_results DROP COLUMN {key}"))
+
+        tally_columns = {column["name"] for column in inspect(connection).get_columns("tallies")}
+        for key in LEGACY_CANDIDATES:
+            if key in tally_columns:
+                connection.execute(text(f"ALTER TABLE tallies DROP COLUMN {key}"))
+
+    # tally votes are only kept from here on
+    rebuild_tallies()
+    return True, count
@@ -0,0 +1,209 @@
+"""
+Pink sheets file
+
+Scanned pink sheets are kept in a content-addressed store on disk and
+results only hold their digest. Thumbnails are rendered on a background pool
+"""
+
+import base64
+import binascii
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from functools import partial
+
+from blobstore import BlobStore
+from blobstore import BlobTooLarge
+from blobstore import DIGEST_PATTERN
+from dotenv import load_dotenv
+from PIL import Image
+load_dotenv()
+
+PINK_SHEET_STORE_DIR = os.environ.get("PINK_SHEET_STORE_DIR", "pinksheets")
+PINK_SHEET_MAX_BYTES = int(os.environ.get("PINK_SHEET_MAX_BYTES", 20 * 1024 * 1024))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_TIMEOUT = 10
+
+# leading bytes of the image types accepted as pink sheets
+IMAGE_TYPES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png")
+)
+
+
+_executor = ThreadPoolExecutor(max_workers = THUMBNAIL_WORKERS, thread_name_prefix = "thumbnail")
+_store = BlobStore(PINK_SHEET_STORE_DIR)
+_thumbnails = BlobStore(os.path.join(PINK_SHEET_STORE_DIR, "thumbnails"), ".jpg")
+_lock = threading.Lock()
+
+# digest -> future of a thumbnail still rendering, dropped once done
+_jobs = {}
+_rendered = {"rendered" : 0, "failed" : 0}
+
+
+
+def sniff_mimetype(head):
+    """
+    Returns the mimetype of an image from its leading bytes, or None
+    """
+    for magic, mimetype in IMAGE_TYPES:
+        if head.startswith(magic):
+            return mimetype
+    return None
+
+
+def get_mimetype(digest):
+    with open(_store.path(digest), "rb") as pink_sheet:
+        return sniff_mimetype(pink_sheet.read(16))
+
+
+def _read_head(stream, size = 16):
+    """
+    Returns the first size bytes of stream, fewer if it ends before
+    """
+    head = b""
+
+    while len(head) < size:
+        chunk = stream.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+
+    return head
+
+
+def store_upload(stream):
+    """
+    Stores an uploaded pink sheet from a stream, never holding it in memory,
+    and queues its thumbnail
+
+    Returns whether it is an accepted image and its digest, or an error message
+    """
+    # sniffed before anything is written, so rejected uploads are never stored
+    head = _read_head(stream)
+
+    if sniff_mimetype(head) is None:
+        return False, "Pink sheet must be a jpeg or png image"
+
+    try:
+        digest, size = _store.store_stream(stream, max_size = PINK_SHEET_MAX_BYTES, head = head)
+    except BlobTooLarge:
+        return False, "Pink sheet too large"
+
+    _submit_thumbnail(digest)
+    return True, digest
+
+
+def resolve(pink_sheet):
+    """
+    Returns the digest a submitted pink sheet value stands for
+
+    Values are the digest of an uploaded pink sheet. Older clients send the
+    pink sheet itself, base64 encoded or as text, which is stored here so the
+    result row only holds its digest
+    """
+    if not pink_sheet or not isinstance(pink_sheet, str):
+        return False, None
+
+    if DIGEST_PATTERN.fullmatch(pink_sheet):
+        return _store.exists(pink_sheet), pink_sheet
+
+    try:
+        blob = base64.b64decode(pink_sheet, validate = True)
+    except (binascii.Error, ValueError):
+        blob = pink_sheet.encode("utf8")
+
+    digest = _store.store(blob)
+    if sniff_mimetype(blob[:16]):
+        _submit_thumbnail(digest)
+
+    return True, digest
+
+
+def exists(digest):
+    return _store.exists(digest)
+
+
+def path(digest):
+    return _store.path(digest)
+
+
+##### THUMBNAILS #####
+def _render_thumbnail(digest):
+    """
+    Renders and stores the thumbnail of a pink sheet
+    """
+    with Image.open(_store.path(digest)) as image:
+        # jpeg decoding at a reduced scale is much faster than a full decode
+        image.draft("RGB", THUMBNAIL_SIZE)
+        image = image.convert("RGB")
+        image.thumbnail(THUMBNAIL_SIZE)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format = "JPEG", quality = 80)
+
+    _thumbnails.store_as(digest, buffer.getvalue())
+    return digest
+
+
+def _forget(digest, future):
+    with _lock:
+        if _jobs.get(digest) is future:
+            del _jobs[digest]
+
+        _rendered["failed" if future.exception() is not None else "rendered"] += 1
+
+
+def _submit_thumbnail(digest):
+    """
+    Returns the job rendering a pink sheet's thumbnail, queueing it if there is none
+    """
+    with _lock:
+        future = _jobs.get(digest)
+
+        if future is not None:
+            return future
+
+        future = _executor.submit(_render_thumbnail, digest)
+        _jobs[digest] = future
+
+    # outside the lock, the callback runs right away if the job is already done.
+    # Failed jobs are forgotten too, so they are retried
+    future.add_done_callback(partial(_forget, digest))
+    return future
+
+
+def thumbnail_path(digest, timeout = THUMBNAIL_TIMEOUT):
+    """
+    Returns whether a pink sheet has a thumbnail, and its path and mimetype,
+    waiting for it to be rendered
+
+    Thumbnails lost in a restart are rendered again on demand. Images too large
+    to decode safely get the pink sheet itself instead of a thumbnail
+    """
+    if not _store.exists(digest):
+        return False, None
+
+    if not _thumbnails.exists(digest):
+        try:
+            _submit_thumbnail(digest).result(timeout = timeout)
+        except Image.DecompressionBombError:
+            return True, (_store.path(digest), get_mimetype(digest))
+        except (OSError, FuturesTimeoutError):
+            # not an image, or still rendering
+            return False, None
+
+    return True, (_thumbnails.path(digest), "image/jpeg")
+
+
+def metrics():
+    """
+    Returns the thumbnail queue metrics
+    """
+    with _lock:
+        res = dict(_rendered, workers = THUMBNAIL_WORKERS, pending = len(_jobs))
+
+    return res
@@ -0,0 +1,140 @@
+"""
+Provisioning file
+
+Helper file rendering polling agent TOTP QR codes on a background pool. Both
+codes carry the TOTP secret, so they are only kept in a bounded in-memory cache
+and rendered again from the encrypted secret once evicted
+"""
+
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import qrcode
+from cache import LRUCache
+from dotenv import load_dotenv
+from PIL import ImageDraw, ImageFont
+from totp import gen_totp_uri
+load_dotenv()
+
+QR_WORKERS = int(os.environ.get("QR_WORKERS", 4))
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", 1000))
+QR_CACHE_TTL = int(os.environ.get("QR_CACHE_TTL", 900))
+QR_TIMEOUT = 10
+QR_KINDS = ("uri", "key")
+
+
+_executor = ThreadPoolExecutor(max_workers = QR_WORKERS, thread_name_prefix = "qrcode")
+_lock = threading.Lock()
+
+# (polling_agent_id, kind) -> png bytes
+qrcodes = LRUCache(maxsize = QR_CACHE_SIZE, ttl = QR_CACHE_TTL)
+
+# (polling_agent_id, kind) -> future of a render still running, dropped once done
+_jobs = {}
+
+
+
+def gen_qrcode(data, title):
+    """
+    Returns a QR code of data with title written above it, as png bytes
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+
+
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    font = ImageFont.load_default()
+    draw = ImageDraw.Draw(img)
+    text_width = font.getlength(title)
+    x = (img.size[0] - text_width) // 2
+    y = img.size[1]//25
+    draw.text((x, y), title, font=font, fill="black")
+
+    buffer = io.BytesIO()
+    img.save(buffer, format = "PNG")
+    return buffer.getvalue()
+
+
+def _render(key, data, title):
+    png = gen_qrcode(data, title)
+    qrcodes.set(key, png)
+    return png
+
+
+def _forget(key, future):
+    with _lock:
+        if _jobs.get(key) is future:
+            del _jobs[key]
+
+
+def _submit(polling_agent_id, kind, name, totp_key, polling_station_id):
+    """
+    Returns the job rendering a polling agent's QR code, queueing it if there is none
+    """
+    key = (polling_agent_id, kind)
+
+    with _lock:
+        future = _jobs.get(key)
+
+        if future is not None:
+            return future
+
+        data = gen_totp_uri(totp_key, name) if kind == "uri" else totp_key
+        future = _executor.submit(_render, key, data, f"{kind}-{name}-{polling_station_id}")
+        _jobs[key] = future
+
+    # outside the lock, the callback runs right away if the job is already done.
+    # Failed jobs are forgotten too, so they are retried
+    future.add_done_callback(partial(_forget, key))
+    return future
+
+
+def provision_polling_agent(polling_agent_id, name, totp_key, polling_station_id):
+    """
+    Queues rendering of both QR codes of a polling agent and returns immediately
+    """
+    for kind in QR_KINDS:
+        _submit(polling_agent_id, kind, name, totp_key, polling_station_id)
+
+
+def get_qrcode(polling_agent_id, kind, name, totp_key, polling_station_id, timeout = QR_TIMEOUT):
+    """
+    Returns a polling agent's QR code as png bytes, waiting for it to be rendered
+
+    QR codes evicted from the cache or lost in a restart are rendered again
+    """
+    if kind not in QR_KINDS:
+        return False, None
+
+    png = qrcodes.get((polling_agent_id, kind))
+
+    if png is None:
+        png = _submit(polling_agent_id, kind, name, totp_key, polling_station_id).result(timeout = timeout)
+
+    return True, png
+
+
+def metrics():
+    """
+    Returns the provisioning queue and cache metrics
+    """
+    with _lock:
+        pending = len(_jobs)
+
+    res = {
+        "workers" : QR_WORKERS,
+        "pending" : pending
+    }
+    res.update(qrcodes.metrics())
+    return res
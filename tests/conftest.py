@@ -0,0 +1,37 @@
+"""
+Test fixtures
+
+The modules of the app live at the top of the repository and read their
+settings from the environment when imported, so both are set up first
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix = "collation-tests-")
+
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("TOTP_KEY_FILE", os.path.join(STATE_DIR, "totp.key"))
+os.environ.setdefault("SESSION_KEY_FILE", os.path.join(STATE_DIR, "session.key"))
+os.environ.setdefault("SMS_QUEUE_PATH", os.path.join(STATE_DIR, "sms_queue.db"))
+os.environ.setdefault("PINK_SHEET_STORE_DIR", os.path.join(STATE_DIR, "pinksheets"))
+os.environ.setdefault("SMS_PROVIDER", "fake")
+
+import pytest
+
+
+
+@pytest.fixture
+def app(tmp_path):
+    """
+    Returns an app on a fresh SQLite database
+    """
+    from app import create_app
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI" : f"sqlite:///{tmp_path / 'collation.db'}"})
+
+    with app.app_context():
+        yield app
@@ -0,0 +1,111 @@
+"""
+Tests that the station listings load with a fixed number of statements,
+however many stations they cover
+"""
+
+import pytest
+from sqlalchemy import event
+
+import dao
+from db import Candidate
+from db import Polling_Agent
+from db import Polling_Station
+from db import Polling_Station_Result
+from db import Polling_Station_Vote
+from db import db
+
+
+
+def seed(stations):
+    """
+    Creates stations in one constituency, each with an agent and a result
+    """
+    candidates = [Candidate(key = key) for key in ("cand1", "cand2")]
+    db.session.add_all(candidates)
+
+    for i in range(stations):
+        db.session.add(Polling_Station(name = f"station {i}", number = str(i), constituency = "constituency", region = "region"))
+    db.session.flush()
+
+    for polling_station in Polling_Station.query.all():
+        polling_agent = Polling_Agent(name = f"agent {polling_station.id}",
+                                      phone_number = str(polling_station.id),
+                                      password_digest = f"digest {polling_station.id}",
+                                      polling_station_id = polling_station.id,
+                                      totp_key = "JBSWY3DPEHPK3PXP")
+        db.session.add(polling_agent)
+        db.session.flush()
+
+        db.session.add(Polling_Station_Result(
+            total_valid_ballots = 30,
+            total_rejected_ballots = 1,
+            total_votes_cast = 31,
+            pink_sheet = f"pink sheet {polling_station.id}",
+            polling_agent_id = polling_agent.id,
+            polling_station_id = polling_station.id,
+            candidate_votes = [Polling_Station_Vote(polling_station_id = polling_station.id,
+                                                    candidate_id = candidate.id,
+                                                    votes = 15)
+                               for candidate in candidates]
+        ))
+
+    db.session.commit()
+
+    # listings must not be served from objects loaded while seeding
+    db.session.expunge_all()
+
+
+def count_statements(listing, *args, **kwargs):
+    """
+    Returns the listing and the number of statements it ran
+    """
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        success, res = listing(*args, **kwargs)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    db.session.expunge_all()
+    return res, len(statements)
+
+
+def reset():
+    for model in (Polling_Station_Vote, Polling_Station_Result, Polling_Agent, Polling_Station, Candidate):
+        db.session.query(model).delete()
+    db.session.commit()
+
+
+@pytest.mark.parametrize("listing, args", [
+    (dao.get_all_results, ()),
+    (dao.get_result_by_constituency, ("constituency",)),
+    (dao.get_result_by_region, ("region",))
+])
+def test_listing_statements_do_not_grow_with_stations(app, listing, args):
+    counts = []
+
+    for stations in (10, 200):
+        reset()
+        seed(stations)
+        res, count = count_statements(listing, *args)
+
+        assert len(res) == stations
+        assert all(station["polling_agent"] and station["polling_station_result"] for station in res)
+        assert res[0]["polling_station_result"][0]["data"] == {"cand1" : 15, "cand2" : 15}
+        counts.append(count)
+
+    # stations with their agents and results, then the candidate votes of
+    # the results reached through the station and through the agent
+    assert counts == [3, 3]
+
+
+def test_lazy_listing_grows_with_stations(app):
+    seed(10)
+    res, count = count_statements(dao.get_all_results, eager_load = False)
+
+    # what the eager loading saves, at least one lazy load per station
+    assert count > 10
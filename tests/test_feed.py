@@ -0,0 +1,41 @@
+"""
+Tests of the results feed client slots
+"""
+
+import pytest
+
+import feed
+
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(feed, "FEED_LIMITS", {"stream" : 2, "poll" : 1})
+    monkeypatch.setattr(feed, "_clients", {"stream" : 0, "poll" : 0})
+    monkeypatch.setattr(feed, "_rejected", {"stream" : 0, "poll" : 0})
+    monkeypatch.setattr(feed, "_poller", {"pid" : None})
+    monkeypatch.setattr(feed, "FEED_POLL_SECONDS", 3600)
+
+
+def test_streams_and_polls_have_their_own_slots(limits):
+    last_seq = lambda: 0
+
+    assert feed.connect(last_seq, "poll")
+    assert not feed.connect(last_seq, "poll")
+
+    # full long polls leave the streams alone
+    assert feed.connect(last_seq, "stream")
+    assert feed.connect(last_seq, "stream")
+    assert not feed.connect(last_seq, "stream")
+
+    feed.disconnect("poll")
+    assert feed.connect(last_seq, "poll")
+
+    metrics = feed.metrics()
+    assert (metrics["streams"], metrics["polls"]) == (2, 1)
+    assert (metrics["rejected_streams"], metrics["rejected_polls"]) == (1, 1)
+
+
+def test_default_limits_leave_reserved_threads():
+    assert feed.FEED_MAX_STREAMS + feed.FEED_MAX_POLLS <= feed.WORKER_THREADS - feed.FEED_RESERVED_THREADS
+    assert feed.FEED_MAX_STREAMS > feed.FEED_MAX_POLLS > 0
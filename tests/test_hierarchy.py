@@ -0,0 +1,83 @@
+"""
+Tests of the normalized region and constituency keys of polling stations
+"""
+
+import sqlite3
+
+from sqlalchemy import inspect
+
+from db import Constituency
+from db import Polling_Station
+from db import Region
+from db import db
+from importer import import_polling_stations
+from migrations import migrate_station_hierarchy
+
+STATIONS = [
+    ("station 1", "1", "constituency", "region"),
+    ("station 2", "2", "constituency", "region"),
+    ("station 3", "3", "constituency", "other region")
+]
+
+
+
+def assert_keys_match_names():
+    stations = Polling_Station.query.all()
+    constituencies = {constituency.id : constituency for constituency in Constituency.query.all()}
+    regions = {region.id : region.name for region in Region.query.all()}
+
+    assert len(stations) == len(STATIONS)
+    assert sorted(regions.values()) == ["other region", "region"]
+
+    # the same constituency name in two regions is two constituencies
+    assert len(constituencies) == 2
+
+    for polling_station in stations:
+        constituency = constituencies[polling_station.constituency_id]
+
+        assert regions[polling_station.region_id] == polling_station.region
+        assert constituency.name == polling_station.constituency
+        assert constituency.region_id == polling_station.region_id
+
+
+def test_import_fills_region_and_constituency_keys(app, tmp_path):
+    roster = tmp_path / "stations.csv"
+    roster.write_text("name,number,constituency,region\n" + "".join(",".join(station) + "\n" for station in STATIONS))
+
+    success, stats = import_polling_stations(str(roster))
+
+    assert success
+    assert_keys_match_names()
+
+    # a station moved to another region on re-import follows it
+    roster.write_text("name,number,constituency,region\nstation 1,1,constituency,other region\n")
+    import_polling_stations(str(roster))
+
+    polling_station = Polling_Station.query.filter(Polling_Station.number == "1").one()
+    assert db.session.get(Region, polling_station.region_id).name == "other region"
+
+
+def test_migration_backfills_flat_stations(tmp_path):
+    from app import create_app
+
+    path = tmp_path / "legacy.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE polling_stations (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+                       "number VARCHAR NOT NULL UNIQUE, constituency VARCHAR NOT NULL, region VARCHAR NOT NULL, "
+                       "registered_voters INTEGER)")
+    connection.executemany("INSERT INTO polling_stations (name, number, constituency, region) VALUES (?, ?, ?, ?)", STATIONS)
+    connection.commit()
+    connection.close()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI" : f"sqlite:///{path}"})
+
+    with app.app_context():
+        assert migrate_station_hierarchy()
+
+        indexes = {index["name"] for index in inspect(db.engine).get_indexes("polling_stations")}
+        assert "ix_polling_stations_hierarchy" in indexes
+        assert_keys_match_names()
+
+        # running it again changes nothing
+        assert migrate_station_hierarchy()
+        assert_keys_match_names()
@@ -0,0 +1,53 @@
+"""
+Tests of the bulk polling agent endpoint
+"""
+
+import json
+
+import dao
+from db import Polling_Agent
+from db import Polling_Station
+from db import db
+
+
+
+def seed():
+    db.session.add_all([
+        Polling_Station(name = "station 1", number = "1", constituency = "constituency", region = "region"),
+        Polling_Station(name = "station 2", number = "2", constituency = "constituency", region = "other region")
+    ])
+    db.session.commit()
+
+    success, (collation_centre, key) = dao.create_collation_centre("centre", "region")
+    return key
+
+
+def post_agents(app, agents, key = None):
+    headers = {"Authorization" : f"Bearer {key}"} if key else {}
+    return app.test_client().post("/createpollingagents/", data = json.dumps({"agents" : agents}), headers = headers)
+
+
+AGENTS = [
+    {"name" : "agent 1", "phone_number" : "0200000001", "polling_station_number" : "1"},
+    {"name" : "agent 2", "phone_number" : "0200000002", "polling_station_number" : "2"}
+]
+
+
+def test_requires_collation_centre_key(app):
+    seed()
+
+    assert post_agents(app, AGENTS).status_code == 401
+    assert post_agents(app, AGENTS, key = "not a key").status_code == 401
+    assert Polling_Agent.query.count() == 0
+
+
+def test_creates_agents_in_the_collation_centre_area_only(app):
+    key = seed()
+    response = post_agents(app, AGENTS, key = key)
+    results = json.loads(response.data)["results"]
+
+    assert response.status_code == 201
+    assert results[0]["status"] == "created"
+    assert results[0]["session_token"]
+    assert results[1] == {"row" : 2, "status" : "rejected", "error" : "Polling station is not in the area of this collation centre"}
+    assert [polling_agent.name for polling_agent in Polling_Agent.query.all()] == ["agent 1"]
@@ -0,0 +1,73 @@
+"""
+Tests of the pink sheet store and its thumbnails
+"""
+
+import io
+import os
+import time
+
+from PIL import Image
+
+import pinksheets
+
+
+
+def png(size = (64, 48)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "pink").save(buffer, format = "PNG")
+    return buffer.getvalue()
+
+
+def stored_files():
+    return {os.path.join(root, name) for root, dirs, names in os.walk(pinksheets.PINK_SHEET_STORE_DIR) for name in names}
+
+
+def forgotten(digest):
+    """
+    Returns whether the render job of digest was dropped, once its callback ran
+    """
+    deadline = time.time() + 5
+    while digest in pinksheets._jobs and time.time() < deadline:
+        time.sleep(0.01)
+
+    return digest not in pinksheets._jobs
+
+
+def test_stores_image_and_forgets_its_thumbnail_job():
+    success, digest = pinksheets.store_upload(io.BytesIO(png()))
+
+    assert success
+    assert pinksheets.exists(digest)
+
+    success, (path, mimetype) = pinksheets.thumbnail_path(digest)
+
+    assert success
+    assert mimetype == "image/jpeg"
+    assert os.path.exists(path)
+    assert forgotten(digest)
+
+
+def test_rejected_upload_is_not_stored():
+    blob = b"not an image, " * 10
+    stored = stored_files()
+
+    assert pinksheets.store_upload(io.BytesIO(blob)) == (False, "Pink sheet must be a jpeg or png image")
+    assert stored_files() == stored
+
+
+def test_decompression_bomb_serves_the_pink_sheet(monkeypatch):
+    blob = png((300, 300))
+    success, digest = pinksheets.store_upload(io.BytesIO(blob))
+    assert success
+
+    # the upload queued a render before the limit was lowered
+    pinksheets.thumbnail_path(digest)
+    assert forgotten(digest)
+    os.remove(pinksheets._thumbnails.path(digest))
+
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    success, (path, mimetype) = pinksheets.thumbnail_path(digest)
+
+    assert success
+    assert (path, mimetype) == (pinksheets.path(digest), "image/png")
+    assert forgotten(digest)
@@ -0,0 +1,54 @@
+"""
+Tests of the sequence and paging arguments of the results endpoints
+"""
+
+import json
+
+import pytest
+
+
+
+@pytest.mark.parametrize("query", [
+    "since=abc",
+    "since=-1",
+    "since=0&limit=abc",
+    "after=-5",
+    "after=abc",
+    "after=0&limit=0"
+])
+def test_rejects_invalid_sequence_and_paging(app, query):
+    response = app.test_client().get(f"/sendallresults/?{query}")
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query", ["since=0", "after=0&limit=10"])
+def test_accepts_valid_sequence_and_paging(app, query):
+    response = app.test_client().get(f"/sendallresults/?{query}")
+
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("since", ["abc", "-3"])
+def test_feed_poll_rejects_invalid_since(app, since):
+    response = app.test_client().get(f"/resultsfeed/poll/?since={since}&timeout=0")
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query, headers", [
+    ("?since=abc", {}),
+    ("?since=-3", {}),
+    ("", {"Last-Event-ID" : "abc"})
+])
+def test_feed_stream_rejects_invalid_since(app, query, headers):
+    response = app.test_client().get(f"/resultsfeed/{query}", headers = headers)
+
+    assert response.status_code == 400
+
+
+def test_feed_poll_returns_events_after_since(app):
+    response = app.test_client().get("/resultsfeed/poll/?since=0&timeout=0")
+
+    assert response.status_code == 200
+    assert json.loads(response.data) == {"last_seq" : 0, "events" : []}
@@ -0,0 +1,142 @@
+"""
+Tests of the SMS queue, sent through the fake provider
+"""
+
+import threading
+import time
+
+import pytest
+
+import twilioapp
+
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch):
+    """
+    Returns a fake provider sending from a fresh queue, with no rate limit
+    """
+    provider = twilioapp.FakeProvider()
+
+    monkeypatch.setattr(twilioapp, "SMS_QUEUE_PATH", str(tmp_path / "sms_queue.db"))
+    monkeypatch.setattr(twilioapp, "SMS_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(twilioapp, "_provider", provider)
+    monkeypatch.setattr(twilioapp, "_rate_limiter", twilioapp._RateLimiter(1000))
+    monkeypatch.setattr(twilioapp, "_local", threading.local())
+    return provider
+
+
+def send_due():
+    """
+    Sends the messages due now, as a worker would
+    """
+    connection = twilioapp._thread_connection()
+    rows = twilioapp._claim_batch(connection)
+    twilioapp._send_batch(connection, rows)
+    return len(rows)
+
+
+def message(dest):
+    return twilioapp._thread_connection().execute(
+        "SELECT status, attempts, next_attempt_at, last_error FROM messages WHERE dest = ?", (dest,)
+    ).fetchone()
+
+
+def make_due(dest):
+    twilioapp._thread_connection().execute("UPDATE messages SET next_attempt_at = 0 WHERE dest = ?", (dest,))
+
+
+def test_sends_queued_message(provider):
+    twilioapp.sendmessage("+233200000001", "123456")
+
+    assert send_due() == 1
+    assert provider.sent == [("+233200000001", "123456")]
+    assert message("+233200000001")[:2] == ("sent", 1)
+
+
+def test_retries_with_backoff(provider):
+    twilioapp.sendmessage("+233200000002", "123456")
+    provider.fail_next = 1
+
+    before = time.time()
+    send_due()
+    status, attempts, next_attempt_at, last_error = message("+233200000002")
+
+    assert (status, attempts, last_error) == ("pending", 1, "fake provider failure")
+    assert next_attempt_at >= before + twilioapp.SMS_RETRY_BASE_SECONDS * 2
+    assert provider.sent == []
+
+    # not due again until the backoff is over
+    assert send_due() == 0
+
+    make_due("+233200000002")
+    assert send_due() == 1
+    assert provider.sent == [("+233200000002", "123456")]
+    assert message("+233200000002")[:2] == ("sent", 2)
+
+
+def test_backoff_doubles(provider):
+    twilioapp.sendmessage("+233200000003", "123456")
+    provider.fail_next = 2
+
+    send_due()
+    first_delay = message("+233200000003")[2] - time.time()
+    make_due("+233200000003")
+    send_due()
+    second_delay = message("+233200000003")[2] - time.time()
+
+    assert second_delay == pytest.approx(2 * first_delay, abs = 0.5)
+
+
+def test_fails_after_max_attempts(provider):
+    twilioapp.sendmessage("+233200000004", "123456")
+    provider.fail_next = twilioapp.SMS_MAX_ATTEMPTS
+
+    for attempt in range(twilioapp.SMS_MAX_ATTEMPTS):
+        make_due("+233200000004")
+        assert send_due() == 1
+
+    assert message("+233200000004")[:2] == ("failed", twilioapp.SMS_MAX_ATTEMPTS)
+
+    # failed messages are not sent again
+    make_due("+233200000004")
+    assert send_due() == 0
+    assert provider.sent == []
+
+
+def test_workers_send_messages_queued_before_start(provider, monkeypatch):
+    monkeypatch.setattr(twilioapp, "_workers_pid", None)
+    monkeypatch.setattr(twilioapp, "SMS_WORKERS", 1)
+    twilioapp.sendmessage("+233200000005", "123456")
+
+    twilioapp.start_workers()
+
+    deadline = time.time() + 5
+    while not provider.sent and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert provider.sent == [("+233200000005", "123456")]
+
+
+def test_worker_survives_provider_errors(provider, monkeypatch, caplog):
+    def get_provider():
+        if not failures:
+            failures.append(True)
+            raise RuntimeError("provider not configured")
+        return provider
+
+    failures = []
+    monkeypatch.setattr(twilioapp, "_workers_pid", None)
+    monkeypatch.setattr(twilioapp, "SMS_WORKERS", 1)
+    monkeypatch.setattr(twilioapp, "SMS_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(twilioapp, "get_provider", get_provider)
+    twilioapp.sendmessage("+233200000006", "123456")
+
+    twilioapp.start_workers()
+
+    deadline = time.time() + 5
+    while not provider.sent and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert provider.sent == [("+233200000006", "123456")]
+    assert "provider not configured" in caplog.text
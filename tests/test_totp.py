@@ -0,0 +1,44 @@
+"""
+Tests of TOTP verification for polling agents
+"""
+
+import pyotp
+
+import dao
+from db import Polling_Agent
+from db import Polling_Station
+from db import db
+from totp import TOTP_INTERVAL
+
+TOTP_KEY = "JBSWY3DPEHPK3PXP"
+
+
+
+def create_agent():
+    polling_station = Polling_Station(name = "station", number = "1", constituency = "constituency", region = "region")
+    db.session.add(polling_station)
+    db.session.flush()
+
+    polling_agent = Polling_Agent(name = "agent", phone_number = "1", password_digest = "digest",
+                                  polling_station_id = polling_station.id, totp_key = TOTP_KEY)
+    db.session.add(polling_agent)
+    db.session.commit()
+    return polling_agent.id
+
+
+def test_verify_sms_code_accepts_each_code_once(app):
+    polling_agent_id = create_agent()
+    code = pyotp.TOTP(TOTP_KEY, interval = TOTP_INTERVAL).now()
+
+    success, polling_agent = dao.verify_sms_code(code, polling_agent_id)
+    assert success
+    assert polling_agent.id == polling_agent_id
+
+    assert dao.verify_sms_code(code, polling_agent_id) == (False, "Auto password already used, wait for the next one")
+
+
+def test_verify_sms_code_rejects_wrong_code_and_unknown_agent(app):
+    polling_agent_id = create_agent()
+
+    assert dao.verify_sms_code("000000", polling_agent_id)[0] is False
+    assert dao.verify_sms_code("000000", polling_agent_id + 1) == (False, "Polling agent does not exists")
@@ -0,0 +1,108 @@
+"""
+Tokens file
+
+Helper file for signed session tokens, which carry the polling agent id,
+polling station id and expiration so they can be verified without the database
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import os
+import secrets
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# opaque tokens are looked up in the database, signed tokens are verified by signature
+SESSION_TOKEN_MODE = os.environ.get("SESSION_TOKEN_MODE", "opaque")
+
+# only used when SESSION_SECRET_KEY is not set, e.g. in development
+SESSION_KEY_FILE = os.environ.get("SESSION_KEY_FILE", "session.key")
+
+
+_key = None
+
+
+
+def signed_tokens_enabled():
+    return SESSION_TOKEN_MODE == "signed"
+
+
+def _get_key():
+    """
+    Returns the signing key, from SESSION_SECRET_KEY or the key file
+
+    Every node must share the key to verify each other's tokens
+    """
+    global _key
+
+    if _key is None:
+        key = os.environ.get("SESSION_SECRET_KEY")
+
+        if not key:
+            if not os.path.exists(SESSION_KEY_FILE):
+                with open(SESSION_KEY_FILE, "w") as key_file:
+                    key_file.write(secrets.token_hex(32))
+            with open(SESSION_KEY_FILE) as key_file:
+                key = key_file.read().strip()
+
+        _key = key.encode("utf8")
+
+    return _key
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload):
+    return hmac.new(_get_key(), payload, hashlib.sha256).digest()
+
+
+def sign_session_token(polling_agent_id, polling_station_id, session_expiration):
+    """
+    Returns a signed session token for a polling agent
+    """
+    expires = int(session_expiration.timestamp())
+    payload = f"{polling_agent_id}.{polling_station_id}.{expires}.{secrets.token_hex(8)}".encode("ascii")
+    return _b64encode(payload) + "." + _b64encode(_sign(payload))
+
+
+def read_session_token(session_token):
+    """
+    Returns whether a signed session token is authentic and unexpired, and its claims
+    """
+    try:
+        encoded_payload, encoded_signature = session_token.split(".")
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except ValueError:
+        return False, None
+
+    # nothing in a forged token is parsed
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return False, None
+
+    try:
+        polling_agent_id, polling_station_id, expires, nonce = payload.decode("ascii").split(".")
+        claims = {
+            "polling_agent_id" : int(polling_agent_id),
+            "polling_station_id" : int(polling_station_id),
+            "session_expiration" : datetime.datetime.fromtimestamp(int(expires))
+        }
+    except (ValueError, UnicodeDecodeError, OverflowError, OSError):
+        return False, None
+
+    return datetime.datetime.now() < claims["session_expiration"], claims
+
+
+def token_digest(session_token):
+    """
+    Returns the digest a revoked token is stored under
+    """
+    return hashlib.sha256(session_token.encode("utf8")).hexdigest()
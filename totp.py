@@ -0,0 +1,86 @@
+"""
+TOTP file
+
+Helper file for keeping TOTP secrets encrypted at rest and verifying TOTP codes
+"""
+
+import datetime
+import hmac
+import os
+
+import pyotp
+from cryptography.fernet import Fernet
+from dotenv import load_dotenv
+load_dotenv()
+
+TOTP_INTERVAL = 15
+
+# only used when TOTP_ENCRYPTION_KEY is not set, e.g. in development
+TOTP_KEY_FILE = os.environ.get("TOTP_KEY_FILE", "totp.key")
+
+
+_fernet = None
+
+
+
+def _get_fernet():
+    """
+    Returns the cipher for TOTP secrets, keyed by TOTP_ENCRYPTION_KEY or the key file
+    """
+    global _fernet
+
+    if _fernet is None:
+        key = os.environ.get("TOTP_ENCRYPTION_KEY")
+
+        if not key:
+            if not os.path.exists(TOTP_KEY_FILE):
+                with open(TOTP_KEY_FILE, "wb") as key_file:
+                    key_file.write(Fernet.generate_key())
+            with open(TOTP_KEY_FILE, "rb") as key_file:
+                key = key_file.read().strip()
+
+        _fernet = Fernet(key)
+
+    return _fernet
+
+
+def gen_totp_key():
+    return pyotp.random_base32()
+
+def gen_totp_uri(key, polling_agent_name):
+    return pyotp.totp.TOTP(key, interval= TOTP_INTERVAL).provisioning_uri(name=polling_agent_name, issuer_name="Collation App")
+
+
+def encrypt_totp_key(totp_key):
+    """
+    Returns the encrypted TOTP secret for storage
+    """
+    return _get_fernet().encrypt(totp_key.encode("utf8")).decode("utf8")
+
+
+def decrypt_totp_key(encrypted_totp_key):
+    """
+    Returns the TOTP secret from its stored encrypted form
+    """
+    return _get_fernet().decrypt(encrypted_totp_key.encode("utf8")).decode("utf8")
+
+
+def totp_keys_match(totp_key, encrypted_totp_key):
+    """
+    Returns true if totp_key is the stored secret, in constant time
+    """
+    return hmac.compare_digest(totp_key.encode("utf8"), decrypt_totp_key(encrypted_totp_key).encode("utf8"))
+
+
+def verify_totp_value(totp_key, totp_value):
+    """
+    Verifies a TOTP code for the current time step
+
+    Returns whether the code is valid and its time step, which the caller
+    accepts once, see Polling_Agent.verify_totp
+    """
+    totp = pyotp.TOTP(totp_key, interval= TOTP_INTERVAL)
+    now = datetime.datetime.now()
+    step = totp.timecode(now)
+
+    return hmac.compare_digest(str(totp_value), totp.at(now)), step
@@ -1,21 +1,252 @@
+"""
+SMS file
+
+Outbound SMS go through a persistent local queue and are sent by a pool of
+background workers, so sending never adds latency to an HTTP request
+"""
+
+import logging
 import os
-from twilio.rest import Client
+import sqlite3
+import threading
+import time
+
 from dotenv import load_dotenv
 load_dotenv()
 
+SMS_QUEUE_PATH = os.environ.get("SMS_QUEUE_PATH", "sms_queue.db")
+SMS_PROVIDER = os.environ.get("SMS_PROVIDER", "twilio")   # twilio or fake
+SMS_WORKERS = int(os.environ.get("SMS_WORKERS", 2))
+SMS_BATCH_SIZE = int(os.environ.get("SMS_BATCH_SIZE", 20))
+SMS_RATE_PER_SECOND = float(os.environ.get("SMS_RATE_PER_SECOND", 10))
+SMS_MAX_ATTEMPTS = int(os.environ.get("SMS_MAX_ATTEMPTS", 5))
+SMS_RETRY_BASE_SECONDS = 2
+SMS_POLL_SECONDS = 1
+
+# messages claimed longer ago than this by a worker that died are sent again
+SMS_STALE_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+
+
+class TwilioProvider:
+    """
+    Sends SMS through Twilio with a single client reused by every worker
+    """
+
+    def __init__(self):
+        from twilio.rest import Client
+
+        self.client = Client(os.environ.get('TWILIO_ACCOUNT_SID'), os.environ.get('TWILIO_AUTH_TOKEN'))
+        self.from_ = os.environ.get("TWILIO_PHONE_NUMBER")
+
+    def send(self, dest, body):
+        self.client.messages.create(from_ = self.from_, body = body, to = dest)
+
+
+class FakeProvider:
+    """
+    Keeps SMS in memory instead of sending them, for tests and development
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.fail_next = 0
+
+    def send(self, dest, body):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise RuntimeError("fake provider failure")
+        self.sent.append((dest, body))
+
+
+class _RateLimiter:
+    """
+    Token bucket shared by the workers of a process
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+_provider = None
+_rate_limiter = _RateLimiter(SMS_RATE_PER_SECOND)
+_workers_pid = None
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_local = threading.local()
+
+
+
+def get_provider():
+    """
+    Returns the SMS provider, created once per process
+    """
+    global _provider
+
+    with _lock:
+        if _provider is None:
+            _provider = FakeProvider() if SMS_PROVIDER == "fake" else TwilioProvider()
+        return _provider
+
+
+def _connect():
+    connection = sqlite3.connect(SMS_QUEUE_PATH, timeout = 30, isolation_level = None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dest TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            last_error TEXT
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_messages_due ON messages (status, next_attempt_at)")
+    return connection
+
+
+def _thread_connection():
+    """
+    Returns the queue connection of the calling thread
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.connection = _connect()
+        _local.pid = os.getpid()
+    return _local.connection
+
+
+def _claim_batch(connection):
+    """
+    Marks up to SMS_BATCH_SIZE due messages as sending and returns them
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute(
+            "UPDATE messages SET status = 'pending' WHERE status = 'sending' AND claimed_at < ?",
+            (now - SMS_STALE_SECONDS,)
+        )
+        rows = connection.execute(
+            "SELECT id, dest, body, attempts FROM messages WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (now, SMS_BATCH_SIZE)
+        ).fetchall()
+        connection.executemany(
+            "UPDATE messages SET status = 'sending', claimed_at = ? WHERE id = ?",
+            [(now, row[0]) for row in rows]
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return rows
+
+
+def _send_batch(connection, rows):
+    """
+    Sends a batch of claimed messages, scheduling failed ones for a retry with backoff
+    """
+    provider = get_provider()
+
+    for id, dest, body, attempts in rows:
+        _rate_limiter.wait()
+        try:
+            provider.send(dest, body)
+        except Exception as e:
+            attempts += 1
+            status = "failed" if attempts >= SMS_MAX_ATTEMPTS else "pending"
+            connection.execute(
+                "UPDATE messages SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, time.time() + SMS_RETRY_BASE_SECONDS * 2 ** attempts, str(e), id)
+            )
+            continue
+
+        connection.execute("UPDATE messages SET status = 'sent', attempts = ? WHERE id = ?", (attempts + 1, id))
+
+
+def _work():
+    while True:
+        try:
+            connection = _thread_connection()
+
+            # a provider that cannot be created claims no messages
+            get_provider()
+            rows = _claim_batch(connection)
+
+            if rows:
+                _send_batch(connection, rows)
+                continue
+        except sqlite3.OperationalError:
+            # queue busy, claimed messages go stale and are picked up again
+            pass
+        except Exception:
+            # e.g. a misconfigured provider, the worker keeps draining the queue
+            logger.exception("SMS worker failed to send a batch")
+
+        _wakeup.wait(SMS_POLL_SECONDS)
+        _wakeup.clear()
+
+
+def start_workers():
+    """
+    Starts the SMS workers of this process, once
+    """
+    global _workers_pid
+
+    with _lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+    for i in range(SMS_WORKERS):
+        threading.Thread(target = _work, name = f"sms-{i}", daemon = True).start()
+
+
 def sendmessage(dest, token):
     """
-    Send sms given dest and token
+    Queues an sms with token as its body for dest
+
+    Returns once the message is stored, it is sent in the background by the
+    workers create_app starts
     """
-    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
+    _thread_connection().execute(
+        "INSERT INTO messages (dest, body, next_attempt_at) VALUES (?, ?, ?)",
+        (dest, token, time.time())
+    )
 
-    message = client.messages.create(
-                                from_= os.environ.get("TWILIO_PHONE_NUMBER"),
-                                body= token,
-                                to= dest
-                            )
-    
+    _wakeup.set()
     return True
 
+
+def metrics():
+    """
+    Returns the number of queued messages by status
+    """
+    res = dict(_thread_connection().execute("SELECT status, COUNT(*) FROM messages GROUP BY status").fetchall())
+
+    res.update({
+        "workers" : SMS_WORKERS,
+        "rate_per_second" : SMS_RATE_PER_SECOND
+    })
+    return res
@@ -0,0 +1,207 @@
+"""
+Writer file
+
+Funnels result submissions through a single writer thread per process,
+which commits whatever queued up while it was busy in one transaction.
+Requests never contend with each other for the SQLite write lock, and a
+burst of submissions shares one commit per batch instead of paying one each
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import db
+from flask import current_app
+from histogram import Histogram
+from dotenv import load_dotenv
+load_dotenv()
+
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 64))
+WRITE_TIMEOUT = int(os.environ.get("WRITE_TIMEOUT", 30))
+
+
+
+class _Job:
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class Writer:
+    """
+    Runs write jobs for an app, on its writer thread when enabled and in the
+    calling thread otherwise
+
+    A job is a function that writes to db.session without committing and
+    returns plain values, never models bound to the writer's session. It must
+    do all its checks before its first write: a job that raises is rolled
+    back, its exception is raised to its caller, and the jobs batched with it
+    are run again without it
+    """
+
+    def __init__(self, app, enabled):
+        self.app = app
+        self.enabled = enabled
+        self.queue_wait = Histogram()
+        self.commit_time = Histogram()
+        self.latency = Histogram()
+        self.batch_size = Histogram(bounds = (1, 2, 4, 8, 16, 32, 64, 128, 256))
+        self.replays = 0
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+
+    def _start(self):
+        """
+        Starts the writer thread of this process, once
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target = self._work, name = "writer", daemon = True).start()
+            return self._queue
+
+
+    def run(self, fn, *args):
+        """
+        Runs a write job and returns its result once it is committed
+        """
+        if not self.enabled:
+            return self._run_here(fn, args)
+
+        job = _Job(fn, args)
+        self._start().put(job)
+        return job.future.result(timeout = WRITE_TIMEOUT)
+
+
+    def _run_here(self, fn, args):
+        start = time.perf_counter()
+        try:
+            res = fn(*args)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.latency.record((time.perf_counter() - start) * 1000)
+        return res
+
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                batch = [self._queue.get()]
+
+                # everything that queued up during the last commit goes in this one
+                while len(batch) < WRITE_BATCH_SIZE:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                try:
+                    self._run_batch(batch)
+                except Exception as e:
+                    for job in batch:
+                        if not job.future.done():
+                            job.future.set_exception(e)
+                finally:
+                    db.session.close()
+
+
+    def _run_batch(self, batch):
+        """
+        Runs a batch of jobs in one transaction and commits it
+        """
+        start = time.perf_counter()
+        for job in batch:
+            self.queue_wait.record((start - job.enqueued_at) * 1000)
+        self.batch_size.record(len(batch))
+
+        done = []
+        pending = list(batch)
+
+        while pending:
+            job = pending.pop(0)
+            try:
+                res = job.fn(*job.args)
+                db.session.flush()
+            except Exception as e:
+                db.session.rollback()
+                job.future.set_exception(e)
+
+                # the rollback undid the jobs before it in this transaction too
+                pending = [done_job for done_job, done_res in done] + pending
+                done = []
+                self.replays += 1
+                continue
+
+            done.append((job, res))
+
+        commit_start = time.perf_counter()
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+
+            if len(done) == 1:
+                done[0][0].future.set_exception(e)
+                return
+
+            # commit each job on its own so one bad job cannot fail the others
+            for job, res in done:
+                self._run_batch([job])
+            return
+
+        finished = time.perf_counter()
+        self.commit_time.record((finished - commit_start) * 1000)
+
+        for job, res in done:
+            self.latency.record((finished - job.enqueued_at) * 1000)
+            job.future.set_result(res)
+
+
+    def metrics(self):
+        """
+        Returns the writer latency histograms in milliseconds and the batch sizes
+        """
+        res = {
+            "enabled" : self.enabled,
+            "queue_depth" : self._queue.qsize() if self._queue is not None else 0,
+            "replays" : self.replays,
+            "latency_ms" : self.latency.metrics(),
+            "queue_wait_ms" : self.queue_wait.metrics(),
+            "commit_ms" : self.commit_time.metrics(),
+            "batch_size" : self.batch_size.metrics()
+        }
+        return res
+
+
+
+def init_app(app):
+    """
+    Attaches a writer to app, enabled by the DB_WRITE_QUEUE setting
+    """
+    app.extensions["writer"] = Writer(app, app.config.get("DB_WRITE_QUEUE", False))
+
+
+def get_writer():
+    return current_app.extensions["writer"]
+
+
+def run(fn, *args):
+    """
+    Runs a write job with the writer of the current app
+    """
+    return get_writer().run(fn, *args)
+
+
+def metrics():
+    return get_writer().metrics()